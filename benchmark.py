@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+# Headless benchmarks for the hot paths: collections, search parsing, sorting results and downloading images.
+# Everything runs against synthetic data in a throwaway cache directory and a local HTTP server,
+# nothing touches the real cache or the network.
+#
+#   python3 benchmark.py --sizes 1000 10000 100000 --output bench.json
+#
+# The results are JSON so runs from two revisions can be compared.
+
+import argparse, contextlib, json, os, random, subprocess, sys, tempfile, threading, time
+
+# cache.py works out its paths when it's imported so this has to happen first
+CACHE_HOME = tempfile.mkdtemp(prefix='mtg-bench-')
+os.environ['XDG_CACHE_HOME'] = CACHE_HOME
+
+import http.server
+from io import BytesIO
+from PIL import Image
+from mtgsdk import Card
+from cache import get_default_cache, build_cache_path, get_card_store
+from cardstore import CardStore
+from collectiondata import CollectionData
+from query import QueryParser
+from requester import Requester
+from ui.cardviewer import CardViewer
+
+RARITIES = ['Common', 'Uncommon', 'Rare', 'Mythic Rare']
+WORDS = ['goblin', 'dragon', 'bolt', 'angel', 'serra', 'shivan', 'llanowar', 'elves', 'counterspell', 'wrath',
+         'damage', 'target', 'creature', 'player', 'flying', 'trample', 'draw', 'card', 'discard', 'land']
+SETS = [(f'Set {i}', f'S{i:02}', f'{1993 + i // 4}-{1 + i % 12:02}-01') for i in range(80)]
+
+
+def make_card_dict(multiverse_id, rng):
+    name = ' '.join(rng.sample(WORDS, 2)).title()
+    return {'multiverse_id':multiverse_id, 'name':name, 'cmc':rng.randint(0, 8), 'rarity':rng.choice(RARITIES),
+            'text':' '.join(rng.choices(WORDS, k=20)) + '.', 'set_name':rng.choice(SETS)[0],
+            'image_url':None, 'rulings':[{'date':'2004-10-04', 'text':' '.join(rng.choices(WORDS, k=30))}]}
+
+def make_card(card_dict):
+    card = Card()
+    card.__dict__.update(card_dict)
+    return card
+
+def timed(function, repeat=1):
+    """ :return: The fastest of `repeat` runs in seconds """
+    best = None
+    for _ in range(repeat):
+        # The app prints as it goes, keep that off the terminal (it's still part of the time)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Benchmark(object):
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def record(self, name, seconds, size=None, ops=1, **extra):
+        result = {'name':name, 'size':size, 'seconds':seconds, 'ops':ops, 'per_op':seconds / ops, **extra}
+        self.results.append(result)
+        print(f'{name:40} size={str(size):>7} {seconds * 1000:10.2f} ms  ({result["per_op"] * 1e6:.1f} us/op)')
+
+    def collection(self, size):
+        rng = random.Random(size)
+        card_dicts = [make_card_dict(i + 1, rng) for i in range(size)]
+        directory = tempfile.mkdtemp(dir=CACHE_HOME)
+        path = os.path.join(directory, 'collection.json')
+
+        # Write the file through the normal API so it's in the current format
+        collection = CollectionData()
+        timed(lambda: [collection.add_card(make_card(card_dict)) for card_dict in card_dicts])
+        collection.save_as(path)
+
+        # The shared card store already has every card we just added in memory, a store of our own on
+        # the same database starts empty each time so the open really reads the cards from SQLite
+        database = get_card_store().path
+        self.record('collection.open', timed(lambda: CollectionData(path, card_store=CardStore(database)), self.repeat), size)
+        collection = CollectionData(path)
+
+        queries = ['name:goblin', 'text:damage to target', 'rarity:rare, cmc:3', 'name:dr, text:fly', 'cmc <= 2 or rarity:mythic rare', 'not text:damage']
+        self.record('collection.search', timed(lambda: [collection.search(query) for query in queries], self.repeat), size, len(queries))
+
+        cards = [make_card(card_dict) for card_dict in rng.sample(card_dicts, min(size, 1000))]
+        self.record('collection.add_card', timed(lambda: [collection.add_card(card) for card in cards]), size, len(cards))
+        self.record('collection.num_owned', timed(lambda: [collection.num_owned(card) for card in cards], self.repeat), size, len(cards))
+
+        self.record('collection.save', timed(collection.save, self.repeat), size)
+
+        journaled = CollectionData(path, journaled=True)
+        timed(lambda: [journaled.add_card(card) for card in cards])
+        self.record('collection.save_journaled', timed(journaled.save), size, len(cards))
+        if journaled.journal.compaction is not None:
+            journaled.journal.compaction.join()
+
+        # The same sort CardViewer does before showing results
+        results = [make_card(card_dict) for card_dict in card_dicts]
+        self.record('cardviewer.sort', timed(lambda: sorted(results, key=CardViewer.sort_key), self.repeat), size)
+
+    def search_parser(self):
+        # The old field:value, field:value form
+        queries = ['name:bolt', 'name: lightning bolt, cmc:1, rarity:common', 'text:draw a card, rarity:mythic'] * 1000
+        self.record('query.parse_legacy', timed(lambda: [QueryParser.parse(query) for query in queries], self.repeat), None, len(queries))
+        queries = ['cmc <= 3 or rarity:rare', '(name:fire or text:draw) and not cmc:3', 'name:light*, -rarity:common'] * 1000
+        # Not QueryPlan.compile, that would only measure its cache
+        self.record('query.parse', timed(lambda: [QueryParser.parse(query) for query in queries], self.repeat), None, len(queries))
+
+    def downloads(self, count):
+        server = ImageServer()
+        try:
+            rng = random.Random(count)
+            cards = []
+            for index in range(count):
+                card_dict = make_card_dict(1000000 + index, rng)
+                card_dict['image_url'] = f'{server.url}/{card_dict["multiverse_id"]}.png'
+                cards.append((index, make_card(card_dict)))
+
+            requester = Requester()
+            received = []
+            def download():
+                requester.async_download_images(cards)
+                while requester.preforming_async_task():
+                    received.extend(requester.pop_async_results())
+                    time.sleep(0.001)
+            seconds = timed(download)
+            # Failed downloads are only logged by the downloader
+            if len(received) != count:
+                print(f'Warning: only {len(received)} of {count} images downloaded', file=sys.stderr)
+            self.record('requester.download_images', seconds, count, count, received=len(received))
+        finally:
+            server.shutdown()
+
+
+class ImageServer(object):
+    """ Serves the same PNG for every path on a local port. """
+    def __init__(self):
+        buffer = BytesIO()
+        Image.new('RGB', (488, 680), (120, 40, 40)).save(buffer, format='PNG')
+        png = buffer.getvalue()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(png)))
+                self.end_headers()
+                self.wfile.write(png)
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def write_set_metadata():
+    """ Gives Requester a set list so sorting doesn't go to the network. """
+    path = os.path.join(build_cache_path(get_default_cache()), 'sets.json')
+    sets = [{'name':name, 'code':code, 'release_date':release_date} for name, code, release_date in SETS]
+    with open(path, 'w') as f:
+        json.dump({'fetched':time.time(), 'sets':sets}, f)
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Time the collection, search, cache and download paths.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='collection sizes to generate')
+    parser.add_argument('--downloads', type=int, default=200, help='images to fetch from the local server')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per timing, the fastest is kept')
+    parser.add_argument('--output', default='bench_output.json', help='where to write the JSON results')
+    args = parser.parse_args()
+
+    write_set_metadata()
+    benchmark = Benchmark(args.repeat)
+    benchmark.search_parser()
+    for size in args.sizes:
+        benchmark.collection(size)
+    benchmark.downloads(args.downloads)
+
+    with open(args.output, 'w') as f:
+        json.dump({'revision':revision(), 'python':sys.version.split()[0], 'time':time.time(),
+                   'results':benchmark.results}, f, indent=2)
+    print(f'Results written to {args.output}')
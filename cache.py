@@ -1,8 +1,30 @@
 # Thanks to pokebase for a lot of the ideas behind this cacheing code
-import shelve, os
+import os, json, hashlib, time, zlib, atexit, threading, contextlib, perf
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 API_CACHE = None
 IMAGE_CACHE = None
+IMAGE_STORE = None
+CARD_STORE = None
+SET_METADATA = None
+
+# Once the cached images take up more than this the least recently used are deleted
+IMAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Size cards are shown at, thumbnails are saved already scaled to this
+THUMBNAIL_SIZE = (223, 310)
+
+# Seconds a search result is trusted for when we're online
+API_CACHE_TTL = 24 * 60 * 60
+# Once the saved search results take up more than this the oldest are thrown away
+API_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Temporary files older than this were left by a crash rather than being written right now
+STALE_TEMP_SECONDS = 60 * 60
 
 def get_default_cache():
     xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or \
@@ -11,38 +33,111 @@ def get_default_cache():
     return os.path.join(xdg_cache_home,'magic-collection-tracker')
 
 
-# I dont' think this is going to work but i'll keep it around for now
-def save(data, multiverse_id):
-    """ Function to save data to cache
-    `data` Should be a Card object
-    `multiverse_id` Is the multiverse_id of the card
-    
-    :param data: Card object from mtgsdk
-    :multiverse_id: Multiverse ID of the card"""
+def query_key(search_dict):
+    """ Turns a search dict into the name of its cache entry.
+    The API ignores case so `name:Bolt` and `NAME: bolt` share an entry.
 
-    cache_path = get_default_cache()
+    :param search_dict: A dict of API filters, i.e. one from QueryPlan.api_filters
+    :return: A hex string """
+    normalized = {key.lower():str(value).strip().lower() for key, value in search_dict.items()}
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
 
-    try:
-        with shelve.open(API_CACHE) as cache:
-            cache[str(multiverse_id)] = data
-    except OSError as error:
-        if error.errno == 11:   # Cache open by something else
-            pass
-        else:
-            raise error
+def save(search_dict, cards):
+    """ Function to save the result of a search to cache
+
+    `search_dict` Is the dict the search was made with
+    `cards` Should be a list of Card objects
 
-# I dont' think this is going to work but i'll keep it around for now
-def load(multiverse_id):
-    cache_path = get_default_cache()
+    :param search_dict: API filters from QueryPlan.api_filters
+    :param cards: The Cards the API returned """
+    # Most fields are empty for most cards, there's no point storing them
+    payload = [{key:value for key, value in card.__dict__.items() if value is not None} for card in cards]
+    build_cache_path(API_CACHE)
+    write_atomic(os.path.join(API_CACHE, query_key(search_dict)), zlib.compress(json.dumps(payload).encode()))
+    trim_api_cache()
 
+def load(search_dict, max_age=None):
+    """ Function to load the result of a search from cache
+
+    :param search_dict: API filters from QueryPlan.api_filters
+    :param max_age: Entries older than this many seconds are ignored, None to accept any age
+    :return: A list of card dicts, or None if there's no usable entry """
+    path = os.path.join(API_CACHE, query_key(search_dict))
+    try:
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            perf.count('api_cache.expired')
+            return None
+        with perf.timer('api_cache.load'), open(path, 'rb') as f:
+            cards = json.loads(zlib.decompress(f.read()).decode())
+    except (OSError, ValueError, zlib.error):
+        # Missing, or half written by something that crashed
+        perf.count('api_cache.miss')
+        return None
+    perf.count('api_cache.hit')
+    return cards
+
+def trim_api_cache(max_bytes=None, max_age=None):
+    """ Removes expired entries, then the oldest ones until the cache fits in max_bytes. """
+    max_bytes = API_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    max_age = API_CACHE_TTL if max_age is None else max_age
+    now = time.time()
+
+    # Other processes can be saving and trimming at the same time, so any file might vanish
+    # part way through. Nothing here needs a lock: entries are only ever replaced whole
+    entries = []
     try:
-        with shelve.open(API_CACHE) as cache:
-            return cache[multiverse_id]
-    except OSError:
-        if error.errno == 11:   # Cache open by something else
+        for entry in os.scandir(API_CACHE):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.tmp'):
+                    # Somebody's write in progress, unless it's been there for ages
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        os.remove(entry.path)
+                elif now - stat.st_mtime > max_age:
+                    os.remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+    except FileNotFoundError:
+        return
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Something else trimmed it first
             pass
-        else:
-            raise error
+        total -= size
+
+def get_image_store():
+    """ Gets the store card images are kept in, made the first time it's asked for. """
+    global IMAGE_STORE
+    if IMAGE_STORE is None:
+        from imagestore import ImageStore
+        IMAGE_STORE = ImageStore(IMAGE_CACHE, IMAGE_CACHE_MAX_BYTES)
+        # Buffered accesses would be lost otherwise
+        atexit.register(IMAGE_STORE.flush)
+    return IMAGE_STORE
+
+def get_card_store():
+    """ Gets the card data shared by every collection, opened the first time it's asked for. """
+    global CARD_STORE
+    if CARD_STORE is None:
+        from cardstore import CardStore
+        CARD_STORE = CardStore(os.path.join(build_cache_path(get_default_cache()), 'cards.db'))
+    return CARD_STORE
+
+def get_set_metadata():
+    """ Gets the set list (names, codes and release dates) shared by everything, it reads the disk on the first lookup. """
+    global SET_METADATA
+    if SET_METADATA is None:
+        from setmetadata import SetMetadata
+        SET_METADATA = SetMetadata()
+    return SET_METADATA
 
 def save_sprite(data, multiverse_id):
     """ Function to save sprites to cache
@@ -52,24 +147,80 @@ def save_sprite(data, multiverse_id):
     
     :param data: Image() object of the card
     :multiverse_id: Multiverse ID of the card """
-    path = os.path.join(IMAGE_CACHE, str(multiverse_id) + '.png')
-
-    data.save(path)
+    get_image_store().put(multiverse_id, data)
+    # Scale it once now so showing it later doesn't have to
+    save_thumbnail(data, multiverse_id)
 
+def save_thumbnail(data, multiverse_id):
+    """ Saves a copy of the image scaled to THUMBNAIL_SIZE
+    :param data: Image() object of the card
+    :multiverse_id: Multiverse ID of the card """
+    from PIL import Image
+    # LANCZOS is the filter ANTIALIAS was an alias for
+    get_image_store().put(multiverse_id, data.resize(THUMBNAIL_SIZE, Image.LANCZOS), 'thumb')
 
-def load_cache():
-    with shelve.open(API_CACHE) as cache:
-        return cache
+def thumbnail_path(multiverse_id):
+    return get_image_store().path(multiverse_id, 'thumb')
 
 def sprite_in_cache(multiverse_id):
-    return os.path.isfile(os.path.join(IMAGE_CACHE, str(multiverse_id) + '.png'))
+    # Answered from the store's index, no stat
+    found = get_image_store().contains(multiverse_id)
+    perf.count('image_cache.hit' if found else 'image_cache.miss')
+    return found
 
 def load_sprite(multiverse_id):
-    path = os.path.join(IMAGE_CACHE, str(multiverse_id) + '.png')
-    with open(path, 'rb') as img_file:
-        img_data = img_file.read()
-
-    return dict(img_data=img_data, path=path)
+    """ Gets the paths to a cached card image. The file isn't read.
+    :return: dict(path=full size image, thumbnail=image scaled to THUMBNAIL_SIZE) """
+    store = get_image_store()
+    store.touch(multiverse_id)
+    if not store.contains(multiverse_id, 'thumb'):
+        from PIL import Image
+        # Saved before thumbnails existed, make it now so it only has to be done once
+        save_thumbnail(Image.open(store.path(multiverse_id)), multiverse_id)
+
+    return dict(path=store.path(multiverse_id), thumbnail=store.path(multiverse_id, 'thumb'))
+
+def write_atomic(path, text):
+    """ Writes text (str or bytes) to path through a temporary file so readers never see half of it.
+    Safe to call for the same path from several threads or processes at once, the last one wins. """
+    temp_path = temp_path_for(path)
+    with open(temp_path, 'wb' if isinstance(text, bytes) else 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+def temp_path_for(path):
+    """ :return: A temporary file name next to path that no other thread or process will use """
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+@contextlib.contextmanager
+def file_lock(path):
+    """ Holds an exclusive lock on the file at path (it's made if it doesn't exist) until the
+    with block ends. Other processes, and other threads of this one, wait for it.
+
+    Only for writers: the caches are laid out so readers never need it. """
+    # Each call opens its own handle and the lock belongs to the handle, so threads exclude each other too
+    with open(path, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(0.01)
+        try:
+            yield
+        finally:
+            # Closing the file releases it too, but say so rather than rely on it
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 def build_cache_path(path):
     try:
@@ -80,8 +231,8 @@ def build_cache_path(path):
 
     return path
 
-build_cache_path(os.path.join(get_default_cache(), 'images'))
-API_CACHE = os.path.join(get_default_cache(),'api.cache')
+# The directories are made when something is first saved to them
+API_CACHE = os.path.join(get_default_cache(),'api')
 IMAGE_CACHE = os.path.join(get_default_cache(), 'images')
 
 
@@ -0,0 +1,150 @@
+import math
+
+
+class CardColumns(object):
+    """ A copy of the numeric and categorical parts of a collection as NumPy arrays, one row per
+    card, so filters and totals over big collections run without a Python loop over the cards.
+
+    Needs NumPy, which is optional: making one raises ImportError without it. Rarity and set are
+    stored as integer codes into `rarities` and `sets`, -1 for a card that doesn't have one.
+    Cards are never taken out, one removed down to nothing stays with 0 owned like in the collection. """
+    initial_capacity = 1024
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+        self.size = 0
+        self.capacity = 0
+        self.multiverse_id = numpy.zeros(0, dtype=numpy.int64)
+        # NaN for cards without a cmc
+        self.cmc = numpy.zeros(0, dtype=numpy.float64)
+        self.owned = numpy.zeros(0, dtype=numpy.int64)
+        self.rarity = numpy.zeros(0, dtype=numpy.int32)
+        self.set = numpy.zeros(0, dtype=numpy.int32)
+
+        # key -> row and row -> key
+        self.rows = {}
+        self.keys = []
+        # code -> name and name -> code for each categorical column
+        self.rarities = []
+        self.rarity_codes = {}
+        self.sets = []
+        self.set_codes = {}
+
+    @staticmethod
+    def from_entries(entries):
+        """ Builds the columns for a whole collection at once.
+        :param entries: A dict of key -> {'card_data', 'collection_data'} like CollectionData.entries """
+        columns = CardColumns()
+        columns.__grow(len(entries))
+        for key, entry in entries.items():
+            columns.__write(columns.size, key, entry['card_data'], entry['collection_data']['owned'])
+            columns.rows[key] = columns.size
+            columns.keys.append(key)
+            columns.size += 1
+        return columns
+
+    def add(self, key, card_dict, owned):
+        """ Adds a card, or replaces what's stored for it if the key is already there. """
+        row = self.rows.get(key)
+        if row is None:
+            self.__grow(self.size + 1)
+            row = self.size
+            self.rows[key] = row
+            self.keys.append(key)
+            self.size += 1
+        self.__write(row, key, card_dict, owned)
+
+    def set_owned(self, key, owned):
+        """ Updates the owned count of a card that's already stored. """
+        self.owned[self.rows[key]] = owned
+
+    def __grow(self, needed):
+        """ Makes sure there's room for `needed` rows, doubling so adding a card is amortized constant time. """
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2, CardColumns.initial_capacity)
+        for name in ('multiverse_id', 'cmc', 'owned', 'rarity', 'set'):
+            old = getattr(self, name)
+            new = self.numpy.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def __write(self, row, key, card_dict, owned):
+        multiverse_id = card_dict.get('multiverse_id', key)
+        # Ids that aren't numbers can still be found through self.keys
+        self.multiverse_id[row] = multiverse_id if isinstance(multiverse_id, int) else -1
+        try:
+            self.cmc[row] = float(card_dict.get('cmc'))
+        except (TypeError, ValueError):
+            self.cmc[row] = math.nan
+        self.owned[row] = owned
+        self.rarity[row] = CardColumns.__code(card_dict.get('rarity'), self.rarities, self.rarity_codes)
+        self.set[row] = CardColumns.__code(card_dict.get('set'), self.sets, self.set_codes)
+
+    @staticmethod
+    def __code(value, names, codes):
+        if value is None:
+            return -1
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(names)
+            names.append(value)
+        return code
+
+    def mask(self, field, op, value):
+        """ Tests one column for every card at once.
+        :param field: cmc, owned, rarity or set
+        :param op: =, !=, <, <=, > or >=. rarity and set only do = and !=
+        :param value: What to compare with, a name for rarity and set
+        :return: A boolean array with one entry per row, combine them with & | ~ """
+        if field in ('rarity', 'set'):
+            names, codes = (self.rarities, self.rarity_codes) if field == 'rarity' else (self.sets, self.set_codes)
+            column = getattr(self, field)[:self.size]
+            # Rarities are matched the way searches match them, without case
+            matching = [code for name, code in codes.items() if name.lower() == str(value).lower()]
+            found = self.numpy.isin(column, matching)
+            if op == '=':
+                return found
+            if op == '!=':
+                return ~found
+            raise ValueError(f"{field} can't be compared with {op}")
+
+        column = getattr(self, field)[:self.size]
+        value = float(value)
+        # Comparisons with NaN are all False, so cards without a cmc never match
+        return {'=':column == value, '!=':column != value, '<':column < value,
+                '<=':column <= value, '>':column > value, '>=':column >= value}[op]
+
+    def rows_for(self, keys):
+        """ :return: A boolean array that's True for the rows of the given keys """
+        mask = self.numpy.zeros(self.size, dtype=bool)
+        rows = [self.rows[key] for key in keys if key in self.rows]
+        mask[rows] = True
+        return mask
+
+    def statistics(self, mask=None):
+        """ Totals over the collection, or the part of it picked out by mask.
+        :return: A dict in the format CollectionData.statistics returns """
+        numpy = self.numpy
+        if mask is None:
+            mask = numpy.ones(self.size, dtype=bool)
+        # Cards removed down to nothing stay in the collection with 0 (or less) owned
+        owned = numpy.maximum(self.owned[:self.size], 0) * mask
+        held = owned > 0
+        cmc = self.cmc[:self.size]
+        costed = held & ~numpy.isnan(cmc)
+
+        def by_code(column, names):
+            # Shifted by one so the -1 "none" code gets a bin too
+            totals = numpy.bincount(column[:self.size] + 1, weights=owned, minlength=len(names) + 1)
+            return {(names[shifted - 1] if shifted else None):int(total) for shifted, total in enumerate(totals) if total}
+
+        values, inverse = numpy.unique(cmc[costed], return_inverse=True)
+        curve = numpy.bincount(inverse, weights=owned[costed], minlength=len(values))
+        total_costed = owned[costed].sum()
+        return {'unique':int(held.sum()), 'total':int(owned.sum()),
+                'by_rarity':by_code(self.rarity, self.rarities), 'by_set':by_code(self.set, self.sets),
+                'curve':{float(value):int(total) for value, total in zip(values, curve)},
+                'average_cmc':float((cmc[costed] * owned[costed]).sum() / total_costed) if total_costed else None}
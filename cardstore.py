@@ -0,0 +1,173 @@
+import json, sqlite3, threading, logging
+
+log = logging.getLogger(__name__)
+
+
+class CardStore(object):
+    """ Card data shared by every collection, kept in a SQLite database in the cache directory
+    and keyed by multiverse_id. Collections only have to remember ids and counts.
+
+    Cards that have been read are kept in memory, so collections open in the same process share
+    one dict per card instead of each having their own copy. """
+    # Most ids to put in one query, SQLite limits how many parameters a statement can have
+    chunk_size = 500
+    # Seconds to wait for another process that's writing to the database before giving up
+    busy_timeout = 30
+
+    def __init__(self, path):
+        self.path = path
+        # Used from the UI thread and from background threads (i.e. searches), the lock keeps them apart
+        self.connection = sqlite3.connect(path, timeout=CardStore.busy_timeout, check_same_thread=False)
+        # Other instances of the app share the database, WAL lets them read while one of them writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cards (multiverse_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        # Lower cased card name -> the printing imports by name get, so a name is only looked up once
+        self.connection.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, multiverse_id TEXT NOT NULL)')
+        self.connection.commit()
+        self.lock = threading.Lock()
+        # key -> card dict for every card read or written so far
+        self.cards = {}
+
+    @staticmethod
+    def key(multiverse_id):
+        return str(multiverse_id)
+
+    def put(self, card_dict):
+        """ Saves a card's data, replacing what was there.
+        :param card_dict: The card's attributes, i.e. card.__dict__
+        :return: The dict the store will hand out for this card from now on """
+        return self.put_many([card_dict])[0]
+
+    def put_many(self, card_dicts):
+        """ Saves several cards in one transaction.
+        :return: The stored dicts in the same order """
+        stored = []
+        rows = []
+        for card_dict in card_dicts:
+            key = CardStore.key(card_dict['multiverse_id'])
+            card_dict = dict(card_dict)
+            stored.append(card_dict)
+            rows.append((key, json.dumps(card_dict)))
+        with self.lock:
+            with self.connection:
+                self.connection.executemany('INSERT OR REPLACE INTO cards VALUES (?, ?)', rows)
+            for (key, _), card_dict in zip(rows, stored):
+                self.cards[key] = card_dict
+        return stored
+
+    def get(self, multiverse_id):
+        """ :return: The card's data as a dict, None if it isn't stored """
+        return self.get_many([multiverse_id]).get(CardStore.key(multiverse_id))
+
+    def get_many(self, multiverse_ids, fetch_missing=False):
+        """ Gets the data for several cards.
+        :param multiverse_ids: The cards to get
+        :param fetch_missing: Ask the API for cards that aren't stored, in as few requests as possible
+        :return: A dict of key -> card dict. Cards that couldn't be found are left out """
+        keys = {CardStore.key(multiverse_id) for multiverse_id in multiverse_ids}
+        with self.lock:
+            found = {key:self.cards[key] for key in keys if key in self.cards}
+            missing = [key for key in keys if key not in found]
+            for start in range(0, len(missing), CardStore.chunk_size):
+                chunk = missing[start:start + CardStore.chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                for key, data in self.connection.execute(f'SELECT multiverse_id, data FROM cards WHERE multiverse_id IN ({placeholders})', chunk):
+                    found[key] = self.cards[key] = json.loads(data)
+
+        if fetch_missing:
+            missing = [key for key in keys if key not in found]
+            if missing:
+                for card_dict in self.put_many(CardStore.fetch(missing)):
+                    found[CardStore.key(card_dict['multiverse_id'])] = card_dict
+        return found
+
+    def iter_many(self, multiverse_ids, fetch_missing=False):
+        """ Like get_many, but hands the cards out one at a time and doesn't keep the ones it
+        reads, so going over a whole collection never has all of its cards in memory at once.
+        :return: A generator of (key, card dict). Cards that couldn't be found are left out """
+        keys = list({CardStore.key(multiverse_id) for multiverse_id in multiverse_ids})
+        missing = set()
+        for start in range(0, len(keys), CardStore.chunk_size):
+            chunk = keys[start:start + CardStore.chunk_size]
+            # Rows are parsed outside the lock, whoever reads the cards can use the store in between
+            with self.lock:
+                cached = {key:self.cards[key] for key in chunk if key in self.cards}
+                uncached = [key for key in chunk if key not in cached]
+                placeholders = ','.join('?' * len(uncached))
+                rows = self.connection.execute(f'SELECT multiverse_id, data FROM cards WHERE multiverse_id IN ({placeholders})', uncached).fetchall()
+            yield from cached.items()
+            for key, data in rows:
+                yield key, json.loads(data)
+            missing.update(set(uncached) - {key for key, _ in rows})
+
+        if fetch_missing and missing:
+            yield from self.get_many(missing, fetch_missing=True).items()
+
+    def find_names(self, names, fetch_missing=False):
+        """ Works out which card each name means. A name has lots of printings, the newest one
+        (the highest multiverse_id) is used.
+        :param names: Card names, case doesn't matter
+        :param fetch_missing: Ask the API about names that haven't been looked up before, in as few requests as possible
+        :return: A dict of lower cased name -> key. Names that couldn't be found are left out """
+        wanted = {name.strip().lower() for name in names}
+        found = {}
+        with self.lock:
+            missing = list(wanted)
+            for start in range(0, len(missing), CardStore.chunk_size):
+                chunk = missing[start:start + CardStore.chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                for name, key in self.connection.execute(f'SELECT name, multiverse_id FROM names WHERE name IN ({placeholders})', chunk):
+                    found[name] = key
+
+        if fetch_missing:
+            missing = [name for name in wanted if name not in found]
+            if missing:
+                card_dicts = [card_dict for card_dict in CardStore.fetch_names(missing) if card_dict.get('multiverse_id') is not None]
+                newest = {}
+                for card_dict in card_dicts:
+                    name = card_dict['name'].lower()
+                    if name in wanted and (name not in newest or card_dict['multiverse_id'] > newest[name]['multiverse_id']):
+                        newest[name] = card_dict
+                # Every printing goes in the store, they came with the same requests
+                self.put_many(card_dicts)
+                rows = [(name, CardStore.key(card_dict['multiverse_id'])) for name, card_dict in newest.items()]
+                with self.lock:
+                    with self.connection:
+                        self.connection.executemany('INSERT OR REPLACE INTO names VALUES (?, ?)', rows)
+                found.update(rows)
+        return found
+
+    @staticmethod
+    def fetch_names(names):
+        """ Downloads every printing of the named cards, several names per request.
+        :return: A list of card dicts """
+        import mtgsdk
+        card_dicts = []
+        # Names make for long URLs so fewer go in each request than with ids
+        for start in range(0, len(names), 20):
+            chunk = names[start:start + 20]
+            try:
+                cards = mtgsdk.Card.where(name='|'.join(chunk)).all()
+            except Exception as error:
+                log.warning("Couldn't look up %d card names: %s", len(chunk), error)
+                continue
+            # The API matches names partially, i.e. "bolt" finds "Lightning Bolt"
+            card_dicts.extend(card.__dict__ for card in cards if card.name and card.name.lower() in chunk)
+        return card_dicts
+
+    @staticmethod
+    def fetch(keys):
+        """ Downloads cards from the API, many ids per request.
+        :return: A list of card dicts """
+        import mtgsdk
+        card_dicts = []
+        # The API takes | separated values as "any of these"
+        for start in range(0, len(keys), 100):
+            chunk = keys[start:start + 100]
+            try:
+                cards = mtgsdk.Card.where(multiverseid='|'.join(chunk)).all()
+            except Exception as error:
+                log.warning("Couldn't fetch card data for %d cards: %s", len(chunk), error)
+                continue
+            card_dicts.extend(card.__dict__ for card in cards if CardStore.key(card.multiverse_id) in chunk)
+        return card_dicts
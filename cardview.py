@@ -0,0 +1,60 @@
+class CardView(object):
+    """ A read-only stand in for mtgsdk.Card over a card's stored data, what collection searches
+    hand out instead of copying every hit into a new Card.
+
+    Attributes read like a Card's, ones the card doesn't have are None. The fields sorting and
+    statistics need (summary_fields) come from a small summary the collection keeps in memory.
+    Anything else fetches the card's record from the card store the first time it's read, and
+    that's the store's own dict, nothing is copied. """
+    __slots__ = ('summary', 'store', 'record')
+    summary_fields = ('multiverse_id', 'name', 'set', 'set_name', 'cmc', 'rarity')
+
+    def __init__(self, summary, store=None, record=None):
+        """ :param summary: A dict with at least multiverse_id, see summarize
+            :param store: The CardStore to get the rest of the card from
+            :param record: The full card data if it's already at hand """
+        object.__setattr__(self, 'summary', summary)
+        object.__setattr__(self, 'store', store)
+        object.__setattr__(self, 'record', record)
+
+    @staticmethod
+    def summarize(card_dict):
+        """ :return: The parts of the card data that a CardView answers without the record """
+        # Fields the card doesn't have come out as None, which reads the same as missing
+        return dict(zip(CardView.summary_fields, map(card_dict.get, CardView.summary_fields)))
+
+    def get(self, name, default=None):
+        """ dict style lookup, so a view can go wherever card data (card.__dict__) is expected
+        without reading its record for the summary fields. """
+        if name in CardView.summary_fields:
+            value = self.summary.get(name)
+        else:
+            value = self.__record().get(name)
+        return default if value is None else value
+
+    def __getattr__(self, name):
+        # Only called for names that aren't slots
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self.get(name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Can't set {name}, a CardView is read-only")
+
+    @property
+    def __dict__(self):
+        """ The card's data like Card.__dict__ is, so code written for Cards keeps working. Don't change it. """
+        return self.__record()
+
+    def __record(self):
+        record = self.record
+        if record is None:
+            if self.store is not None:
+                record = self.store.get(self.summary['multiverse_id'])
+            # Not in the store (i.e. the API didn't know it), the summary is all there is
+            record = record or self.summary
+            object.__setattr__(self, 'record', record)
+        return record
+
+    def __repr__(self):
+        return f'CardView({self.summary.get("multiverse_id")!r}, {self.summary.get("name")!r})'
@@ -1,35 +1,106 @@
-import json,os
+import json,os,threading,queue,logging,perf
 from mtgsdk import Card
-from searchparser import SearchParser
+from cardview import CardView
+from searchindex import SearchIndex
+from query import QueryPlan
+from cardcolumns import CardColumns
+from sortengine import SortKeys, SortedList, get_sort_keys
+from cache import get_set_metadata
+from journal import Journal
+from decklist import Decklist
+from cache import write_atomic, get_card_store
+
+log = logging.getLogger(__name__)
 
 class CollectionData(object):
-    default_collection = {'collection':[]}
-    def __init__(self, file_path=''):
-        
+    # Files only hold multiverse_id -> owned, the card data itself lives in the shared card store
+    default_collection = {'format':2, 'collection':{}}
+    # Cards asked for at once by the background fetch, the same number CardStore.fetch puts in a request
+    fetch_chunk_size = 100
+    def __init__(self, file_path='', journaled=False, card_store=None, columnar=True):
+        """ :param columnar: Keep a NumPy copy of the collection (see CardColumns) for statistics,
+                              ignored if NumPy isn't installed """
         self.file_path = file_path
 
+        # Where the data for the cards in the collection is kept
+        self.card_store = card_store or get_card_store()
+        # Set when the file was in the old layout, it gets rewritten (and backed up) on the next save
+        self.migrated = False
+
+        # In journaled mode save() only appends the changes made since the last save to a log next to the file
+        self.journaled = journaled
+        self.journal = Journal(file_path) if journaled and file_path else None
+        # Changes that haven't been written to the journal yet
+        self.pending = []
+
+        # Maps multiverse_id -> {'card_data', 'collection_data'} for every card in the collection.
+        # card_data only holds what sorting and statistics need (see CardView.summarize), the
+        # rest of each card stays in the card store until something reads it
+        self.entries = {}
+        # Index over the searchable fields so search doesn't have to look at every card
+        self.search_index = SearchIndex()
+        # Arrays of the numbers in the collection, None if columnar is off or NumPy is missing
+        self.columnar = columnar
+        self.columns = None
+        # Every multiverse_id in the default sort order, made by the first search and kept up to date after that
+        self.sorted = None
+        self.sorted_version = None
+
+        # Ids the collection was opened without the data for (the store didn't have it), the
+        # API is asked for them on another thread so a cold cache doesn't hold up opening
+        self.unfetched = set()
+        # Card dicts the background fetch got, fill_fetched puts them into the entries
+        self.fetched = queue.Queue()
+        self.fetch_thread = None
+        # Called on the fetch thread once it's done, i.e. so a viewer can show the search again
+        self.on_fetched = None
+
         self.collection_data = self.open_collection_data(file_path)
+        self.__fetch_missing()
 
     def search(self, text):
         """ Gets a list of cards based on the text.
-        :param text: The text used to search the collection
-        :return: A list of mtgsdk.Card objects that match the search. """
-        search_dict = SearchParser.get_dict(text)
-        cards = []
-        for card_data in self.collection_data['collection']:
-            # Pull out the card data
-            card_dict = card_data['card_data']
-            # If all of the search parameters appear in their respective locations for this card
-            # then we need to add it to the cards list
-            if all([search_dict[key].lower() in card_dict[key].lower() for key in search_dict.keys()]):
-                # Make a card object
-                card = Card()
-                card.__dict__.update(card_dict)
-
-                cards.append(card)
-        print(f'cards found in collection: {[card.name for card in cards]}')
+        :param text: The text used to search the collection, see query.QueryParser for what it can contain
+        :return: A list of CardView objects that match the search. They read like mtgsdk.Card
+                 but only fetch a card's full data from the card store when it's used
+        :raises query.QueryError: If the text can't be understood """
+        self.fill_fetched()
+        # The index hands back the multiverse_ids of every card that matches the query
+        cards = [CardView(self.entries[multiverse_id]['card_data'], self.card_store)
+                 for multiverse_id in self.__in_order(QueryPlan.compile(text).keys(self.search_index))]
+        perf.count('collection.search_results', len(cards))
         return cards
 
+    def __in_order(self, keys):
+        """ Puts search results in the default sort order (see SortKeys), so the viewer's merge has nothing to do. """
+        ordered = self.__sorted()
+        if len(keys) * 16 < len(ordered):
+            # A few results, quicker to sort them than to look through the whole collection
+            sort_keys = get_sort_keys()
+            return sorted(keys, key=lambda key: sort_keys.key(SortKeys.default_order, self.entries[key]['card_data']))
+        if len(keys) == len(ordered):
+            return list(ordered)
+        return [key for key in ordered if key in keys]
+
+    def __sorted(self):
+        """ Gets self.sorted, sorting the collection if it hasn't been yet or the set release dates changed. """
+        sort_keys = get_sort_keys()
+        key = lambda multiverse_id: sort_keys.key(SortKeys.default_order, self.entries[multiverse_id]['card_data'])
+        if self.sorted is None:
+            self.sorted = SortedList(key)
+            self.sorted.extend(self.entries)
+        elif self.sorted_version != get_set_metadata().version:
+            self.sorted.resort(key)
+        # Read afterwards, working out the keys can be what loads the sets
+        self.sorted_version = get_set_metadata().version
+        return self.sorted
+
+    def iter_search(self, text):
+        """ Same as search but in the paged form Requester.iter_search uses. The index
+        answers fast enough that everything comes back as one page.
+        :return: A generator of lists of CardView objects """
+        yield self.search(text)
+
 
     # Adds a card to the collection
     def add_card(self, card):
@@ -38,22 +109,92 @@ class CollectionData(object):
         `card` Should be a mtgsdk.Card type. Will throw error otherwise
 
         :param card: The card to add."""
-        if type(card) != Card:
+        if not isinstance(card, (Card, CardView)):
             raise ValueError("You must only add Cards types to your collection.")
 
-        # Grabs the multiverse_id value from all the cards in the collection
-        # TODO : This can probably be cache instead of calculated every time we add a card if it becomes too slow to iterate through them all
-        cards = [card['card_data']['multiverse_id'] for card in self.collection_data['collection']]
+        card_dict = None
+        if card.multiverse_id not in self.entries:
+            # First copy, the card store needs to know about it before the collection can refer to it
+            card_dict = self.card_store.put(card.__dict__)
+        self.__add(card.multiverse_id, card_dict)
+
+        if self.journaled:
+            self.pending.append({'op':'add', 'multiverse_id':card.multiverse_id})
 
-        # If this card appears in the collectoin add one to the owned field
-        # otherwise add it to the collection with 1 owned
-        if card.multiverse_id in cards:
-            index = cards.index(card.multiverse_id)
-            self.collection_data['collection'][index]['collection_data']['owned'] += 1
+    def add_cards(self, cards):
+        """ Adds a lot of cards in one go. Cards the card store doesn't know about are fetched
+        from the API together rather than one request each. Like add_card nothing is written
+        until the collection is saved.
+
+        :param cards: An iterable of (multiverse_id, count) tuples
+        :return: The multiverse_ids the API didn't know, they're left out of the collection """
+        # Repeats of the same card are added up so each card is touched once
+        counts = {}
+        for multiverse_id, count in cards:
+            if count < 1:
+                raise ValueError(f"Can't add {count} copies of {multiverse_id}")
+            counts[multiverse_id] = counts.get(multiverse_id, 0) + count
+
+        new_ids = [multiverse_id for multiverse_id in counts if multiverse_id not in self.entries]
+        card_dicts = self.card_store.get_many(new_ids, fetch_missing=True)
+
+        unknown = []
+        for multiverse_id, count in counts.items():
+            card_dict = None
+            if multiverse_id not in self.entries:
+                card_dict = card_dicts.get(self.card_store.key(multiverse_id))
+                if card_dict is None:
+                    unknown.append(multiverse_id)
+                    continue
+            self.__add(multiverse_id, card_dict, count)
+            if self.journaled:
+                self.pending.append({'op':'add', 'multiverse_id':multiverse_id, 'count':count})
+        return unknown
+
+    def import_file(self, file_path):
+        """ Adds the cards in a decklist or CSV file (see Decklist for the formats) and saves the
+        collection once at the end if it has a file. Names are turned into cards with one batched
+        lookup that's remembered for next time.
+
+        :param file_path: The file to import
+        :return: The names or multiverse_ids from the file that couldn't be found """
+        resolved, unknown = Decklist.resolve(Decklist.read(file_path), self.card_store)
+        unknown.extend(self.add_cards(resolved))
+        log.info('Imported %d cards from %s, %d not found', sum(count for _, count in resolved), file_path, len(unknown))
+        if self.file_path:
+            self.save()
+        return unknown
+
+    def __add(self, multiverse_id, card_dict=None, count=1):
+        """ Adds count to owned, creating the entry if needed.
+        :param card_dict: The card's data, looked up in the card store if it's needed and not given
+        :return: True if a new entry was made """
+        # If this card appears in the collectoin add to the owned field
+        # otherwise add it to the collection with count owned
+        entry = self.entries.get(multiverse_id)
+        if entry is not None:
+            entry['collection_data']['owned'] += count
+            self.collection_data['collection'][str(multiverse_id)] = entry['collection_data']['owned']
+            if self.columns is not None:
+                self.columns.set_owned(multiverse_id, entry['collection_data']['owned'])
+            return False
         else:
+            if card_dict is None:
+                card_dict = self.card_store.get(multiverse_id)
+            if card_dict is None:
+                # Only when a journal is replayed, the data is fetched in the background like at open
+                card_dict = {'multiverse_id':multiverse_id}
+                self.unfetched.add(multiverse_id)
             # This is a default version of what a card's data is
-            default_card_data = {'card_data':card.__dict__, 'collection_data':{'owned':1}}
-            self.collection_data['collection'].append(default_card_data)
+            default_card_data = {'card_data':CardView.summarize(card_dict), 'collection_data':{'owned':count}}
+            self.collection_data['collection'][str(multiverse_id)] = count
+            self.entries[multiverse_id] = default_card_data
+            self.search_index.add(multiverse_id, card_dict)
+            if self.columns is not None:
+                self.columns.add(multiverse_id, card_dict, count)
+            if self.sorted is not None:
+                self.sorted.add(multiverse_id)
+            return True
 
     # Removes a card from the collection
     def remove_card(self, card):
@@ -62,64 +203,253 @@ class CollectionData(object):
         `card` Should be a mtgsdk.Card type. Will throw error otherwise
 
         :param card: The card to add."""
-        if type(card) != Card:
+        if not isinstance(card, (Card, CardView)):
             raise ValueError("You must only remove Cards types from your collection.")
 
-        # Grabs the multiverse_id value from all the cards in the collection
-        # TODO : This can probably be cache instead of calculated every time we add a card if it becomes too slow to iterate through them all
-        cards = [card['card_data']['multiverse_id'] for card in self.collection_data['collection']]
-        if card.multiverse_id in cards:
-            index = cards.index(card.multiverse_id)
-            if self.collection_data['collection'][index]['collection_data']['owned'] >= 0:
-                self.collection_data['collection'][index]['collection_data']['owned']-= 1
+        if self.__remove(card.multiverse_id) and self.journaled:
+            self.pending.append({'op':'remove', 'multiverse_id':card.multiverse_id})
+
+    def __remove(self, multiverse_id):
+        """ Takes one from owned.
+        :return: True if anything changed """
+        entry = self.entries.get(multiverse_id)
+        if entry is not None:
+            if entry['collection_data']['owned'] >= 0:
+                entry['collection_data']['owned']-= 1
+                self.collection_data['collection'][str(multiverse_id)] = entry['collection_data']['owned']
+                if self.columns is not None:
+                    self.columns.set_owned(multiverse_id, entry['collection_data']['owned'])
+                return True
+        return False
 
     def num_owned(self,card):
         """ Gets the number of owned cards with the same multiverse_id as the given card.
         :param card: The card to check.
         :return: The number of cards of this type that are owned in the collection. """
-        if type(card) != Card:
+        if not isinstance(card, (Card, CardView)):
             raise ValueError("You must only remove Cards types from your collection.")
 
-        mid = card.multiverse_id
-
-        cards = [card['card_data']['multiverse_id'] for card in self.collection_data['collection']]
+        entry = self.entries.get(card.multiverse_id)
 
-        if mid in cards:
-            index = cards.index(mid)
-            return self.collection_data['collection'][index]['collection_data']['owned']
+        if entry is not None:
+            return entry['collection_data']['owned']
         else:
             return '0'
 
     
+    def statistics(self, text=''):
+        """ Totals for the collection. Only cards with at least one copy owned are counted.
+        :param text: Only count the cards that match this search, everything if it's empty
+        :return: A dict with
+                 unique: how many different cards are owned
+                 total: how many copies are owned
+                 by_rarity: rarity -> copies
+                 by_set: set code -> copies
+                 curve: cmc -> copies, cards without a cmc are left out
+                 average_cmc: over every owned copy with a cmc, None if there aren't any """
+        self.fill_fetched()
+        if self.columns is not None:
+            return self.columns.statistics(QueryPlan.compile(text).mask(self.columns, self.search_index) if text else None)
+
+        keys = QueryPlan.compile(text).keys(self.search_index) if text else None
+
+        # Without NumPy
+        statistics = {'unique':0, 'total':0, 'by_rarity':{}, 'by_set':{}, 'curve':{}, 'average_cmc':None}
+        total_cmc = 0
+        costed = 0
+        for multiverse_id in (self.entries if keys is None else keys):
+            entry = self.entries[multiverse_id]
+            owned = entry['collection_data']['owned']
+            if owned <= 0:
+                continue
+            card_dict = entry['card_data']
+            statistics['unique'] += 1
+            statistics['total'] += owned
+            for field, totals in (('rarity', statistics['by_rarity']), ('set', statistics['by_set'])):
+                totals[card_dict.get(field)] = totals.get(card_dict.get(field), 0) + owned
+            try:
+                cmc = float(card_dict.get('cmc'))
+            except (TypeError, ValueError):
+                continue
+            statistics['curve'][cmc] = statistics['curve'].get(cmc, 0) + owned
+            total_cmc += cmc * owned
+            costed += owned
+        statistics['curve'] = dict(sorted(statistics['curve'].items()))
+        statistics['average_cmc'] = total_cmc / costed if costed else None
+        return statistics
+
     def save_as(self, file_path):
         """ Save the collection data to disk as file_path
         :return: None """
-        with open(file_path, 'w') as f:
-            f.write(json.dumps(self.collection_data))
+        if self.migrated and file_path == self.file_path and os.path.isfile(file_path):
+            # Keep the file in its old layout around in case something needs it
+            os.replace(file_path, file_path + '.v1.bak')
+        self.migrated = False
+
         self.file_path = file_path
+        if self.journaled:
+            # A background compaction finishing after this would put an older snapshot back
+            if self.journal is not None:
+                self.journal.wait()
+            journal = self.journal
+            if journal is None or journal.snapshot_path != file_path:
+                journal = Journal(file_path)
+                # Sequence numbers go on from past anything already logged for either file,
+                # so whatever is left in the log if we crash below is skipped on replay
+                journal.replay()
+                journal.seq = max(journal.seq, self.journal.seq if self.journal is not None else 0)
+            # A full snapshot, then an empty journal. The snapshot has to be on disk first,
+            # otherwise a crash in between would lose the changes that were only in the journal
+            self.collection_data['journal_seq'] = journal.seq
+            write_atomic(file_path, json.dumps(self.collection_data))
+            journal.truncate()
+            self.journal = journal
+            self.pending = []
+        else:
+            with open(file_path, 'w') as f:
+                f.write(json.dumps(self.collection_data))
     
     def save(self):
         """ Save the collection data to disk as the file given to __init__
+
+        In journaled mode only the changes since the last save are written. Once the journal
+        gets big enough it's folded into a new snapshot in the background.
         :return: None """
         assert(self.file_path != '')
-        with open(self.file_path, 'w') as f:
-            f.write(json.dumps(self.collection_data))
+        if not self.journaled or self.migrated:
+            # Not journaled, or the file is in the old layout and has to be rewritten whole
+            self.save_as(self.file_path)
+            return
+
+        if self.journal is None or not os.path.isfile(self.file_path):
+            # Nothing to append to yet
+            self.save_as(self.file_path)
+            return
+
+        self.journal.append(self.pending)
+        self.pending = []
+
+        if self.journal.size() > Journal.compact_threshold and not self.journal.is_compacting():
+            self.journal.compact(self.__snapshot())
+
+    def __snapshot(self):
+        """ Copies the parts of the collection that change so it can be written out on another thread. """
+        return {'format':2, 'collection':dict(self.collection_data['collection']), 'journal_seq':self.journal.seq}
     
     def open_collection_data(self, file_path):
         """ Get the data from disk.
-        :return: The data as a json style set of dicts and list. If no file exists then returns a default value."""
+        :return: The data as a json style set of dicts. If no file exists then returns a default value."""
         # If the file doesn't exist
         if os.path.isfile(file_path):
             with open(file_path, 'r') as f:
-                return json.load(f)
+                collection_data = json.load(f)
         else:
-            return CollectionData.default_collection
+            # Copy the default so separate collections don't share (and mutate) the same dict
+            collection_data = {'format':2, 'collection':{}}
 
+        if isinstance(collection_data['collection'], list):
+            collection_data = self.__migrate(collection_data)
 
+        # Build the multiverse_id index once, add_card keeps it up to date from here on.
+        # The cards are read from the store one at a time, indexed and let go of, only their summaries are kept
+        owned = collection_data['collection']
+        self.entries = {}
+        self.search_index = SearchIndex()
+        for key, card_dict in self.card_store.iter_many(owned.keys()):
+            self.__index(card_dict, owned[key])
+        for key, count in owned.items():
+            multiverse_id = CollectionData.multiverse_id(key)
+            if multiverse_id not in self.entries:
+                # Not in the store, it's fetched after opening and there's only the id until then
+                self.__index({'multiverse_id':multiverse_id}, count)
+                self.unfetched.add(multiverse_id)
+        if self.columnar:
+            try:
+                self.columns = CardColumns.from_entries(self.entries)
+            except ImportError:
+                # NumPy is optional, statistics work it out the slow way without it
+                self.columns = None
 
+        if self.journal is not None:
+            # __add and __remove need collection_data to be set before the journal is replayed
+            self.collection_data = collection_data
+            for record in self.journal.replay(collection_data.get('journal_seq', 0)):
+                if record['op'] == 'add':
+                    card_dict = record.get('card_data')
+                    if card_dict is not None:
+                        # Journals written before the card store carry the card data themselves
+                        card_dict = self.card_store.put(card_dict)
+                    self.__add(record['multiverse_id'], card_dict, record.get('count', 1))
+                elif record['op'] == 'remove':
+                    self.__remove(record['multiverse_id'])
 
-    
+        return collection_data
 
-    
+    def __fetch_missing(self):
+        """ Asks the API for the cards in self.unfetched on another thread. Results go on
+        self.fetched a request at a time. """
+        if not self.unfetched:
+            return
+        missing = list(self.unfetched)
+
+        def fetch():
+            for start in range(0, len(missing), CollectionData.fetch_chunk_size):
+                chunk = missing[start:start + CollectionData.fetch_chunk_size]
+                for card_dict in self.card_store.get_many(chunk, fetch_missing=True).values():
+                    self.fetched.put(card_dict)
+            if self.on_fetched is not None:
+                self.on_fetched()
+
+        self.fetch_thread = threading.Thread(target=fetch, daemon=True)
+        self.fetch_thread.start()
+
+    def fill_fetched(self):
+        """ Puts the cards the background fetch has got so far into the collection. search and
+        statistics do it themselves. Only call it from the thread that uses the collection.
+        :return: The number of cards filled in """
+        filled = 0
+        while True:
+            try:
+                card_dict = self.fetched.get_nowait()
+            except queue.Empty:
+                return filled
+            multiverse_id = card_dict['multiverse_id']
+            entry = self.entries.get(multiverse_id)
+            if entry is None or multiverse_id not in self.unfetched:
+                continue
+            self.unfetched.discard(multiverse_id)
+            if self.sorted is not None:
+                # Its place in the order depends on the data that's about to change
+                self.sorted.remove(multiverse_id)
+            get_sort_keys().forget(multiverse_id)
+            entry['card_data'] = CardView.summarize(card_dict)
+            self.search_index.add(multiverse_id, card_dict)
+            if self.columns is not None:
+                self.columns.add(multiverse_id, card_dict, entry['collection_data']['owned'])
+            if self.sorted is not None:
+                self.sorted.add(multiverse_id)
+            filled += 1
+
+    def __index(self, card_dict, count):
+        """ Adds an entry while the collection is being opened. """
+        multiverse_id = card_dict['multiverse_id']
+        self.entries[multiverse_id] = {'card_data':CardView.summarize(card_dict), 'collection_data':{'owned':count}}
+        self.search_index.add(multiverse_id, card_dict)
 
+    def __migrate(self, collection_data):
+        """ Converts the old layout, where every entry carried a full copy of the card, to ids and counts.
+        The card data goes into the card store. """
+        log.info('Moving the card data in %s to the card store', self.file_path)
+        self.card_store.put_many([entry['card_data'] for entry in collection_data['collection']])
+        self.migrated = True
+        return {'format':2,
+                'collection':{str(entry['card_data']['multiverse_id']):entry['collection_data']['owned'] for entry in collection_data['collection']},
+                'journal_seq':collection_data.get('journal_seq', 0)}
 
+    @staticmethod
+    def multiverse_id(key):
+        """ Turns a key from a collection file back into a multiverse_id. """
+        try:
+            return int(key)
+        except ValueError:
+            return key
@@ -0,0 +1,104 @@
+import csv, re
+
+
+class Decklist(object):
+    """ Reads lists of cards to import into a collection. Two kinds of file are understood:
+
+    Plain decklists, one card per line with an optional count in front of it. A card is either
+    its multiverse_id or its name, set codes after the name (MTG Arena style) are ignored:
+
+        4 Lightning Bolt
+        2x Counterspell (7ED) 67
+        12345
+
+    CSV files (anything ending in .csv) with a header row. The card comes from a multiverse_id
+    or name column and the count from a count, quantity or owned column. """
+    # Header names that are accepted for each CSV column, checked in order
+    id_columns = ('multiverse_id', 'multiverseid', 'multiverse id', 'id')
+    name_columns = ('name', 'card', 'card name')
+    count_columns = ('count', 'quantity', 'qty', 'owned', 'amount')
+    # Section headers some decklist formats use
+    section_headers = {'deck', 'sideboard', 'commander', 'companion', 'maybeboard'}
+
+    line_pattern = re.compile(r'^(?:(\d+)\s*x?\s+)?(.+?)$', re.IGNORECASE)
+    set_pattern = re.compile(r'\s+\([A-Za-z0-9]+\)(\s+\S+)?$')
+
+    @staticmethod
+    def read(file_path):
+        """ :return: A list of (card, count) tuples, card is a multiverse_id (an int) or a card name """
+        with open(file_path, 'r', newline='') as f:
+            if file_path.lower().endswith('.csv'):
+                return Decklist.parse_csv(f)
+            return Decklist.parse(f)
+
+    @staticmethod
+    def resolve(cards, card_store):
+        """ Turns the names in a list from read() into multiverse_ids, with one batched lookup
+        for all of them that the card store remembers for next time.
+        :param cards: A list of (card, count) tuples from read()
+        :param card_store: The CardStore to look names up in
+        :return: ([(multiverse_id, count), ...], [names that couldn't be found]) """
+        names = card_store.find_names([card for card, _ in cards if isinstance(card, str)], fetch_missing=True)
+        resolved = []
+        unknown = []
+        for card, count in cards:
+            if isinstance(card, str):
+                key = names.get(card.lower())
+                if key is None:
+                    unknown.append(card)
+                    continue
+                card = int(key) if key.isdigit() else key
+            resolved.append((card, count))
+        return resolved, unknown
+
+    @staticmethod
+    def parse(lines):
+        """ Parses a plain decklist.
+        :param lines: An iterable of lines, i.e. an open file
+        :return: A list of (card, count) tuples """
+        cards = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('//'):
+                continue
+            if line.endswith(':') or line.lower() in Decklist.section_headers:
+                continue
+
+            count, card = Decklist.line_pattern.match(line).groups()
+            card = Decklist.set_pattern.sub('', card)
+            cards.append((int(card) if card.isdigit() else card, int(count) if count else 1))
+        return cards
+
+    @staticmethod
+    def parse_csv(lines):
+        """ Parses a CSV file with a header row.
+        :param lines: An iterable of lines, i.e. an open file
+        :return: A list of (card, count) tuples """
+        reader = csv.DictReader(lines)
+        headers = {header.strip().lower():header for header in reader.fieldnames or []}
+
+        def column(names):
+            for name in names:
+                if name in headers:
+                    return headers[name]
+            return None
+
+        id_column = column(Decklist.id_columns)
+        name_column = column(Decklist.name_columns)
+        count_column = column(Decklist.count_columns)
+        if id_column is None and name_column is None:
+            raise ValueError(f'No multiverse_id or name column in {reader.fieldnames}')
+
+        cards = []
+        for row in reader:
+            multiverse_id = (row.get(id_column) or '').strip() if id_column else ''
+            name = (row.get(name_column) or '').strip() if name_column else ''
+            count = (row.get(count_column) or '').strip() if count_column else ''
+            if not multiverse_id and not name:
+                continue
+            try:
+                count = int(count) if count else 1
+            except ValueError:
+                raise ValueError(f"Line {reader.line_num}: {count!r} isn't a number of cards")
+            cards.append((int(multiverse_id) if multiverse_id.isdigit() else name or multiverse_id, count))
+        return cards
@@ -0,0 +1,188 @@
+import threading, queue, logging, perf
+from io import BytesIO
+from cache import save_sprite, load_sprite
+
+log = logging.getLogger(__name__)
+
+# The downloader every viewer shares, see get_downloader
+DOWNLOADER = None
+
+
+class DownloadTicket(object):
+    """ A group of images asked for together, normally everything missing from one search. """
+    def __init__(self, on_result, on_done=None):
+        # Called from a worker thread with (index, img_data, card) for each image that finishes
+        self.on_result = on_result
+        # Called from a worker thread once every image in the ticket has finished or failed
+        self.on_done = on_done
+        self.remaining = 0
+        self.cancelled = False
+        # index -> card for everything asked for, so the ticket's images can be reprioritized
+        self.cards = {}
+
+    def done(self):
+        return self.cancelled or self.remaining == 0
+
+
+class Downloader(object):
+    """ Downloads card images on a fixed number of worker threads that share one keep-alive HTTP session.
+
+    If an image is asked for while it's already being downloaded the caller is attached to the
+    download that's in progress instead of starting another one.
+
+    Images are downloaded lowest priority first, in the order they were asked for when the
+    priorities are the same. A priority can be anything that compares with background_priority. """
+    default_workers = 8
+    # What images get when they're asked for without a priority, tuples sort ahead of it with (0, ...)
+    background_priority = (1,)
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or Downloader.default_workers
+
+        # requests is slow to import, nothing needs it until the first download
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        # One pooled connection per worker so they don't have to queue up for a socket
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # (priority, sequence, multiverse_id, card). An image that's reprioritized is queued again
+        # and whichever job doesn't match its current priority is skipped
+        self.jobs = queue.PriorityQueue()
+        self.sequence = 0
+        self.lock = threading.Lock()
+        # multiverse_id -> list of (ticket, index, card) waiting on that image
+        self.in_flight = {}
+        # multiverse_id -> current priority for the images in flight
+        self.priorities = {}
+        # multiverse_ids a worker is downloading right now
+        self.running = set()
+        self.workers = []
+
+    def download(self, cards_to_download, on_result, on_done=None, priority=None):
+        """ Queues up images to download.
+        :param cards_to_download: A list of (index, Card) tuples
+        :param on_result: Function called with (index, img_data, card) as each image is saved.
+                          img_data is a dict of paths in the format returned by cache.load_sprite
+        :param on_done: Function called with no arguments once the whole ticket is finished
+        :param priority: Priority for all of the images, background_priority if it's None
+        :return: A DownloadTicket that can be passed to cancel and prioritize """
+        if priority is None:
+            priority = Downloader.background_priority
+        ticket = DownloadTicket(on_result, on_done)
+        ticket.remaining = len(cards_to_download)
+
+        with self.lock:
+            for index, card in cards_to_download:
+                ticket.cards[index] = card
+                waiters = self.in_flight.get(card.multiverse_id)
+                if waiters is None:
+                    self.in_flight[card.multiverse_id] = [(ticket, index, card)]
+                    self.__queue(card, priority)
+                else:
+                    waiters.append((ticket, index, card))
+                    if card.multiverse_id not in self.running and priority < self.priorities[card.multiverse_id]:
+                        self.__queue(card, priority)
+            self.__start_workers()
+
+        if ticket.remaining == 0 and on_done is not None:
+            on_done()
+        return ticket
+
+    def prioritize(self, ticket, priorities):
+        """ Moves some of a ticket's images up the queue, i.e. the ones that just scrolled into view.
+        Images only ever move forward, ones already downloading or done are left alone.
+        :param priorities: A dict of index -> priority, the indexes given to download """
+        with self.lock:
+            if ticket.cancelled:
+                return
+            for index, priority in priorities.items():
+                card = ticket.cards.get(index)
+                if card is None or card.multiverse_id not in self.in_flight or card.multiverse_id in self.running:
+                    continue
+                if priority < self.priorities[card.multiverse_id]:
+                    self.__queue(card, priority)
+
+    def __queue(self, card, priority):
+        """ Puts a job on the queue at priority. Call with the lock held. """
+        self.priorities[card.multiverse_id] = priority
+        self.sequence += 1
+        self.jobs.put((priority, self.sequence, card.multiverse_id, card))
+
+    def cancel(self, ticket):
+        """ Stops delivering results for a ticket. Images nobody else is waiting on are dropped from the queue. """
+        if ticket is None:
+            return
+        with self.lock:
+            ticket.cancelled = True
+            for multiverse_id in list(self.in_flight):
+                waiters = [waiter for waiter in self.in_flight[multiverse_id] if waiter[0] is not ticket]
+                if waiters or multiverse_id in self.running:
+                    # Something is still downloading it, keep it around so it can be reused
+                    self.in_flight[multiverse_id] = waiters
+                else:
+                    # The worker skips jobs that aren't in flight anymore
+                    del self.in_flight[multiverse_id]
+                    del self.priorities[multiverse_id]
+
+    def __start_workers(self):
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self.__work, daemon=True)
+            self.workers.append(worker)
+            worker.start()
+
+    def __work(self):
+        while True:
+            priority, _, multiverse_id, card = self.jobs.get()
+            with self.lock:
+                if multiverse_id not in self.in_flight or multiverse_id in self.running or self.priorities[multiverse_id] != priority:
+                    # Cancelled, picked up by another worker already, or queued again at a different priority
+                    continue
+                self.running.add(multiverse_id)
+
+            try:
+                with perf.timer('download.fetch'):
+                    img_data = self.fetch(card)
+            except Exception as error:
+                log.warning("Couldn't download %s: %s", card.name, error)
+                perf.count('download.failed')
+                img_data = None
+
+            with self.lock:
+                self.running.discard(multiverse_id)
+                waiters = self.in_flight.pop(multiverse_id, [])
+                self.priorities.pop(multiverse_id, None)
+
+            # Results go out before the tickets are counted down so a ticket never looks
+            # done while one of its results is still on the way
+            for ticket, index, waiting_card in waiters:
+                if img_data is not None and not ticket.cancelled:
+                    ticket.on_result((index, img_data, waiting_card))
+
+            for ticket, index, waiting_card in waiters:
+                with self.lock:
+                    ticket.remaining -= 1
+                    last = ticket.remaining == 0
+                if last and not ticket.cancelled and ticket.on_done is not None:
+                    ticket.on_done()
+
+    def fetch(self, card):
+        """ Downloads a card's image and saves it to the cache.
+        :return: The image paths in the format returned by cache.load_sprite """
+        log.debug('Downloading %s from server', card.name)
+        response = self.session.get(card.image_url, timeout=30)
+        response.raise_for_status()
+        from PIL import Image
+        img = Image.open(BytesIO(response.content))
+        save_sprite(img, card.multiverse_id)
+        return load_sprite(card.multiverse_id)
+
+
+def get_downloader():
+    """ Gets the downloader shared by every tab, made the first time something needs downloading. """
+    global DOWNLOADER
+    if DOWNLOADER is None:
+        DOWNLOADER = Downloader()
+    return DOWNLOADER
@@ -0,0 +1,308 @@
+import json, os, threading, time, zlib, logging, perf
+from cache import write_atomic, build_cache_path, file_lock, temp_path_for, STALE_TEMP_SECONDS
+
+log = logging.getLogger(__name__)
+
+
+class ImageStore(object):
+    """ Card images on disk, spread over 256 subdirectories so no one directory gets huge.
+
+    Which images we have, how big they are and when they were last used is kept in memory so
+    nothing has to be stat'd to answer `contains`. That information is persisted as a snapshot
+    (index.json) plus a log of changes since the snapshot (access.log). Once the images take up
+    more than `max_bytes` the least recently used ones are deleted.
+
+    Several processes can share a store. Writing to the log, compacting it and evicting happen
+    while holding index.lock, and first read whatever the other processes have logged so
+    everyone's changes are kept. Reads don't take the lock: images are renamed into place
+    whole, and the in memory index picks up other processes' images from the log now and then. """
+    # Variants of an image that can be stored. They're evicted together
+    variants = ('full', 'thumb')
+    # Accesses are buffered and written to the log in groups of this many
+    access_flush_every = 100
+    # Once the log has this many lines it's folded into a new index.json
+    compact_every = 20000
+    # Eviction frees space down to this fraction of max_bytes so it doesn't run on every save
+    evict_to = 0.9
+    # Most often a miss in contains() reads the log for images other processes have saved, in seconds
+    refresh_every = 2.0
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, 'index.json')
+        self.log_path = os.path.join(root, 'access.log')
+        self.lock_path = os.path.join(root, 'index.lock')
+
+        self.lock = threading.RLock()
+        # key -> {'sizes': {variant: bytes}, 'atime': last access}, None until first use
+        self.entries = None
+        self.total_bytes = 0
+        self.log_lines = 0
+        # (inode, offset) of the log read up to. Compacting replaces the log so the inode changes
+        self.log_position = (None, 0)
+        self.last_refresh = 0
+        # Access lines not written to the log yet
+        self.pending_accesses = []
+
+    @staticmethod
+    def key(multiverse_id):
+        return str(multiverse_id)
+
+    def path(self, multiverse_id, variant='full'):
+        """ :return: Where the variant of the image lives on disk, whether or not it exists """
+        key = ImageStore.key(multiverse_id)
+        shard = format(zlib.crc32(key.encode()) % 256, '02x')
+        suffix = '.png' if variant == 'full' else f'.{variant}.png'
+        return os.path.join(self.root, shard, key + suffix)
+
+    def contains(self, multiverse_id, variant='full'):
+        """ Checks the in memory index. On a miss the log is read for images other processes
+        have saved, at most every refresh_every seconds. """
+        self.__load()
+        key = ImageStore.key(multiverse_id)
+        entry = self.entries.get(key)
+        if (entry is None or variant not in entry['sizes']) and time.time() - self.last_refresh > ImageStore.refresh_every:
+            # Maybe another process has saved it since we last looked
+            with self.lock:
+                self.__catch_up(locked=False)
+            entry = self.entries.get(key)
+        return entry is not None and variant in entry['sizes']
+
+    def put(self, multiverse_id, image, variant='full'):
+        """ Saves a PIL image. It's written to a temporary file and renamed into place so a
+        crash or a failed download never leaves half an image behind, and a process saving
+        the same card at the same time just replaces it with an identical copy.
+        :param multiverse_id: Multiverse ID of the card
+        :param image: PIL Image() object
+        :param variant: One of ImageStore.variants """
+        self.__load()
+        key = ImageStore.key(multiverse_id)
+        path = self.path(multiverse_id, variant)
+        build_cache_path(os.path.dirname(path))
+
+        # Unique per process and thread so two workers saving the same card don't write the same temp file
+        temp_path = temp_path_for(path)
+        image.save(temp_path, format='PNG')
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+
+        now = time.time()
+        with self.lock, file_lock(self.lock_path):
+            self.__catch_up()
+            entry = self.entries.setdefault(key, {'sizes':{}, 'atime':now})
+            self.total_bytes += size - entry['sizes'].get(variant, 0)
+            entry['sizes'][variant] = size
+            entry['atime'] = now
+            self.__log([f'p {key} {variant} {size} {now}'])
+
+            if self.total_bytes > self.max_bytes:
+                self.__evict(int(self.max_bytes * ImageStore.evict_to))
+
+    def touch(self, multiverse_id):
+        """ Marks the image as just used so it's the last to be evicted. """
+        self.__load()
+        key = ImageStore.key(multiverse_id)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['atime'] = now
+            self.pending_accesses.append(f'a {key} {now}')
+            if len(self.pending_accesses) < ImageStore.access_flush_every:
+                return
+        self.flush()
+
+    def evict(self, target_bytes):
+        """ Deletes the least recently used images until the store is no bigger than target_bytes. """
+        self.__load()
+        with self.lock, file_lock(self.lock_path):
+            self.__catch_up()
+            self.__evict(target_bytes)
+
+    def __evict(self, target_bytes):
+        """ Call with both locks held and caught up, so images other processes just saved count too. """
+        removed = []
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['atime']):
+            if self.total_bytes <= target_bytes:
+                break
+            for variant in entry['sizes']:
+                try:
+                    os.remove(self.path(key, variant))
+                except FileNotFoundError:
+                    pass
+            self.total_bytes -= sum(entry['sizes'].values())
+            removed.append(key)
+
+        for key in removed:
+            del self.entries[key]
+        self.__log([f'r {key}' for key in removed])
+        perf.count('image_cache.evicted', len(removed))
+        log.debug('Evicted %d images from the cache', len(removed))
+
+    def flush(self):
+        """ Writes any buffered accesses to the log. """
+        if self.entries is None:
+            return
+        with self.lock:
+            if not self.pending_accesses:
+                return
+            with file_lock(self.lock_path):
+                self.__catch_up()
+                self.__log([])
+
+    def __log(self, lines):
+        """ Appends lines (and any buffered accesses) to the log, folding it into index.json when it gets long.
+        Call with both locks held and caught up, so the log is only ever written from where we've read to. """
+        lines = self.pending_accesses + lines
+        self.pending_accesses = []
+        if not lines:
+            return
+        with open(self.log_path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            self.log_position = (os.fstat(f.fileno()).st_ino, f.tell())
+        self.log_lines += len(lines)
+        if self.log_lines >= ImageStore.compact_every:
+            self.__compact()
+
+    def __compact(self):
+        """ Call with both locks held and caught up, otherwise lines other processes logged would be lost. """
+        write_atomic(self.index_path, json.dumps(self.entries))
+        write_atomic(self.log_path, '')
+        self.log_position = (os.stat(self.log_path).st_ino, 0)
+        self.log_lines = 0
+
+    def __load(self):
+        """ Builds the in memory index the first time it's needed. """
+        if self.entries is not None:
+            return
+        with self.lock:
+            if self.entries is not None:
+                return
+            build_cache_path(self.root)
+            with file_lock(self.lock_path):
+                entries = self.__read()
+                self.entries = entries
+                self.total_bytes = sum(sum(entry['sizes'].values()) for entry in entries.values())
+                if self.log_lines == 0 and not os.path.isfile(self.index_path):
+                    self.__compact()
+
+    def __read(self):
+        """ Reads index.json and replays the log on top of it. Call with the file lock held so
+        nobody compacts in between.
+        :return: The entries """
+        try:
+            with open(self.index_path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            # First run (or the index got lost), look at what's actually on disk
+            entries = self.__scan()
+        self.log_position = (None, 0)
+        self.log_lines = 0
+        self.__replay(entries)
+        self.last_refresh = time.time()
+        return entries
+
+    def __catch_up(self, locked=True):
+        """ Applies what other processes have logged since we last read the log. Call with self.lock held.
+        :param locked: Whether the file lock is held. Without it, a log that's been compacted is
+                       left for the next time the lock is taken, since reading index.json while
+                       somebody else compacts could miss lines """
+        self.last_refresh = time.time()
+        try:
+            inode = os.stat(self.log_path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if inode == self.log_position[0]:
+            self.total_bytes += self.__replay(self.entries)
+        elif locked:
+            # Compacted by another process, everything we knew is in index.json now
+            self.entries = self.__read()
+            self.total_bytes = sum(sum(entry['sizes'].values()) for entry in self.entries.values())
+
+    def __replay(self, entries):
+        """ Applies the log lines after self.log_position to entries. Only whole lines are read,
+        one still being written is picked up next time.
+        :return: How much the lines changed the total size by """
+        inode, offset = self.log_position
+        delta = 0
+        try:
+            with open(self.log_path, 'rb') as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self.log_position[0]:
+                    if self.log_position[0] is not None:
+                        # Compacted since we checked, __catch_up with the file lock sorts it out
+                        return 0
+                    offset = 0
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    self.log_lines += 1
+                    delta += ImageStore.__apply(entries, line.decode(errors='replace').split())
+        except FileNotFoundError:
+            pass
+        self.log_position = (inode, offset)
+        return delta
+
+    @staticmethod
+    def __apply(entries, parts):
+        """ Applies one log line.
+        :return: How much it changed the total size by """
+        try:
+            if parts[0] == 'p':
+                entry = entries.setdefault(parts[1], {'sizes':{}, 'atime':0})
+                size = int(parts[3])
+                delta = size - entry['sizes'].get(parts[2], 0)
+                entry['sizes'][parts[2]] = size
+                entry['atime'] = float(parts[4])
+                return delta
+            elif parts[0] == 'a' and parts[1] in entries:
+                entries[parts[1]]['atime'] = float(parts[2])
+            elif parts[0] == 'r' and parts[1] in entries:
+                return -sum(entries.pop(parts[1])['sizes'].values())
+        except (IndexError, ValueError):
+            # Torn line from a crash
+            pass
+        return 0
+
+    def __scan(self):
+        """ Finds every image on disk. Images from before the store was sharded are moved into their shard. """
+        entries = {}
+        now = time.time()
+
+        def add(key, variant, path):
+            entry = entries.setdefault(key, {'sizes':{}, 'atime':now})
+            entry['sizes'][variant] = os.path.getsize(path)
+
+        # The old flat layouts, full size images straight in the root and thumbnails in their own directory
+        old_thumbnails = os.path.join(os.path.dirname(self.root), 'thumbnails')
+        for directory, variant in ((self.root, 'full'), (old_thumbnails, 'thumb')):
+            if not os.path.isdir(directory):
+                continue
+            for dir_entry in os.scandir(directory):
+                if dir_entry.is_file() and dir_entry.name.endswith('.png'):
+                    new_path = self.path(dir_entry.name[:-len('.png')], variant)
+                    build_cache_path(os.path.dirname(new_path))
+                    # Picked up by the shard scan below
+                    os.replace(dir_entry.path, new_path)
+        if os.path.isdir(old_thumbnails) and not os.listdir(old_thumbnails):
+            os.rmdir(old_thumbnails)
+
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for dir_entry in os.scandir(shard.path):
+                name = dir_entry.name
+                if name.endswith('.tmp'):
+                    # Left over from a crash while saving, unless another process is saving it right now
+                    if now - dir_entry.stat().st_mtime > STALE_TEMP_SECONDS:
+                        os.remove(dir_entry.path)
+                elif name.endswith('.thumb.png'):
+                    add(name[:-len('.thumb.png')], 'thumb', dir_entry.path)
+                elif name.endswith('.png'):
+                    add(name[:-len('.png')], 'full', dir_entry.path)
+        return entries
@@ -0,0 +1,119 @@
+import json, os, threading
+from cache import write_atomic
+
+
+class Journal(object):
+    """ Append only log of changes to a collection, kept next to the collection file as `<file>.journal`.
+
+    Every record gets a sequence number. Snapshots remember the last sequence number they
+    contain so replaying the log on top of a snapshot never applies a change twice, even if
+    we crashed halfway through a compaction. """
+    # Once the log gets bigger than this many bytes it gets folded into a new snapshot
+    compact_threshold = 1024 * 1024
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+        self.path = snapshot_path + '.journal'
+        # Sequence number of the last record written (or replayed)
+        self.seq = 0
+        # Held while appending or rewriting the log so a compaction can't drop new records
+        self.lock = threading.Lock()
+        self.compaction = None
+
+    def replay(self, since_seq=0):
+        """ Reads the records that aren't part of the snapshot yet.
+        :param since_seq: The journal_seq stored in the snapshot
+        :return: A list of records in the order they were written """
+        records = []
+        self.seq = since_seq
+        if not os.path.isfile(self.path):
+            return records
+
+        with self.lock, open(self.path, 'rb+') as f:
+            # Where the last whole line ends
+            good = 0
+            for line in f:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('no newline')
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write from a crash can only be the last line, nothing after it was saved.
+                    # Cut it off, otherwise the next append would be glued onto it and lost too
+                    f.truncate(good)
+                    break
+                good += len(line)
+                if record['seq'] > since_seq:
+                    records.append(record)
+                    self.seq = record['seq']
+        return records
+
+    def append(self, records):
+        """ Writes records to the end of the log and flushes them to disk.
+        :param records: A list of dicts, each gets a `seq` key added """
+        if not records:
+            return
+        with self.lock:
+            lines = []
+            for record in records:
+                self.seq += 1
+                record['seq'] = self.seq
+                lines.append(json.dumps(record) + '\n')
+            with open(self.path, 'a') as f:
+                f.write(''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def truncate(self):
+        """ Throws the log away. Only call it once a snapshot with `journal_seq` set to self.seq
+        is safely on disk: the sequence numbers carry on from where they were, so if we crash
+        before the log is gone its records are all skipped on replay rather than applied twice. """
+        with self.lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+
+    def wait(self):
+        """ Waits for a compaction that's running to finish. Call before writing a snapshot
+        yourself, otherwise the compaction could replace it with an older one. """
+        if self.compaction is not None:
+            self.compaction.join()
+
+    def is_compacting(self):
+        return self.compaction is not None and self.compaction.is_alive()
+
+    def compact(self, snapshot):
+        """ Writes snapshot to disk in the background and drops the records it contains from the log.
+        :param snapshot: The collection data to save. It must not be changed after this call,
+                         and its `journal_seq` must be the seq of the last record it includes. """
+        if self.is_compacting():
+            return
+        # Not a daemon so closing the app doesn't cut a compaction off halfway
+        self.compaction = threading.Thread(target=self.__compact, args=(snapshot,))
+        self.compaction.start()
+
+    def __compact(self, snapshot):
+        write_atomic(self.snapshot_path, json.dumps(snapshot))
+
+        # Keep anything that was appended while the snapshot was being written
+        with self.lock:
+            kept = []
+            try:
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break
+                        if record['seq'] > snapshot['journal_seq']:
+                            kept.append(line)
+            except FileNotFoundError:
+                # Nothing's been appended since
+                return
+            write_atomic(self.path, ''.join(kept))
+
@@ -5,18 +5,20 @@
 # Event queue is processed in this file.
 
 
-import mtgsdk, sys, requests, os, multiprocessing, ntpath
+import sys, os, ntpath, logging, perf
 
 from collectiondata import CollectionData
+from sqlitecollection import SQLiteCollectionData
 from requester import Requester
 from tkinter import *
 from tkinter import ttk
 from tkinter.filedialog import askopenfilename, asksaveasfilename
+from tkinter.messagebox import showerror
 from ui.cardviewer import CardViewer
+from sortengine import SortKeys
 
 class Application(object):
     def __init__(self):
-        self.requester = Requester()
         self.window = Tk()
         self.window.title("MTG Collection Tracker")
         self.tab_control = ttk.Notebook(self.window)
@@ -29,12 +31,30 @@ class Application(object):
         filemenu.add_command(label="Save as", command=self.save_collection_as)
         filemenu.add_command(label="Open", command=self.open_collection)
         filemenu.add_command(label="New", command=self.new_collection)
+        filemenu.add_command(label="Import cards", command=self.import_cards)
+        filemenu.add_command(label="Statistics", command=self.show_statistics)
+
+        # Offline mode answers web searches from the cache only
+        self.offline = BooleanVar(value=False)
+        optionsmenu = Menu(menubar)
+        menubar.add_cascade(label="Options", menu=optionsmenu)
+        optionsmenu.add_checkbutton(label="Offline mode", variable=self.offline, command=self.toggle_offline)
+
+        # Timings for the slow parts of a search, see perf.py
+        self.recording = BooleanVar(value=perf.ENABLED)
+        perfmenu = Menu(menubar)
+        menubar.add_cascade(label="Performance", menu=perfmenu)
+        perfmenu.add_checkbutton(label="Record timings", variable=self.recording, command=lambda: perf.enable(self.recording.get()))
+        perfmenu.add_command(label="Show statistics", command=self.show_performance)
+        perfmenu.add_command(label="Save statistics as", command=self.save_performance)
+        perfmenu.add_command(label="Reset statistics", command=perf.reset)
+        self.performance_window = None
         # display the menu
         self.window.config(menu=menubar)
         
 
-        searchable = Requester()
-        self.web_searcher = CardViewer(self.window, searchable, height=700, background='bisque')
+        self.searchable = Requester()
+        self.web_searcher = CardViewer(self.window, self.searchable, height=700, background='bisque')
         self.web_searcher.pack(side=LEFT, fill=BOTH, expand=True)
 
         self.web_searcher.rowconfigure(0, weight=1)
@@ -46,6 +66,7 @@ class Application(object):
         # Search button
         search_button = Button(self.web_searcher, text='Search', command=lambda:self.web_searcher.load_cards(self.txt_entry.get()))
         search_button.grid(column=1,row=1, sticky=S)
+        self.add_sort_menu(self.web_searcher)
         
         
         self.tab_control.pack(side=RIGHT, fill=BOTH, expand=True)
@@ -60,9 +81,9 @@ class Application(object):
         active_tab = self.tab_control.nametowidget(active_tab_name)
 
         # If the collection has a file_path we save to that file path
-        # otherwise we use the "save as" saving
-        if active_tab.collection.file_path:
-            active_tab.collection.save()
+        # otherwise we use the "save as" saving. CardViewer keeps the collection as its searchable
+        if active_tab.searchable.file_path:
+            active_tab.searchable.save()
         else:
             self.save_collection_as()
             
@@ -70,24 +91,93 @@ class Application(object):
 
     def save_collection_as(self):
         file_path = asksaveasfilename(title='Save as', defaultextension='.json')
+        if not file_path:
+            # Cancelled
+            return
         active_tab_name = self.tab_control.select()
         active_tab = self.tab_control.nametowidget(active_tab_name)
-        active_tab.collection.save_as(file_path)
+        active_tab.searchable.save_as(file_path)
 
         file_name = ntpath.basename(file_path)
         file_name_no_extension = os.path.splitext(file_name)[0]
 
         self.tab_control.tab(active_tab, text=file_name_no_extension)
 
+    def show_performance(self):
+        # Only one window, asking again brings it up to date
+        if self.performance_window is None or not self.performance_window.winfo_exists():
+            self.performance_window = Toplevel(self.window)
+            self.performance_window.title("Performance")
+            self.performance_text = Text(self.performance_window, width=100, height=30, font='TkFixedFont')
+            self.performance_text.pack(fill=BOTH, expand=True)
+            Button(self.performance_window, text='Refresh', command=self.show_performance).pack(side=RIGHT)
+        self.performance_text.configure(state=NORMAL)
+        self.performance_text.delete('1.0', END)
+        if not perf.ENABLED:
+            self.performance_text.insert(END, 'Recording is off, turn on Performance > Record timings\n\n')
+        self.performance_text.insert(END, perf.report())
+        self.performance_text.configure(state=DISABLED)
+
+    def save_performance(self):
+        file_path = asksaveasfilename(title='Save statistics as', defaultextension='.json')
+        if file_path:
+            perf.dump(file_path)
+
+    def import_cards(self):
+        """ Adds a decklist or CSV file to the open collection. """
+        active_tab_name = self.tab_control.select()
+        if not active_tab_name:
+            return
+        active_tab = self.tab_control.nametowidget(active_tab_name)
+        file_path = askopenfilename(initialdir = "~/",title = "Select file",filetypes = (("decklists","*.txt *.dec"),("csv files","*.csv"),("all files","*.*")))
+        if file_path:
+            # CardViewer keeps the collection as its searchable
+            try:
+                active_tab.searchable.import_file(file_path)
+            except ValueError as e:
+                # i.e. a CSV file without a name or multiverse_id column, or a count that isn't a number
+                showerror("Import failed", f"Couldn't import {ntpath.basename(file_path)}:\n{e}")
+
+    def show_statistics(self):
+        """ Shows what's in the open collection, or in the results of the search typed into it. """
+        active_tab_name = self.tab_control.select()
+        if not active_tab_name:
+            return
+        active_tab = self.tab_control.nametowidget(active_tab_name)
+        statistics = active_tab.searchable.statistics(active_tab.search_text)
+
+        lines = [f"{statistics['unique']} different cards, {statistics['total']} copies"]
+        if statistics['average_cmc'] is not None:
+            lines.append(f"Average cmc {statistics['average_cmc']:.2f}")
+        for title, totals in (('Rarity', statistics['by_rarity']), ('Set', statistics['by_set']), ('Mana curve', statistics['curve'])):
+            lines.append('')
+            lines.append(title)
+            for value, copies in totals.items():
+                lines.append(f'  {value if value is not None else "(none)"!s:24} {copies}')
+
+        window = Toplevel(self.window)
+        window.title("Statistics")
+        text = Text(window, width=60, height=30, font='TkFixedFont')
+        text.insert(END, '\n'.join(lines))
+        text.configure(state=DISABLED)
+        text.pack(fill=BOTH, expand=True)
+
+    def toggle_offline(self):
+        self.searchable.offline = self.offline.get()
+
     def new_collection(self):
-        self.new_card_viewer_tab(CollectionData())
+        self.new_card_viewer_tab(CollectionData(journaled=True))
     
     def open_collection(self):
-        file_path = askopenfilename(initialdir = "~/",title = "Select file",filetypes = (("json files","*.json"),("all files","*.*")))
+        file_path = askopenfilename(initialdir = "~/",title = "Select file",filetypes = (("json files","*.json"),("sqlite collections","*.db"),("all files","*.*")))
         file_name = ntpath.basename(file_path)
-        file_name_no_extension = os.path.splitext(file_name)[0]
+        file_name_no_extension, extension = os.path.splitext(file_name)
 
-        collection = CollectionData(file_path=file_path)
+        # Big collections are better off in SQLite, they open without being read into memory
+        if extension == '.db':
+            collection = SQLiteCollectionData(file_path=file_path)
+        else:
+            collection = CollectionData(file_path=file_path, journaled=True)
 
         self.new_card_viewer_tab(collection, file_name_no_extension)
     
@@ -106,8 +196,18 @@ class Application(object):
         # Search button
         search_button = Button(new_tab, text='Search', command=lambda:new_tab.load_cards(txt_entry.get()))
         search_button.grid(column=1,row=1)
+        self.add_sort_menu(new_tab)
+
+    def add_sort_menu(self, card_viewer):
+        """ Adds a drop down that picks the order the viewer shows cards in. """
+        # Kept on the viewer so it isn't garbage collected
+        card_viewer.sort_variable = StringVar(value=card_viewer.sort_order)
+        sort_menu = OptionMenu(card_viewer, card_viewer.sort_variable, *SortKeys.orders, command=card_viewer.set_sort_order)
+        sort_menu.grid(column=2, row=1, sticky=S)
 
 if __name__ == "__main__":
+    # Imports, migrations and failures are logged, per card chatter is at DEBUG
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
     Application()
 
 
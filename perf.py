@@ -0,0 +1,139 @@
+# Counters and latency histograms for the slow parts of a search, so we can tell where the
+# time went without attaching a profiler. Off by default, set MTG_PERF=1 (or turn it on from
+# the Performance menu) to start recording. Set MTG_PERF_DUMP to a path to have the numbers
+# written there as JSON when the program exits.
+#
+#   with perf.timer('api.search_page'):
+#       ...
+#   perf.count('api_cache.hit')
+import os, json, time, threading, atexit
+
+ENABLED = os.environ.get('MTG_PERF', '') not in ('', '0')
+
+# name -> count
+COUNTERS = {}
+# name -> Histogram
+HISTOGRAMS = {}
+# Worker threads record too
+LOCK = threading.Lock()
+
+
+class Histogram(object):
+    """ Latencies bucketed by powers of two microseconds, so it stays small however much is recorded. """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # upper bound in microseconds -> count
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        bound = 1 << max(0, int(seconds * 1e6)).bit_length()
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def percentile(self, fraction):
+        """ :return: The upper bound (in seconds) of the bucket the percentile falls in, None if empty """
+        seen = 0
+        for bound in sorted(self.buckets):
+            seen += self.buckets[bound]
+            if seen >= fraction * self.count:
+                # The bucket's bound can be past anything actually recorded
+                return min(bound / 1e6, self.max)
+        return None
+
+    def as_dict(self):
+        return {'count':self.count, 'total':self.total, 'mean':self.total / self.count if self.count else None,
+                'min':self.min, 'max':self.max, 'p50':self.percentile(0.5), 'p95':self.percentile(0.95),
+                'buckets_us':{str(bound):count for bound, count in sorted(self.buckets.items())}}
+
+
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Something that failed part way isn't a useful latency, count failures separately
+        if exc_type is None:
+            record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer(object):
+    """ What timer() hands out while recording is off, so a disabled timer costs next to nothing. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def timer(name):
+    """ Times the body of a with block into the histogram called name. Blocks that raise aren't recorded. """
+    if not ENABLED:
+        return NULL_TIMER
+    return Timer(name)
+
+def record(name, seconds):
+    """ Adds a latency to the histogram called name. """
+    if not ENABLED:
+        return
+    with LOCK:
+        histogram = HISTOGRAMS.get(name)
+        if histogram is None:
+            histogram = HISTOGRAMS[name] = Histogram()
+        histogram.add(seconds)
+
+def count(name, amount=1):
+    """ Adds amount to the counter called name. """
+    if not ENABLED:
+        return
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+def reset():
+    with LOCK:
+        COUNTERS.clear()
+        HISTOGRAMS.clear()
+
+def snapshot():
+    """ :return: Everything recorded so far as a dict of plain values """
+    with LOCK:
+        return {'enabled':ENABLED, 'counters':dict(sorted(COUNTERS.items())),
+                'histograms':{name:histogram.as_dict() for name, histogram in sorted(HISTOGRAMS.items())}}
+
+def report():
+    """ :return: The numbers as a table for people to read """
+    stats = snapshot()
+    lines = [f'{"timer":32} {"count":>7} {"mean ms":>9} {"p50 ms":>9} {"p95 ms":>9} {"max ms":>9} {"total s":>9}']
+    for name, histogram in stats['histograms'].items():
+        lines.append(f'{name:32} {histogram["count"]:7} {histogram["mean"] * 1000:9.2f} {histogram["p50"] * 1000:9.2f} '
+                     f'{histogram["p95"] * 1000:9.2f} {histogram["max"] * 1000:9.2f} {histogram["total"]:9.2f}')
+    lines.append('')
+    lines.append(f'{"counter":32} {"count":>7}')
+    for name, value in stats['counters'].items():
+        lines.append(f'{name:32} {value:7}')
+    return '\n'.join(lines)
+
+def dump(path):
+    """ Writes snapshot() to path as JSON. """
+    # Imported here so this module can be used before the cache directories exist
+    from cache import write_atomic
+    write_atomic(path, json.dumps(snapshot(), indent=2))
+
+if os.environ.get('MTG_PERF_DUMP'):
+    atexit.register(lambda: dump(os.environ['MTG_PERF_DUMP']))
@@ -0,0 +1,439 @@
+import re, functools
+from searchindex import SearchIndex
+
+
+class QueryError(ValueError):
+    """ The search text couldn't be understood. """
+
+
+class Term(object):
+    """ One test against one card field.
+
+    `op` is one of contains, exact or prefix, or <, <=, > or >= for cmc. `value` is already in the
+    form SearchIndex.normalize gives card values, with cmc comparisons also kept as a float. """
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+        self.number = float(value) if field == 'cmc' else None
+
+    def __repr__(self):
+        return f'Term({self.field!r}, {self.op!r}, {self.value!r})'
+
+
+class And(object):
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return f'And({self.children!r})'
+
+
+class Or(object):
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return f'Or({self.children!r})'
+
+
+class Not(object):
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return f'Not({self.child!r})'
+
+
+class QueryParser(object):
+    """ Turns search text into a tree of Term, And, Or and Not.
+
+    The old `name: lightning bolt, cmc:1` form still works, a comma is an AND. On top of that:
+
+        field:value      name and text contain value, rarity and cmc equal it
+        field:value*     the field starts with value
+        field=value      the field is exactly value
+        field!=value     the field isn't value
+        cmc<3 cmc>=2     numeric comparisons, cmc only
+        a or b, a and b, not a, -a, (a or b), "quoted values"
+
+    Terms next to each other are ANDed. Text without a field searches names.
+
+    Values run up to the next comma, bracket or field, so `text:target creature or player` and
+    `name:Fire and Ice` are one value each. AND, OR and NOT in capitals always split the value.
+    Otherwise and/or/not are only operators between terms: after a comma, bracket or quoted
+    value, or right before a field, bracket or quote, i.e. `name:bolt or name:shock`. """
+    comparisons = ('<', '<=', '>', '>=')
+    keywords = ('and', 'or', 'not')
+
+    token_pattern = re.compile(r'''
+        (?P<space>\s+)
+      | (?P<field>(?:name|cmc|rarity|text)\s*(?:<=|>=|!=|<|>|=|:))
+      | (?P<negate>-(?=\(|"|(?:name|cmc|rarity|text)\s*[<>=!:]))
+      | (?P<punctuation>[(),])
+      | "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | (?P<word>[^\s(),"]+)
+    ''', re.IGNORECASE | re.VERBOSE)
+
+    @staticmethod
+    def tokenize(text):
+        """ :return: A list of (kind, value) tuples """
+        tokens = []
+        position = 0
+        while position < len(text):
+            match = QueryParser.token_pattern.match(text, position)
+            if match is None:
+                raise QueryError(f'Unbalanced quote at {text[position:]!r}')
+            position = match.end()
+            kind = match.lastgroup
+            if kind == 'space':
+                continue
+            value = match.group(kind)
+            if kind == 'field':
+                field, op = re.match(r'(\w+)\s*(.*)', value).groups()
+                tokens.append(('field', (field.lower(), op)))
+            elif kind == 'quoted':
+                tokens.append(('quoted', re.sub(r'\\(.)', r'\1', value)))
+            elif kind == 'word' and value.isupper() and value.lower() in QueryParser.keywords:
+                tokens.append(('keyword', value.lower()))
+            else:
+                tokens.append((kind, value))
+        return tokens
+
+    @staticmethod
+    def parse(text):
+        """ :return: The root of the tree, None for a query with nothing in it (which matches every card) """
+        parser = QueryParser(QueryParser.tokenize(text))
+        if not parser.tokens:
+            return None
+        tree = parser.parse_or()
+        if parser.peek() is not None:
+            raise QueryError(f'Unexpected {parser.peek()[1]!r}')
+        return tree
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def operator(self, position=None):
+        """ :return: and, or or not if the token at position (the next one by default) can be
+            that operator, None if it can't. Only capitals make a keyword token, the lower case
+            ones are words and it's up to where they are whether they count. """
+        position = self.position if position is None else position
+        if position >= len(self.tokens):
+            return None
+        kind, value = self.tokens[position]
+        if kind == 'keyword':
+            return value
+        if kind == 'word' and value.lower() in QueryParser.keywords:
+            return value.lower()
+        return None
+
+    def starts_term(self, position):
+        """ :return: Whether the token at position can only be the start of a new term """
+        if position >= len(self.tokens):
+            return False
+        kind, value = self.tokens[position]
+        if kind in ('field', 'negate', 'quoted', 'keyword') or (kind, value) == ('punctuation', '('):
+            return True
+        # i.e. `name:bolt or not rarity:common`
+        return self.operator(position) == 'not' and self.starts_term(position + 1)
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.operator() == 'or':
+            self.next()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while True:
+            token = self.peek()
+            if token is None or token == ('punctuation', ')') or self.operator() == 'or':
+                break
+            if token == ('punctuation', ',') or self.operator() == 'and':
+                self.next()
+                if token == ('punctuation', ',') and self.operator() in ('and', 'or'):
+                    # `a, or b` and `a, and b`, the word after the comma is the operator
+                    if self.operator() == 'or':
+                        break
+                    self.next()
+                if self.peek() is None:
+                    # A trailing comma, the old parser let those through
+                    break
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self):
+        token = self.peek()
+        if self.operator() == 'not' or (token is not None and token[0] == 'negate'):
+            self.next()
+            return Not(self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        token = self.next()
+        if token is None:
+            raise QueryError('The search ends too early')
+        kind, value = token
+        if token == ('punctuation', '('):
+            tree = self.parse_or()
+            if self.next() != ('punctuation', ')'):
+                raise QueryError('Missing )')
+            return tree
+        if kind == 'field':
+            field, op = value
+            return self.term(field, op, self.value())
+        if kind in ('word', 'quoted'):
+            # No field, look for it in the name
+            self.position -= 1
+            return self.term('name', ':', self.value())
+        raise QueryError(f'Unexpected {value!r}')
+
+    def value(self):
+        """ Reads a quoted value, or the words up to the next comma, bracket, field or operator. """
+        token = self.peek()
+        if token is not None and token[0] == 'quoted':
+            self.next()
+            return token[1], True
+        words = []
+        while self.peek() is not None and self.peek()[0] == 'word':
+            if words and self.operator() is not None and self.starts_term(self.position + 1):
+                # and/or/not between this value and the next term
+                break
+            words.append(self.next()[1])
+        return ' '.join(words), False
+
+    def term(self, field, op, value):
+        value, quoted = value
+        if not value:
+            raise QueryError(f'Nothing to search {field} for')
+        if field == 'rarity' and value.lower() == 'mythic':
+            # For some reason the API calls mythic cards "special" for rarity
+            value = 'special'
+
+        if op in QueryParser.comparisons:
+            if field != 'cmc':
+                raise QueryError(f'Only cmc can be compared with {op}')
+        elif op == '!=':
+            return Not(self.term(field, '=', (value, quoted)))
+        elif op == ':' and value.endswith('*') and not quoted:
+            op, value = 'prefix', value[:-1]
+        elif op == ':' and field in SearchIndex.word_fields:
+            op = 'contains'
+        else:
+            # rarity:rare and cmc:3 have always meant equals
+            op = 'exact'
+
+        normalized = SearchIndex.normalize(field, value)
+        if normalized is None:
+            raise QueryError(f'{value!r} is not a number')
+        return Term(field, op, normalized)
+
+
+class QueryPlan(object):
+    """ A parsed query ready to run. Get one with QueryPlan.compile, which caches them by text.
+
+    The same plan can check single cards (`matches`), find the matching keys in a SearchIndex
+    (`keys`), pick out rows of a CardColumns (`mask`) or be turned into filters for the API
+    (`api_filters`). """
+    # Most plans kept by compile
+    cache_size = 256
+    # More ORed alternatives than this aren't worth searching online one by one
+    max_api_filters = 16
+    # cmc comparisons with an upper bound are sent to the API as every whole number up to it
+    max_api_cmc = 20
+
+    def __init__(self, text, tree):
+        self.text = text
+        self.tree = tree
+        self.matches = QueryPlan.__predicate(tree) if tree is not None else (lambda card_dict: True)
+        self.filters = None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=cache_size)
+    def compile(text):
+        """ Parses text into a plan. Plans are cached so the same search isn't parsed twice.
+        :raises QueryError: If the text can't be parsed """
+        return QueryPlan(text, QueryParser.parse(text))
+
+    @staticmethod
+    def __predicate(node):
+        """ Builds a function that takes a card dict and says whether it matches node. """
+        if isinstance(node, And):
+            predicates = [QueryPlan.__predicate(child) for child in node.children]
+            return lambda card_dict: all(predicate(card_dict) for predicate in predicates)
+        if isinstance(node, Or):
+            predicates = [QueryPlan.__predicate(child) for child in node.children]
+            return lambda card_dict: any(predicate(card_dict) for predicate in predicates)
+        if isinstance(node, Not):
+            predicate = QueryPlan.__predicate(node.child)
+            return lambda card_dict: not predicate(card_dict)
+
+        field, op, value, number = node.field, node.op, node.value, node.number
+        if op == 'contains':
+            test = lambda card_value: value in card_value
+        elif op == 'exact':
+            test = lambda card_value: card_value == value
+        elif op == 'prefix':
+            test = lambda card_value: card_value.startswith(value)
+        else:
+            test = SearchIndex.comparison(op, number)
+
+        def predicate(card_dict):
+            card_value = SearchIndex.normalize(field, card_dict.get(field))
+            return card_value is not None and test(card_value)
+        return predicate
+
+    def keys(self, index):
+        """ Runs the plan against a SearchIndex.
+        :return: The set of keys of the matching cards """
+        if self.tree is None:
+            return set(index.keys)
+        return QueryPlan.__keys(self.tree, index)
+
+    @staticmethod
+    def __keys(node, index):
+        if isinstance(node, Term):
+            return index.lookup(node.field, node.op, node.value)
+        if isinstance(node, Or):
+            keys = set()
+            for child in node.children:
+                keys |= QueryPlan.__keys(child, index)
+            return keys
+        if isinstance(node, Not):
+            return index.keys - QueryPlan.__keys(node.child, index)
+
+        # Narrow down with the positive parts first, then take away the negated ones
+        positive = [child for child in node.children if not isinstance(child, Not)]
+        negative = [child.child for child in node.children if isinstance(child, Not)]
+        keys = None
+        for child in positive:
+            found = QueryPlan.__keys(child, index)
+            keys = found if keys is None else keys & found
+            if not keys:
+                return set()
+        if keys is None:
+            keys = set(index.keys)
+        for child in negative:
+            keys -= QueryPlan.__keys(child, index)
+        return keys
+
+    def mask(self, columns, index):
+        """ Runs the plan against a CardColumns, cmc and rarity are compared a whole column at a time.
+        :param index: The SearchIndex over the same cards, it answers the name and text terms
+        :return: A boolean array with one entry per row of columns """
+        if self.tree is None:
+            return columns.numpy.ones(columns.size, dtype=bool)
+        return QueryPlan.__mask(self.tree, columns, index)
+
+    @staticmethod
+    def __mask(node, columns, index):
+        if isinstance(node, Not):
+            return ~QueryPlan.__mask(node.child, columns, index)
+        if isinstance(node, (And, Or)):
+            mask = QueryPlan.__mask(node.children[0], columns, index)
+            for child in node.children[1:]:
+                if isinstance(node, And):
+                    mask &= QueryPlan.__mask(child, columns, index)
+                else:
+                    mask |= QueryPlan.__mask(child, columns, index)
+            return mask
+        if node.field in SearchIndex.bucket_fields and node.op != 'prefix':
+            return columns.mask(node.field, '=' if node.op == 'exact' else node.op, node.value)
+        return columns.rows_for(index.lookup(node.field, node.op, node.value))
+
+    def api_filters(self):
+        """ Turns the plan into keyword arguments for mtgsdk.Card.where. Each dict is one search,
+        the results of all of them together (filtered with `matches`) are the results of the query.
+        Anything the API can't do (negation, prefixes, exact names, lower bounds) is left out of
+        the filters and only checked by `matches`.
+
+        :return: A list of dicts. [{}] for an empty query, which gets every card
+        :raises QueryError: If part of the query has nothing the API can search by """
+        if self.filters is not None:
+            return self.filters
+        if self.tree is None:
+            self.filters = [{}]
+            return self.filters
+
+        conjunctions = QueryPlan.__disjunctive(self.tree)
+        filters = []
+        for conjunction in conjunctions:
+            kwargs = {}
+            for literal in conjunction:
+                if isinstance(literal, Term) and literal.field not in kwargs:
+                    value = QueryPlan.__api_value(literal)
+                    if value is not None:
+                        kwargs[literal.field] = value
+            if not kwargs:
+                raise QueryError(f'Part of "{self.text}" would need every card downloaded, add something to search by')
+            if kwargs not in filters:
+                filters.append(kwargs)
+
+        # Searches on just one field can share a request, | means "any of these" to the API
+        merged = []
+        by_field = {}
+        for kwargs in filters:
+            if len(kwargs) == 1:
+                (field, value), = kwargs.items()
+                if field in by_field:
+                    by_field[field][field] += '|' + value
+                    continue
+                by_field[field] = kwargs = dict(kwargs)
+            merged.append(kwargs)
+
+        if len(merged) > QueryPlan.max_api_filters:
+            raise QueryError(f'"{self.text}" has too many alternatives to search online')
+        self.filters = merged
+        return self.filters
+
+    @staticmethod
+    def __api_value(term):
+        """ :return: What to send the API for term, None if it can't narrow the search """
+        if term.field in SearchIndex.word_fields:
+            # The API matches names and text partially, so exact names and prefixes are narrowed down afterwards
+            return term.value
+        if term.field == 'rarity':
+            return term.value if term.op == 'exact' else None
+        if term.op == 'exact':
+            return term.value
+        # Sent as every whole number under the bound, so the half costs from joke sets are missed
+        if term.op in ('<', '<=') and term.number <= QueryPlan.max_api_cmc:
+            values = [cmc for cmc in range(int(term.number) + 1) if SearchIndex.comparison(term.op, term.number)(cmc)]
+            return '|'.join(str(cmc) for cmc in values) or None
+        return None
+
+    @staticmethod
+    def __disjunctive(node):
+        """ :return: The tree as a list of ANDed lists of Terms and Not(Term)s that are ORed together """
+        if isinstance(node, Term):
+            return [[node]]
+        if isinstance(node, Or):
+            return [conjunction for child in node.children for conjunction in QueryPlan.__disjunctive(child)]
+        if isinstance(node, And):
+            conjunctions = [[]]
+            for child in node.children:
+                conjunctions = [left + right for left in conjunctions for right in QueryPlan.__disjunctive(child)]
+                if len(conjunctions) > QueryPlan.max_api_filters:
+                    raise QueryError('The search has too many alternatives to search online')
+            return conjunctions
+
+        child = node.child
+        if isinstance(child, Term):
+            return [[node]]
+        if isinstance(child, Not):
+            return QueryPlan.__disjunctive(child.child)
+        # De Morgan, so only single terms end up negated
+        if isinstance(child, And):
+            return QueryPlan.__disjunctive(Or([Not(grandchild) for grandchild in child.children]))
+        return QueryPlan.__disjunctive(And([Not(grandchild) for grandchild in child.children]))
@@ -1,82 +1,180 @@
-import json, mtgsdk, re, requests
-from searchparser import SearchParser
-from PIL import Image
-from io import BytesIO
-from cache import save, save_sprite, load, load_sprite, sprite_in_cache
+import json, mtgsdk, re, queue, logging, perf
+from query import QueryPlan
+from downloader import Downloader, get_downloader
+from cache import API_CACHE_TTL, save, load, get_set_metadata
 
-from multiprocessing import Pool, Manager, Process
+log = logging.getLogger(__name__)
 
 class Requester(object):
-    sets = mtgsdk.Set.all()
-    def __init__(self):
-        self.page = 1
+    # Put on the completion queue after the last result of a download
+    DONE = object()
+    # Cards asked for per request when streaming a search, 100 is the most the API allows
+    page_size = 100
+    # Searches go over the network so viewers should run them off the UI thread
+    search_in_background = True
+    def __init__(self, downloader=None, max_workers=None, offline=False):
         self.search_type = None
         self.search_for = None
 
-        #self.async_results = None
-        #self.pool = Pool(processes=4)
+        # When offline searches are answered from the cache only, however old the entry is
+        self.offline = offline
 
-        self.processes = []
-        self.manager = Manager()
-        self.async_results = self.manager.list()
+        # The shared downloader is used unless one is given (or a size for our own one is),
+        # it's looked up the first time we need to download something so requesters that only search don't pay for it
+        self.downloader = downloader
+        self.max_workers = max_workers
+        # The tickets for the images of the current search
+        self.tickets = []
+        # Bumped on every new search so late results from an older one can be told apart
+        self.generation = 0
+        # How many of the current generation's tickets have had their done signal taken off the queue
+        self.finished_tickets = 0
+
+        # The downloader's worker threads put (generation, result) here as images finish
+        # and (generation, Requester.DONE) once every image in a ticket is through
+        self.completed = queue.Queue()
+        # Called on the worker thread after anything is put on self.completed, i.e. to wake up a viewer
+        self.on_completed = None
 
     
 
     # Takes in the raw text from the user and formats a search query to mtgsdk
     def search(self, text):
-        kwargs = SearchParser.get_dict(text)
-        return mtgsdk.Card.where(**kwargs).all()
+        """ Gets the cards matching the search, from the cache if we've made the same search recently.
+        :param text: The text used to search
+        :return: A list of mtgsdk.Card objects that match the search. """
+        return [card for page in self.iter_search(text) for card in page]
+
+    def iter_search(self, text):
+        """ Gets the cards matching the search a page at a time, so the first ones can be
+        shown before the rest have been downloaded. Cached searches come back as one page.
+
+        The query is turned into one or more API searches (see QueryPlan.api_filters) and what
+        comes back is checked against the whole query, since the API can't do all of it.
+        :param text: The text used to search, see query.QueryParser for what it can contain
+        :return: A generator of lists of mtgsdk.Card objects
+        :raises query.QueryError: If the text can't be understood or searched for online """
+        plan = QueryPlan.compile(text)
+        # A card can come back from more than one of the API searches
+        seen = set()
+        for kwargs in plan.api_filters():
+            for page in self.__iter_api_search(kwargs):
+                matching = []
+                for card in page:
+                    if plan.matches(card.__dict__) and card.multiverse_id not in seen:
+                        if card.multiverse_id is not None:
+                            seen.add(card.multiverse_id)
+                        matching.append(card)
+                if matching:
+                    yield matching
+
+    def __iter_api_search(self, kwargs):
+        """ Pages through one API search, or its cached results.
+        :param kwargs: Filters for mtgsdk.Card.where
+        :return: A generator of lists of mtgsdk.Card objects """
+        cached = load(kwargs, max_age=None if self.offline else API_CACHE_TTL)
+        if cached is not None:
+            yield [Requester.make_card(card_dict) for card_dict in cached]
+            return
+        if self.offline:
+            log.info('No cached results for %s while offline', kwargs)
+            return
+
+        cards = []
+        # Local, a search that's been replaced can still be paging on its own thread
+        page_number = 1
+        while True:
+            with perf.timer('api.search_page'):
+                page = mtgsdk.Card.where(page=page_number, pageSize=Requester.page_size, **kwargs).all()
+            if not page:
+                break
+            cards.extend(page)
+            yield page
+            if len(page) < Requester.page_size:
+                # A short page is the last one, no need to ask for an empty one to find out
+                break
+            page_number += 1
+
+        # Only get here if the caller read every page, a search abandoned halfway isn't cached
+        save(kwargs, cards)
+
+    @staticmethod
+    def make_card(card_dict):
+        """ Builds a Card from a dict of its attributes, the same way CollectionData does. """
+        card = mtgsdk.Card()
+        card.__dict__.update(card_dict)
+        return card
 
     def preforming_async_task(self):
-        for process in self.processes:
-            if process.is_alive():
-                return True
-        
-        return False
+        """ Whether there are still results to come for the current search's downloads.
+        Only goes False once every result has been popped, so nothing is missed by stopping then. """
+        return self.finished_tickets < len(self.tickets)
 
     def has_results_in_list(self):
-        return len(self.async_results) > 0
+        return not self.completed.empty()
     
-    def pop_async_results(self):
+    def pop_async_results(self, max_results=None):
+        """ Takes finished downloads off the completion queue without waiting.
+        :param max_results: The most results to return, None for all of the ones that are ready
+        :return: A list of (index, img_data, card) tuples """
         return_list = []
-        for result in self.async_results:
-            return_list.append(self.async_results.pop(0))
+        while max_results is None or len(return_list) < max_results:
+            try:
+                generation, result = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                # Left over from a search that's been replaced
+                continue
+            if result is Requester.DONE:
+                self.finished_tickets += 1
+                continue
+            return_list.append(result)
         return return_list
         
-    def async_download_images(self, cards_to_download):
-        for card in cards_to_download:
-            p = Process(target=Requester.async_get_images, args=(card, self.async_results))
-            self.processes.append(p)
-            p.start()
+    def async_download_images(self, cards_to_download, replace=True):
+        """ Downloads the images for the cards in the background.
+        :param cards_to_download: A list of (index, Card) tuples
+        :param replace: When True this is a new search, images still downloading for the previous
+                        one are cancelled unless they're needed again. When False the cards are
+                        added to the current search, i.e. for the next page of results.
+        :return: None """
+        if self.downloader is None:
+            self.downloader = Downloader(self.max_workers) if self.max_workers else get_downloader()
 
-    @staticmethod
-    def get_set_release_date(set_name):
-        for magic_set in Requester.sets:
-            if magic_set.name == set_name:
-                return magic_set.release_date
+        if replace:
+            self.cancel_downloads()
+        generation = self.generation
 
-    @staticmethod
-    def load_image_from_server(card):
-        print(f"Downloading {card.name} from server.")
-        response = requests.get(card.image_url)
-        img = Image.open(BytesIO(response.content))
-        save_sprite(img, card.multiverse_id)
-        data = load_sprite(card.multiverse_id)
-        return data
-    
-    @staticmethod
-    def async_get_images(data, return_list):
-        """ Takes data and grabs the image from the internet
-        :param data: Should be a tuple of format (index, Card)
+        self.tickets.append(self.downloader.download(cards_to_download,
+                                                     lambda result: self.__complete(generation, result),
+                                                     lambda: self.__complete(generation, Requester.DONE)))
 
-        :return: (index, img_data, card_data) where data = {img_data:a PIL image, path:path_to_image} """
-        index = data[0]
-        card_obj = data[1]
+    def __complete(self, generation, result):
+        self.completed.put((generation, result))
+        if self.on_completed is not None:
+            self.on_completed()
 
-        img_data = Requester.load_image_from_server(card_obj)
-        
-        return_data = (index, img_data, card_obj)
-        return_list.append(return_data)
+    def prioritize(self, priorities):
+        """ Moves images of the current search up the download queue, see Downloader.prioritize.
+        :param priorities: A dict of index -> priority, the indexes given to async_download_images """
+        if self.downloader is None:
+            return
+        for ticket in self.tickets:
+            if not ticket.done():
+                self.downloader.prioritize(ticket, priorities)
 
-        
-    
\ No newline at end of file
+    def cancel_downloads(self):
+        """ Starts a new search. Images still downloading for the old one are dropped unless
+        they're needed again and results already on the queue are ignored. """
+        if self.downloader is not None:
+            for ticket in self.tickets:
+                self.downloader.cancel(ticket)
+        self.tickets = []
+        self.finished_tickets = 0
+        self.generation += 1
+
+    @staticmethod
+    def get_set_release_date(set_name):
+        """ :return: The release date of the set as a datetime, None if it isn't known """
+        return get_set_metadata().get_release_date(set_name)
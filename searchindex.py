@@ -0,0 +1,180 @@
+import re
+from collections import defaultdict
+
+
+class SearchIndex(object):
+    """ In memory index over the card fields searches can use (see query.QueryParser).
+
+    `name` and `text` are split into words and every word goes into a posting list.
+    The words themselves are indexed by trigram so a substring of a word can be found
+    without looking at every card. `rarity` and `cmc` are exact value buckets. """
+    word_fields = ('name', 'text')
+    bucket_fields = ('rarity', 'cmc')
+    gram_size = 3
+    word_pattern = re.compile(r'\w+')
+
+    def __init__(self):
+        self.keys = set()
+        # field -> {key: lowercase value}, used to check the full substring once the candidates are narrowed down
+        self.values = {field:{} for field in SearchIndex.word_fields}
+        # field -> {word: set of keys}
+        self.postings = {field:defaultdict(set) for field in SearchIndex.word_fields}
+        # field -> {trigram: set of words}
+        self.grams = {field:defaultdict(set) for field in SearchIndex.word_fields}
+        # field -> {value: set of keys}
+        self.buckets = {field:defaultdict(set) for field in SearchIndex.bucket_fields}
+        # key -> {field: bucket value} so a card can be taken back out of its buckets
+        self.bucket_values = {}
+
+    @staticmethod
+    def normalize(field, value):
+        """ Turns a card value or a search value into the form the index stores.
+        :param field: One of name, text, rarity or cmc
+        :param value: The raw value
+        :return: A lowercase string, or None if the value can't be indexed """
+        if value is None:
+            return None
+        if field == 'cmc':
+            # 3, 3.0 and '3' should all land in the same bucket
+            try:
+                return f'{float(value):g}'
+            except (TypeError, ValueError):
+                return None
+        return str(value).lower()
+
+    @staticmethod
+    def comparison(op, number):
+        """ :return: A function that checks a normalized cmc against number with op (<, <=, > or >=) """
+        if op == '<':
+            return lambda value: float(value) < number
+        if op == '<=':
+            return lambda value: float(value) <= number
+        if op == '>':
+            return lambda value: float(value) > number
+        return lambda value: float(value) >= number
+
+    def __gram_list(self, word):
+        n = SearchIndex.gram_size
+        return {word[i:i + n] for i in range(len(word) - n + 1)}
+
+    def add(self, key, card_dict):
+        """ Adds a card to the index. If the key is already indexed it's replaced.
+        :param key: The key lookups return, normally the multiverse_id
+        :param card_dict: The card's data as a dict """
+        if key in self.keys:
+            self.remove(key)
+        self.keys.add(key)
+
+        for field in SearchIndex.word_fields:
+            value = SearchIndex.normalize(field, card_dict.get(field))
+            if value is None:
+                continue
+            self.values[field][key] = value
+            for word in set(SearchIndex.word_pattern.findall(value)):
+                postings = self.postings[field][word]
+                if not postings:
+                    # First time we've seen this word so its trigrams need indexing too
+                    for gram in self.__gram_list(word):
+                        self.grams[field][gram].add(word)
+                postings.add(key)
+
+        bucket_values = {}
+        for field in SearchIndex.bucket_fields:
+            value = SearchIndex.normalize(field, card_dict.get(field))
+            if value is None:
+                continue
+            bucket_values[field] = value
+            self.buckets[field][value].add(key)
+        self.bucket_values[key] = bucket_values
+
+    def remove(self, key):
+        """ Removes a card from the index. Does nothing if the key isn't indexed.
+        :param key: The key the card was added with """
+        if key not in self.keys:
+            return
+        self.keys.discard(key)
+
+        for field in SearchIndex.word_fields:
+            value = self.values[field].pop(key, None)
+            if value is None:
+                continue
+            for word in set(SearchIndex.word_pattern.findall(value)):
+                postings = self.postings[field][word]
+                postings.discard(key)
+                if not postings:
+                    # Nobody uses this word anymore so drop it from the trigrams as well
+                    del self.postings[field][word]
+                    for gram in self.__gram_list(word):
+                        words = self.grams[field][gram]
+                        words.discard(word)
+                        if not words:
+                            del self.grams[field][gram]
+
+        for field, value in self.bucket_values.pop(key).items():
+            bucket = self.buckets[field][value]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[field][value]
+
+    def __words_containing(self, field, fragment):
+        """ Gets every indexed word that has fragment as a substring. """
+        grams = self.__gram_list(fragment)
+        if not grams:
+            # Too short for a trigram, the vocabulary is small compared to the cards so just scan it
+            return [word for word in self.postings[field] if fragment in word]
+
+        words = None
+        for gram in sorted(grams, key=lambda gram: len(self.grams[field].get(gram, ()))):
+            found = self.grams[field].get(gram)
+            if not found:
+                return []
+            words = set(found) if words is None else words & found
+            if not words:
+                return []
+        return [word for word in words if fragment in word]
+
+    def __word_candidates(self, field, query):
+        """ Gets a set of keys that might contain query in field. Still needs the substring check. """
+        fragments = SearchIndex.word_pattern.findall(query)
+        if not fragments:
+            # Nothing word-like to look up (i.e. just punctuation), every card with this field is a candidate
+            return set(self.values[field])
+
+        candidates = None
+        # Longest fragments first, they're the most selective
+        for fragment in sorted(set(fragments), key=len, reverse=True):
+            keys = set()
+            for word in self.__words_containing(field, fragment):
+                keys |= self.postings[field][word]
+            candidates = keys if candidates is None else candidates & keys
+            if not candidates:
+                return set()
+        return candidates
+
+    def lookup(self, field, op, value):
+        """ Gets the keys of the cards where one field matches.
+        :param field: One of word_fields or bucket_fields
+        :param op: contains, exact or prefix. cmc can also be compared with <, <=, > or >=
+        :param value: The value to look for, already normalized
+        :return: A set of keys """
+        if field in SearchIndex.word_fields:
+            values = self.values[field]
+            if op == 'exact':
+                return {key for key in self.__word_candidates(field, value) if values.get(key) == value}
+            if op == 'prefix':
+                return {key for key in self.__word_candidates(field, value) if values.get(key, '').startswith(value)}
+            return {key for key in self.__word_candidates(field, value) if value in values.get(key, '')}
+
+        buckets = self.buckets[field]
+        if op == 'exact':
+            return set(buckets.get(value, ()))
+        # There are only a handful of distinct rarities and costs so checking every bucket is cheap
+        if op == 'prefix':
+            test = lambda bucket_value: bucket_value.startswith(value)
+        else:
+            test = SearchIndex.comparison(op, float(value))
+        keys = set()
+        for bucket_value, bucket in buckets.items():
+            if test(bucket_value):
+                keys |= bucket
+        return keys
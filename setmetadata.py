@@ -0,0 +1,94 @@
+import json, os, threading, time, datetime, logging
+from cache import get_default_cache, build_cache_path, write_atomic
+
+log = logging.getLogger(__name__)
+
+
+class SetMetadata(object):
+    """ Names, codes and release dates of every set, kept on disk in the cache directory.
+
+    Nothing is read until the first lookup. If the file on disk is missing or older than `ttl`
+    a fresh copy is downloaded on a background thread, lookups keep using whatever we already
+    have (possibly nothing) until it arrives. """
+    # Seconds before the set list is downloaded again
+    ttl = 7 * 24 * 60 * 60
+    date_format = '%Y-%m-%d'
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(get_default_cache(), 'sets.json')
+        # set name -> {'name', 'code', 'release_date'} with release_date as a datetime (or None)
+        self.sets = None
+        self.lock = threading.Lock()
+        self.refreshing = None
+        # Goes up every time the sets are replaced, so anything worked out from them knows to redo it
+        self.version = 0
+
+    def get(self, set_name):
+        """ Gets the metadata for a set.
+        :param set_name: The name of the set, i.e. card.set_name
+        :return: A dict with name, code and release_date. None if we don't know the set (yet). """
+        if self.sets is None:
+            self.load()
+        return self.sets.get(set_name)
+
+    def get_release_date(self, set_name):
+        """ :return: The set's release date as a datetime, None if it isn't known """
+        magic_set = self.get(set_name)
+        if magic_set is None:
+            return None
+        return magic_set['release_date']
+
+    def load(self):
+        """ Reads the sets from disk and starts a background refresh if they're stale. """
+        with self.lock:
+            if self.sets is not None:
+                return
+            fetched = 0
+            records = []
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                fetched = data['fetched']
+                records = data['sets']
+            except (OSError, ValueError, KeyError):
+                # Nothing usable on disk, the refresh below will fill it in
+                pass
+            self.sets = SetMetadata.__index(records)
+            self.version += 1
+
+        if time.time() - fetched > SetMetadata.ttl:
+            self.refresh()
+
+    def refresh(self):
+        """ Downloads the set list on a background thread. Does nothing if a download is already running. """
+        with self.lock:
+            if self.refreshing is not None and self.refreshing.is_alive():
+                return
+            self.refreshing = threading.Thread(target=self.__refresh, daemon=True)
+            self.refreshing.start()
+
+    def __refresh(self):
+        import mtgsdk
+        try:
+            records = [{'name':magic_set.name, 'code':magic_set.code, 'release_date':magic_set.release_date}
+                        for magic_set in mtgsdk.Set.all()]
+        except Exception as error:
+            log.warning("Couldn't refresh the set list: %s", error)
+            return
+
+        build_cache_path(os.path.dirname(self.path))
+        write_atomic(self.path, json.dumps({'fetched':time.time(), 'sets':records}))
+        # Swapping the whole dict in means readers never see it half built
+        self.sets = SetMetadata.__index(records)
+        self.version += 1
+
+    @staticmethod
+    def __index(records):
+        sets = {}
+        for record in records:
+            try:
+                release_date = datetime.datetime.strptime(record['release_date'], SetMetadata.date_format)
+            except (TypeError, ValueError):
+                release_date = None
+            sets[record['name']] = {'name':record['name'], 'code':record.get('code'), 'release_date':release_date}
+        return sets
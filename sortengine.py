@@ -0,0 +1,158 @@
+import bisect, datetime, heapq, math
+from cache import get_set_metadata
+from cardview import CardView
+
+# The SortKeys everything shares, see get_sort_keys
+SORT_KEYS = None
+
+
+class SortKeys(object):
+    """ Works out sort keys for cards and remembers them by multiverse_id, so sorting the same
+    cards again (a new page of results, another search, a different order) only compares tuples.
+
+    Release dates come from the set metadata. When that's replaced (i.e. a refresh finished) the
+    remembered keys are thrown away, since cards whose set was unknown will sort differently. """
+    # Sets we don't have a release date for yet go first
+    unknown_date = datetime.datetime.min
+    # Cards without a cmc go last
+    unknown_cmc = math.inf
+    rarity_ranks = {'common':0, 'uncommon':1, 'rare':2, 'mythic rare':3, 'special':4}
+    # Keys remembered before they're all thrown away, enough for several searches worth of cards
+    max_keys = 200000
+
+    # Name shown to people -> what the key is made of, in order
+    orders = {'Name':('name', 'release_date'),
+              'Release date':('release_date', 'name'),
+              'Mana value':('cmc', 'name', 'release_date'),
+              'Rarity':('rarity', 'name', 'release_date')}
+    default_order = 'Name'
+
+    def __init__(self):
+        # order -> {multiverse_id: key}
+        self.keys = {order:{} for order in SortKeys.orders}
+        self.count = 0
+        self.sets_version = None
+
+    def key(self, order, card_dict):
+        """ Gets the sort key for a card.
+        :param order: One of SortKeys.orders
+        :param card_dict: The card's data, i.e. card.__dict__, or anything else with a dict style get
+        :return: A tuple that sorts the card into place """
+        sets = get_set_metadata()
+        if sets.sets is None:
+            # Load now rather than part way through working out a key, which would change the version
+            sets.load()
+        if sets.version != self.sets_version:
+            self.clear()
+            self.sets_version = sets.version
+
+        keys = self.keys[order]
+        multiverse_id = card_dict.get('multiverse_id')
+        key = keys.get(multiverse_id)
+        if key is None:
+            key = tuple(SortKeys.__part(part, card_dict) for part in SortKeys.orders[order])
+            # A card that's only an id so far (its data is still being fetched) isn't remembered,
+            # its key changes once the data's in
+            if multiverse_id is not None and card_dict.get('name') is not None:
+                if self.count >= SortKeys.max_keys:
+                    self.clear()
+                keys[multiverse_id] = key
+                self.count += 1
+        return key
+
+    def card_key(self, order, card):
+        """ Same as key, for a mtgsdk.Card or a CardView. A CardView is used as it is, so
+        sorting never reads more of the card than its summary. """
+        return self.key(order, card if isinstance(card, CardView) else card.__dict__)
+
+    def forget(self, multiverse_id):
+        """ Drops the keys remembered for a card, i.e. because its data changed. """
+        for keys in self.keys.values():
+            if keys.pop(multiverse_id, None) is not None:
+                self.count -= 1
+
+    def clear(self):
+        for keys in self.keys.values():
+            keys.clear()
+        self.count = 0
+
+    @staticmethod
+    def __part(part, card_dict):
+        if part == 'name':
+            return card_dict.get('name') or ''
+        if part == 'release_date':
+            return get_set_metadata().get_release_date(card_dict.get('set_name')) or SortKeys.unknown_date
+        if part == 'cmc':
+            try:
+                return float(card_dict.get('cmc'))
+            except (TypeError, ValueError):
+                return SortKeys.unknown_cmc
+        rarity = str(card_dict.get('rarity')).lower()
+        return SortKeys.rarity_ranks.get(rarity, len(SortKeys.rarity_ranks))
+
+
+def get_sort_keys():
+    """ Gets the sort key cache shared by every viewer and collection. """
+    global SORT_KEYS
+    if SORT_KEYS is None:
+        SORT_KEYS = SortKeys()
+    return SORT_KEYS
+
+
+class SortedList(object):
+    """ Items kept sorted by key as they're added, so the order never has to be rebuilt from scratch.
+
+    Items with equal keys stay in the order they were added. Indexing gives the items. """
+    def __init__(self, key):
+        """ :param key: Function that gives an item's sort key """
+        self.key = key
+        # (key, sequence, item) sorted, the sequence breaks ties so items themselves are never compared
+        self.entries = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, index):
+        return self.entries[index][2]
+
+    def __iter__(self):
+        return (item for _, _, item in self.entries)
+
+    def __entry(self, item):
+        self.sequence += 1
+        return (self.key(item), self.sequence, item)
+
+    def add(self, item):
+        """ Puts one item into place. """
+        bisect.insort(self.entries, self.__entry(item))
+
+    def extend(self, items):
+        """ Adds a group of items. They're sorted on their own and merged in, which for a page of
+        results is much less work than sorting everything again. """
+        new = sorted(self.__entry(item) for item in items)
+        if not new:
+            return
+        if not self.entries or new[0] >= self.entries[-1]:
+            # Common when the items arrive already in order
+            self.entries.extend(new)
+        elif len(new) < 8:
+            for entry in new:
+                bisect.insort(self.entries, entry)
+        else:
+            self.entries = list(heapq.merge(self.entries, new))
+
+    def remove(self, item):
+        """ Takes an item out, found by its key. Does nothing if it isn't there. """
+        key = self.key(item)
+        index = bisect.bisect_left(self.entries, (key,))
+        while index < len(self.entries) and self.entries[index][0] == key:
+            if self.entries[index][2] == item:
+                del self.entries[index]
+                return
+            index += 1
+
+    def resort(self, key):
+        """ Changes the key and puts everything in the new order. """
+        self.key = key
+        self.entries = sorted((key(item), sequence, item) for _, sequence, item in self.entries)
@@ -0,0 +1,274 @@
+import json, sqlite3, logging, perf
+from mtgsdk import Card
+from cardview import CardView
+from searchindex import SearchIndex
+from query import QueryPlan, And, Or, Not
+from cache import write_atomic, get_card_store
+from collectiondata import CollectionData
+from decklist import Decklist
+
+log = logging.getLogger(__name__)
+
+
+class SQLiteCollectionData(object):
+    """ A collection kept in a SQLite database instead of a JSON file.
+
+    Has the same search/add_card/remove_card/num_owned/save interface as CollectionData. Opening
+    one doesn't read the cards into memory. Exact and prefix searches on name and rarity and cmc
+    comparisons use the column indexes (name's ignores case). Name and rules text also go in an
+    FTS5 trigram index that answers substring searches of 3 or more characters, shorter ones,
+    negations and everything on a SQLite without FTS5 scan the table.
+
+    Changes are made in a transaction that save() commits, so like the JSON collections nothing
+    is written until the collection is saved. """
+    schema = '''
+        CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY,
+            multiverse_id TEXT UNIQUE NOT NULL,
+            name TEXT,
+            rarity TEXT,
+            cmc REAL,
+            text TEXT,
+            owned INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        -- Names are searched ignoring case, collections made before that have a plain index to replace
+        DROP INDEX IF EXISTS cards_name;
+        CREATE INDEX IF NOT EXISTS cards_name_nocase ON cards(name COLLATE NOCASE);
+        CREATE INDEX IF NOT EXISTS cards_rarity ON cards(rarity);
+        CREATE INDEX IF NOT EXISTS cards_cmc ON cards(cmc);
+    '''
+    # rowid matches cards.id
+    fts_schema = "CREATE VIRTUAL TABLE IF NOT EXISTS cards_fts USING fts5(name, text, tokenize='trigram')"
+
+    def __init__(self, file_path=''):
+        self.file_path = file_path
+        self.connection = self.open_collection_data(file_path)
+
+    def open_collection_data(self, file_path):
+        """ Opens (creating if needed) the database. An empty file_path gives an in memory collection.
+        :return: A sqlite3 connection """
+        connection = sqlite3.connect(file_path or ':memory:')
+        connection.executescript(SQLiteCollectionData.schema)
+        try:
+            connection.execute(SQLiteCollectionData.fts_schema)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5 (or too old for trigrams), searches fall back to scanning
+            log.warning('FTS5 trigram index not available, text searches will be slower')
+            self.fts = False
+        connection.commit()
+        return connection
+
+    def search(self, text):
+        """ Gets a list of cards based on the text.
+        :param text: The text used to search the collection, see query.QueryParser for what it can contain
+        :return: A list of CardView objects that match the search, each over the card data read from the database
+        :raises query.QueryError: If the text can't be understood """
+        tree = QueryPlan.compile(text).tree
+        args = []
+        query = 'SELECT data FROM cards'
+        if tree is not None:
+            query += ' WHERE ' + self.__where(tree, args)
+
+        cards = []
+        for (data,) in self.connection.execute(query, args):
+            card_dict = json.loads(data)
+            cards.append(CardView(card_dict, record=card_dict))
+        perf.count('collection.search_results', len(cards))
+        return cards
+
+    def __where(self, node, args):
+        """ Turns a query tree into an SQL condition.
+        :param args: The values for the condition's ? placeholders are added to this
+        :return: The condition """
+        if isinstance(node, And):
+            return '(' + ' AND '.join(self.__where(child, args) for child in node.children) + ')'
+        if isinstance(node, Or):
+            return '(' + ' OR '.join(self.__where(child, args) for child in node.children) + ')'
+        if isinstance(node, Not):
+            # A card without the field doesn't match the term, so it does match its negation
+            return f'NOT coalesce({self.__where(node.child, args)}, 0)'
+
+        field, op, value = node.field, node.op, node.value
+        # Values are lower cased already, so is rarity in the table. NOCASE makes name and text
+        # compare the same way without lower(), which would stop the name index being used
+        collate = ' COLLATE NOCASE' if field in SearchIndex.word_fields else ''
+        if field == 'cmc' and op != 'prefix':
+            args.append(node.number)
+            return f'cmc {"=" if op == "exact" else op} ?'
+        if op == 'exact':
+            args.append(value)
+            return f'{field} = ?{collate}'
+        if op == 'contains' and self.fts and len(value) >= 3:
+            # A quoted string is a substring match with the trigram tokenizer, quotes inside are doubled
+            args.append(f'{field} : "' + value.replace('"', '""') + '"')
+            return 'id IN (SELECT rowid FROM cards_fts WHERE cards_fts MATCH ?)'
+
+        pattern = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        if op == 'prefix' and field != 'cmc' and value:
+            # The index narrows it down to a range, i.e. light* is light <= name < lighu, and LIKE
+            # only checks the rows in it. The range can be a little wide for odd characters like @
+            args.extend((value, value[:-1] + chr(ord(value[-1]) + 1), pattern + '%'))
+            return f"({field} >= ?{collate} AND {field} < ?{collate} AND {field} LIKE ? ESCAPE '\\')"
+
+        # Too short for a trigram or there's no FTS5, this one reads every row
+        args.append(pattern + '%' if op == 'prefix' else '%' + pattern + '%')
+        return f"{field} LIKE ? ESCAPE '\\'"
+
+    def statistics(self, text=''):
+        """ Totals for the collection, worked out by the database.
+        :param text: Only count the cards that match this search, everything if it's empty
+        :return: A dict in the format CollectionData.statistics returns """
+        args = []
+        where = 'owned > 0'
+        tree = QueryPlan.compile(text).tree if text else None
+        if tree is not None:
+            where += ' AND ' + self.__where(tree, args)
+
+        def grouped(column):
+            rows = self.connection.execute(f'SELECT {column}, sum(owned) FROM cards WHERE {where} GROUP BY 1', args)
+            return {value:total for value, total in rows}
+
+        unique, total = self.connection.execute(f'SELECT count(*), coalesce(sum(owned), 0) FROM cards WHERE {where}', args).fetchone()
+        curve = {value:total for value, total in grouped('cmc').items() if value is not None}
+        costed = sum(curve.values())
+        return {'unique':unique, 'total':total,
+                # The rarity column is lower cased for searching, the card data has it as the API does
+                'by_rarity':grouped("json_extract(data, '$.rarity')"), 'by_set':grouped("json_extract(data, '$.set')"),
+                'curve':dict(sorted(curve.items())),
+                'average_cmc':sum(cmc * count for cmc, count in curve.items()) / costed if costed else None}
+
+    def iter_search(self, text):
+        """ Same as search but in the paged form Requester.iter_search uses.
+        :return: A generator of lists of CardView objects """
+        yield self.search(text)
+
+    def add_card(self, card):
+        """ Adds one card from the collection. If the card already exists in the collection it adds one to owned.
+
+        `card` Should be a mtgsdk.Card type. Will throw error otherwise
+
+        :param card: The card to add."""
+        if not isinstance(card, (Card, CardView)):
+            raise ValueError("You must only add Cards types to your collection.")
+        self.__add(card.__dict__, 1)
+
+    def add_cards(self, cards):
+        """ Adds a lot of cards in one go, see CollectionData.add_cards.
+        :param cards: An iterable of (multiverse_id, count) tuples
+        :return: The multiverse_ids the API didn't know, they're left out of the collection """
+        counts = {}
+        for multiverse_id, count in cards:
+            if count < 1:
+                raise ValueError(f"Can't add {count} copies of {multiverse_id}")
+            counts[multiverse_id] = counts.get(multiverse_id, 0) + count
+
+        # Cards already in the collection only need their count bumped
+        new_ids = []
+        for multiverse_id, count in counts.items():
+            cursor = self.connection.execute('UPDATE cards SET owned = owned + ? WHERE multiverse_id = ?', (count, str(multiverse_id)))
+            if cursor.rowcount == 0:
+                new_ids.append(multiverse_id)
+
+        card_dicts = get_card_store().get_many(new_ids, fetch_missing=True)
+        unknown = []
+        for multiverse_id in new_ids:
+            card_dict = card_dicts.get(str(multiverse_id))
+            if card_dict is None:
+                unknown.append(multiverse_id)
+            else:
+                self.__add(card_dict, counts[multiverse_id])
+        return unknown
+
+    def import_file(self, file_path):
+        """ Adds the cards in a decklist or CSV file and commits once at the end, see CollectionData.import_file.
+        :return: The names or multiverse_ids from the file that couldn't be found """
+        resolved, unknown = Decklist.resolve(Decklist.read(file_path), get_card_store())
+        unknown.extend(self.add_cards(resolved))
+        log.info('Imported %d cards from %s, %d not found', sum(count for _, count in resolved), file_path, len(unknown))
+        if self.file_path:
+            self.save()
+        return unknown
+
+    def __add(self, card_dict, count):
+        cursor = self.connection.execute('UPDATE cards SET owned = owned + ? WHERE multiverse_id = ?',
+                                         (count, str(card_dict['multiverse_id'])))
+        if cursor.rowcount == 0:
+            cursor = self.connection.execute('INSERT INTO cards (multiverse_id, name, rarity, cmc, text, owned, data) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                             (str(card_dict['multiverse_id']), card_dict.get('name'),
+                                              SearchIndex.normalize('rarity', card_dict.get('rarity')),
+                                              SearchIndex.normalize('cmc', card_dict.get('cmc')),
+                                              card_dict.get('text'), count, json.dumps(card_dict)))
+            if self.fts:
+                self.connection.execute('INSERT INTO cards_fts (rowid, name, text) VALUES (?, ?, ?)',
+                                        (cursor.lastrowid, card_dict.get('name'), card_dict.get('text')))
+
+    def remove_card(self, card):
+        """ Removes one card from the collection. If the card doesn't exist in the collection it does nothing.
+
+        `card` Should be a mtgsdk.Card type. Will throw error otherwise
+
+        :param card: The card to add."""
+        if not isinstance(card, (Card, CardView)):
+            raise ValueError("You must only remove Cards types from your collection.")
+        self.connection.execute('UPDATE cards SET owned = owned - 1 WHERE multiverse_id = ? AND owned > 0',
+                                (str(card.multiverse_id),))
+
+    def num_owned(self, card):
+        """ Gets the number of owned cards with the same multiverse_id as the given card.
+        :param card: The card to check.
+        :return: The number of cards of this type that are owned in the collection. """
+        if not isinstance(card, (Card, CardView)):
+            raise ValueError("You must only remove Cards types from your collection.")
+        row = self.connection.execute('SELECT owned FROM cards WHERE multiverse_id = ?', (str(card.multiverse_id),)).fetchone()
+        if row is not None:
+            return row[0]
+        else:
+            return '0'
+
+    def save(self):
+        """ Commits the changes made since the last save.
+        :return: None """
+        assert(self.file_path != '')
+        self.connection.commit()
+
+    def save_as(self, file_path):
+        """ Save the collection to file_path. A path ending in .json is exported in the format
+        CollectionData reads, anything else becomes a copy of the database that this object then uses.
+        :return: None """
+        if file_path.endswith('.json'):
+            self.export_json(file_path)
+            return
+
+        self.connection.commit()
+        new_connection = sqlite3.connect(file_path)
+        self.connection.backup(new_connection)
+        self.connection.close()
+        self.connection = new_connection
+        self.file_path = file_path
+
+    def import_json(self, json_path):
+        """ Adds every card from a JSON collection (either layout CollectionData understands) to this one.
+        :param json_path: The collection file to read """
+        collection = CollectionData(json_path, columnar=False)
+        # The collection only keeps summaries of its cards, the whole of each is in the card store
+        stored = set()
+        for key, card_dict in collection.card_store.iter_many(collection.entries):
+            stored.add(key)
+            self.__add(card_dict, collection.entries[card_dict['multiverse_id']]['collection_data']['owned'])
+        for multiverse_id, entry in collection.entries.items():
+            if collection.card_store.key(multiverse_id) not in stored:
+                # Cards the API didn't know, there's only the id
+                self.__add(entry['card_data'], entry['collection_data']['owned'])
+
+    def export_json(self, json_path):
+        """ Writes the collection as a JSON collection. The card data goes to the shared card store
+        the same way CollectionData saves it. """
+        card_dicts = []
+        owned = {}
+        for multiverse_id, count, data in self.connection.execute('SELECT multiverse_id, owned, data FROM cards'):
+            card_dicts.append(json.loads(data))
+            owned[multiverse_id] = count
+        get_card_store().put_many(card_dicts)
+        write_atomic(json_path, json.dumps({'format':2, 'collection':owned}))
@@ -0,0 +1,5 @@
+import os, sys, tempfile
+
+# cache.py works out its paths when it's imported, so point it somewhere throwaway before any test imports it
+os.environ['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='mtg-tests-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
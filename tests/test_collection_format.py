@@ -0,0 +1,90 @@
+import json, os, threading
+import pytest
+from cardstore import CardStore
+from collectiondata import CollectionData
+from query import QueryPlan
+from setmetadata import SetMetadata
+
+
+@pytest.fixture
+def card_store(tmp_path):
+    return CardStore(str(tmp_path / 'cards.db'))
+
+
+def card_dict(multiverse_id):
+    return {'multiverse_id':multiverse_id, 'name':f'Card {multiverse_id}', 'cmc':2, 'rarity':'Rare', 'set':'TST', 'text':'Draw a card.'}
+
+
+def test_old_layout_moves_to_the_card_store(tmp_path, card_store):
+    path = str(tmp_path / 'collection.json')
+    with open(path, 'w') as f:
+        json.dump({'collection':[{'card_data':card_dict(1), 'collection_data':{'owned':2}},
+                                 {'card_data':card_dict(2), 'collection_data':{'owned':1}}]}, f)
+
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    assert collection.migrated
+    assert card_store.get(1)['text'] == 'Draw a card.'
+    assert collection.entries[1] == {'card_data':{'multiverse_id':1, 'name':'Card 1', 'set':'TST', 'set_name':None, 'cmc':2, 'rarity':'Rare'},
+                                     'collection_data':{'owned':2}}
+
+    collection.save()
+    with open(path) as f:
+        assert json.load(f) == {'format':2, 'collection':{'1':2, '2':1}, 'journal_seq':0}
+    # The old file is kept in case anything went wrong
+    assert os.path.isfile(path + '.v1.bak')
+
+    reopened = CollectionData(path, journaled=True, card_store=card_store)
+    assert not reopened.migrated
+    assert {multiverse_id:entry['collection_data']['owned'] for multiverse_id, entry in reopened.entries.items()} == {1:2, 2:1}
+
+
+def test_old_journal_records_carry_their_card_data(tmp_path, card_store):
+    path = str(tmp_path / 'collection.json')
+    with open(path, 'w') as f:
+        json.dump({'format':2, 'collection':{}, 'journal_seq':0}, f)
+    with open(path + '.journal', 'w') as f:
+        f.write(json.dumps({'op':'add', 'multiverse_id':3, 'card_data':card_dict(3), 'seq':1}) + '\n')
+
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    assert collection.entries[3]['collection_data']['owned'] == 1
+    assert card_store.get(3)['name'] == 'Card 3'
+
+
+def test_cards_missing_from_the_store_are_fetched_after_opening(tmp_path, card_store, monkeypatch):
+    # Release dates don't matter here, don't go looking for the set list
+    monkeypatch.setattr(SetMetadata, 'refresh', lambda self: None)
+    names = {'2':'Zzzz', '3':'Aaaa'}
+    fetched = []
+    go = threading.Event()
+    def fetch(keys):
+        # Held back until the collection has been sorted without the data
+        go.wait(10)
+        fetched.extend(keys)
+        # 99 isn't a card the API knows
+        return [dict(card_dict(int(key)), name=names[key]) for key in keys if key in names]
+    monkeypatch.setattr(CardStore, 'fetch', staticmethod(fetch))
+
+    card_store.put(dict(card_dict(1), name='Mmm'))
+    path = str(tmp_path / 'collection.json')
+    with open(path, 'w') as f:
+        json.dump({'format':2, 'collection':{'1':1, '2':3, '3':1, '99':1}}, f)
+
+    collection = CollectionData(path, card_store=card_store)
+    # Opened with just the ids, the rest comes from another thread
+    assert collection.unfetched == {2, 3, 99}
+    assert collection.entries[2]['card_data']['name'] is None
+    # Sorted before the data's in, as cards without a name
+    assert [card.multiverse_id for card in collection.search('')][-1] == 1
+    go.set()
+    collection.fetch_thread.join()
+    assert sorted(fetched) == ['2', '3', '99']
+
+    assert collection.fill_fetched() == 2
+    assert collection.unfetched == {99}
+    assert collection.entries[2]['card_data']['name'] == 'Zzzz'
+    assert QueryPlan.compile('name:a or name:z').keys(collection.search_index) == {2, 3}
+    assert collection.statistics('cmc:2')['total'] == 5
+    # The fetched cards move to where their names put them
+    assert [card.multiverse_id for card in collection.search('')] == [99, 3, 1, 2]
+    # The count of a card nobody knows is kept
+    assert collection.entries[99]['collection_data']['owned'] == 1
@@ -0,0 +1,54 @@
+import io
+import pytest
+from decklist import Decklist
+
+
+def test_parse():
+    text = '''// Burn
+Deck
+4 Lightning Bolt
+2x Counterspell (7ED) 67
+3X Shock
+1 Fire // Ice (MH2)
+12345
+
+Sideboard:
+# comments and blank lines are skipped
+Pyroblast
+'''
+    assert Decklist.parse(io.StringIO(text)) == [('Lightning Bolt', 4), ('Counterspell', 2), ('Shock', 3),
+                                                  ('Fire // Ice', 1), (12345, 1), ('Pyroblast', 1)]
+
+
+def test_parse_set_suffixes():
+    # Collector numbers aren't always just digits, a set code alone is dropped too
+    assert Decklist.parse(['2 Forest (ZEN) 246a', 'Island (M21)', 'Sideboard', 'Forest (Alt Art)']) == \
+        [('Forest', 2), ('Island', 1), ('Forest (Alt Art)', 1)]
+
+
+@pytest.mark.parametrize('header', ['multiverse_id,count', 'MultiverseID,Quantity', 'Multiverse ID , Qty', 'id,owned'])
+def test_parse_csv_header_aliases(header):
+    assert Decklist.parse_csv(io.StringIO(f'{header}\n1,4\n2,\n')) == [(1, 4), (2, 1)]
+
+
+def test_parse_csv_names():
+    text = 'Card Name,Set,Amount\nLightning Bolt,LEA,2\n"Fire // Ice",MH2,1\n,,\n'
+    assert Decklist.parse_csv(io.StringIO(text)) == [('Lightning Bolt', 2), ('Fire // Ice', 1)]
+    # The id wins when there's both, the name is used for rows without one
+    text = 'name,multiverse_id\nLightning Bolt,1\nShock,\n'
+    assert Decklist.parse_csv(io.StringIO(text)) == [(1, 1), ('Shock', 1)]
+
+
+@pytest.mark.parametrize('text', ['set,count\nLEA,1\n', '', 'name,count\nShock,lots\n'])
+def test_parse_csv_errors(text):
+    with pytest.raises(ValueError):
+        Decklist.parse_csv(io.StringIO(text))
+
+
+def test_read_picks_the_format_by_extension(tmp_path):
+    path = tmp_path / 'cards.CSV'
+    path.write_text('name,qty\nShock,3\n')
+    assert Decklist.read(str(path)) == [('Shock', 3)]
+    path = tmp_path / 'cards.txt'
+    path.write_text('name,qty\n')
+    assert Decklist.read(str(path)) == [('name,qty', 1)]
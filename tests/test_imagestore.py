@@ -0,0 +1,89 @@
+import os, subprocess, sys
+from PIL import Image
+from imagestore import ImageStore
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Saves images into a store from another process, the way a second copy of the app would
+WRITER = '''
+import sys
+from PIL import Image
+from imagestore import ImageStore
+root, first, last, compact_every = sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4])
+ImageStore.compact_every = compact_every
+store = ImageStore(root, 1 << 30)
+for multiverse_id in range(first, last):
+    store.put(multiverse_id, Image.new('RGB', (4, 4), (multiverse_id % 256, 0, 0)))
+'''
+
+
+def writer(root, first, last, compact_every=ImageStore.compact_every):
+    return subprocess.Popen([sys.executable, '-c', WRITER, root, str(first), str(last), str(compact_every)], cwd=REPO)
+
+
+def keys(store):
+    return {int(key) for key in store.entries}
+
+
+def check_total(store):
+    assert store.total_bytes == sum(sum(entry['sizes'].values()) for entry in store.entries.values())
+
+
+def test_picks_up_images_other_processes_saved(tmp_path, monkeypatch):
+    monkeypatch.setattr(ImageStore, 'refresh_every', 0)
+    root = str(tmp_path / 'images')
+    store = ImageStore(root, 1 << 30)
+    assert not store.contains(1)
+
+    assert writer(root, 1, 4).wait() == 0
+    # Read from the other process's log lines
+    assert store.contains(1) and store.contains(3)
+    store.put(4, Image.new('RGB', (4, 4)))
+    check_total(store)
+
+    fresh = ImageStore(root, 1 << 30)
+    assert fresh.contains(4)
+    assert keys(fresh) == {1, 2, 3, 4}
+
+
+def test_writers_at_the_same_time_keep_every_entry(tmp_path):
+    root = str(tmp_path / 'images')
+    # A small compact_every so the log is replaced under the other writer a few times
+    writers = [writer(root, 0, 40, 7), writer(root, 40, 80, 5)]
+    assert [process.wait() for process in writers] == [0, 0]
+
+    store = ImageStore(root, 1 << 30)
+    store.contains(0)
+    assert keys(store) == set(range(80))
+    check_total(store)
+
+
+def test_catches_up_after_another_process_compacts(tmp_path, monkeypatch):
+    monkeypatch.setattr(ImageStore, 'refresh_every', 0)
+    root = str(tmp_path / 'images')
+    store = ImageStore(root, 1 << 30)
+    store.put(100, Image.new('RGB', (4, 4)))
+
+    # Compacting replaces the log, the next locked catch up reads index.json again
+    assert writer(root, 1, 6, 2).wait() == 0
+    store.put(101, Image.new('RGB', (4, 4)))
+    assert keys(store) == {1, 2, 3, 4, 5, 100, 101}
+    check_total(store)
+    fresh = ImageStore(root, 1 << 30)
+    fresh.contains(0)
+    assert keys(fresh) == {1, 2, 3, 4, 5, 100, 101}
+
+
+def test_eviction_removes_the_oldest_images_from_every_process(tmp_path):
+    root = str(tmp_path / 'images')
+    assert writer(root, 1, 6).wait() == 0
+    store = ImageStore(root, 1 << 30)
+    store.contains(0)
+    size = store.total_bytes // 5
+    store.evict(size * 2)
+    assert store.total_bytes <= size * 2 and 5 in keys(store)
+    assert not os.path.isfile(store.path(1))
+
+    fresh = ImageStore(root, 1 << 30)
+    fresh.contains(0)
+    assert keys(fresh) == keys(store)
@@ -0,0 +1,139 @@
+import json, os
+import pytest
+from cardstore import CardStore
+from collectiondata import CollectionData
+from journal import Journal
+
+
+@pytest.fixture
+def card_store(tmp_path):
+    store = CardStore(str(tmp_path / 'cards.db'))
+    store.put_many([{'multiverse_id':multiverse_id, 'name':f'Card {multiverse_id}', 'cmc':multiverse_id % 4, 'rarity':'Common', 'set':'TST'}
+                    for multiverse_id in range(1, 11)])
+    return store
+
+
+def owned(collection):
+    return {multiverse_id:entry['collection_data']['owned'] for multiverse_id, entry in collection.entries.items()}
+
+
+def test_replay_skips_the_snapshot_and_stops_at_a_torn_line(tmp_path):
+    path = str(tmp_path / 'collection.json')
+    with open(path + '.journal', 'w') as f:
+        for seq in range(1, 5):
+            f.write(json.dumps({'op':'add', 'multiverse_id':seq, 'seq':seq}) + '\n')
+        f.write('{"op": "add", "multiv')
+
+    journal = Journal(path)
+    assert [record['seq'] for record in journal.replay(2)] == [3, 4]
+    assert journal.seq == 4
+    # The torn line is cut off so what's appended next starts on a line of its own
+    journal.append([{'op':'add', 'multiverse_id':5}])
+    assert [record['seq'] for record in Journal(path).replay(2)] == [3, 4, 5]
+    # Nothing in the log yet, the seq carries on from the snapshot's
+    assert Journal(str(tmp_path / 'other.json')).replay(7) == []
+
+
+def test_save_appends_and_reopening_replays(tmp_path, card_store):
+    path = str(tmp_path / 'collection.json')
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(1, 2), (2, 1)])
+    collection.save()
+    # The first save has nothing to append to, it writes the snapshot
+    assert os.path.isfile(path) and not os.path.isfile(path + '.journal')
+
+    collection.add_cards([(1, 1), (3, 1)])
+    collection.save()
+    assert os.path.isfile(path + '.journal')
+
+    assert owned(CollectionData(path, journaled=True, card_store=card_store)) == {1:3, 2:1, 3:1}
+
+
+def test_saves_after_a_crash_mid_append_are_kept(tmp_path, card_store):
+    path = str(tmp_path / 'collection.json')
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(1, 1)])
+    collection.save()
+    collection.add_cards([(2, 1)])
+    collection.save()
+    with open(path + '.journal', 'a') as f:
+        f.write('{"op": "add", "multiverse_id": 9, "se')
+
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(3, 1)])
+    collection.save()
+    assert owned(CollectionData(path, journaled=True, card_store=card_store)) == {1:1, 2:1, 3:1}
+
+
+def test_save_as_writes_the_snapshot_before_dropping_the_journal(tmp_path, card_store):
+    path = str(tmp_path / 'collection.json')
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(1, 1)])
+    collection.save()
+    collection.add_cards([(2, 1)])
+    collection.save()
+    seq = collection.journal.seq
+
+    collection.save_as(path)
+    with open(path) as f:
+        assert json.load(f)['journal_seq'] == seq
+    assert not os.path.isfile(path + '.journal')
+
+    # Sequence numbers carry on so a stale journal could never be replayed over the snapshot
+    collection.add_cards([(3, 1)])
+    collection.save()
+    assert collection.journal.seq == seq + 1
+    assert owned(CollectionData(path, journaled=True, card_store=card_store)) == {1:1, 2:1, 3:1}
+
+
+def test_crash_between_snapshot_and_truncate(tmp_path, card_store):
+    path = str(tmp_path / 'collection.json')
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(1, 1)])
+    collection.save()
+    collection.add_cards([(1, 1), (2, 2)])
+    collection.save()
+
+    # What's on disk if we die after the new snapshot is written but before the log is removed
+    with open(path, 'w') as f:
+        json.dump({'format':2, 'collection':{'1':2, '2':2}, 'journal_seq':collection.journal.seq}, f)
+    assert os.path.isfile(path + '.journal')
+
+    assert owned(CollectionData(path, journaled=True, card_store=card_store)) == {1:2, 2:2}
+
+
+def test_compaction_keeps_records_appended_meanwhile(tmp_path, card_store, monkeypatch):
+    monkeypatch.setattr(Journal, 'compact_threshold', 1)
+    path = str(tmp_path / 'collection.json')
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(1, 1)])
+    collection.save()
+    for multiverse_id in range(2, 8):
+        collection.add_cards([(multiverse_id, 1)])
+        collection.save()
+    collection.journal.wait()
+
+    with open(path) as f:
+        snapshot = json.load(f)
+    # Whatever the compaction didn't fold into the snapshot is still in the log
+    kept = collection.journal.replay(snapshot['journal_seq'])
+    assert {record['multiverse_id'] for record in kept} | set(map(int, snapshot['collection'])) == set(range(1, 8))
+    assert owned(CollectionData(path, journaled=True, card_store=card_store)) == {multiverse_id:1 for multiverse_id in range(1, 8)}
+
+
+def test_save_as_waits_for_a_compaction(tmp_path, card_store, monkeypatch):
+    monkeypatch.setattr(Journal, 'compact_threshold', 1)
+    path = str(tmp_path / 'collection.json')
+    collection = CollectionData(path, journaled=True, card_store=card_store)
+    collection.add_cards([(1, 1)])
+    collection.save()
+    collection.add_cards([(2, 1)])
+    collection.save()
+    # A compaction may still be running, it mustn't replace what save_as writes
+    collection.add_cards([(3, 1)])
+    collection.save_as(path)
+    collection.journal.wait()
+
+    with open(path) as f:
+        assert json.load(f)['collection'] == {'1':1, '2':1, '3':1}
+    assert owned(CollectionData(path, journaled=True, card_store=card_store)) == {1:1, 2:1, 3:1}
@@ -0,0 +1,65 @@
+import pytest
+from query import QueryParser, QueryPlan, QueryError
+
+
+def parse(text):
+    return repr(QueryParser.parse(text))
+
+
+def test_legacy_queries():
+    assert parse('name: lightning bolt, cmc:1, rarity:common') == \
+        "And([Term('name', 'contains', 'lightning bolt'), Term('cmc', 'exact', '1'), Term('rarity', 'exact', 'common')])"
+    assert parse('text:draw a card, rarity:mythic') == \
+        "And([Term('text', 'contains', 'draw a card'), Term('rarity', 'exact', 'special')])"
+    assert parse('name:bolt,') == "Term('name', 'contains', 'bolt')"
+    assert parse('cmc:3.0') == "Term('cmc', 'exact', '3')"
+
+
+def test_keywords_inside_values():
+    assert parse('text:target creature or player') == "Term('text', 'contains', 'target creature or player')"
+    assert parse('name:Fire and Ice') == "Term('name', 'contains', 'fire and ice')"
+    assert parse('text:can not be countered') == "Term('text', 'contains', 'can not be countered')"
+
+
+def test_operators():
+    assert parse('bolt OR shock') == "Or([Term('name', 'contains', 'bolt'), Term('name', 'contains', 'shock')])"
+    assert parse('name:bolt or name:shock') == "Or([Term('name', 'contains', 'bolt'), Term('name', 'contains', 'shock')])"
+    assert parse('name:bolt, or name:shock') == "Or([Term('name', 'contains', 'bolt'), Term('name', 'contains', 'shock')])"
+    assert parse('name:bolt or not rarity:common') == \
+        "Or([Term('name', 'contains', 'bolt'), Not(Term('rarity', 'exact', 'common'))])"
+    assert parse('(name:fire or text:draw) and not cmc:3') == \
+        "And([Or([Term('name', 'contains', 'fire'), Term('text', 'contains', 'draw')]), Not(Term('cmc', 'exact', '3'))])"
+    assert parse('name:light*, -rarity:common') == \
+        "And([Term('name', 'prefix', 'light'), Not(Term('rarity', 'exact', 'common'))])"
+    assert parse('rarity!=rare') == "Not(Term('rarity', 'exact', 'rare'))"
+    assert parse('"fire" or "ice"') == "Or([Term('name', 'contains', 'fire'), Term('name', 'contains', 'ice')])"
+    assert QueryParser.parse('') is None
+
+
+@pytest.mark.parametrize('text', ['(name:bolt', 'name:', 'cmc:abc', 'name<3', 'name:"bolt', 'name:bolt)'])
+def test_errors(text):
+    with pytest.raises(QueryError):
+        QueryParser.parse(text)
+
+
+def test_matches():
+    plan = QueryPlan.compile('(name:fire or text:draw) and not cmc:3')
+    assert plan.matches({'name':'Fireball', 'cmc':1})
+    assert plan.matches({'name':'Opt', 'text':'Draw a card.', 'cmc':1})
+    assert not plan.matches({'name':'Fireball', 'cmc':3})
+    assert not plan.matches({'name':'Shock', 'cmc':1})
+    assert QueryPlan.compile('cmc<=2').matches({'cmc':'2'})
+    assert not QueryPlan.compile('cmc<=2').matches({})
+
+
+def test_api_filters():
+    assert QueryPlan.compile('').api_filters() == [{}]
+    # Single field alternatives share a request
+    assert QueryPlan.compile('name:bolt or name:shock').api_filters() == [{'name':'bolt|shock'}]
+    assert QueryPlan.compile('cmc<2, rarity:rare').api_filters() == [{'rarity':'rare', 'cmc':'0|1'}]
+    # De Morgan, not (a or b) is (not a) and (not b) which the API can't search for
+    with pytest.raises(QueryError):
+        QueryPlan.compile('not (name:bolt or name:shock)').api_filters()
+    assert QueryPlan.compile('name:bolt and not (rarity:common and cmc:1)').api_filters() == [{'name':'bolt'}]
+    assert QueryPlan.compile('(name:a or name:b) and (rarity:rare or cmc:1)').api_filters() == \
+        [{'name':'a', 'rarity':'rare'}, {'name':'a', 'cmc':'1'}, {'name':'b', 'rarity':'rare'}, {'name':'b', 'cmc':'1'}]
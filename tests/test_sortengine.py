@@ -0,0 +1,78 @@
+import pytest
+from setmetadata import SetMetadata
+from sortengine import SortKeys, SortedList
+
+
+def check(items, expected):
+    assert list(items) == expected
+    assert [items[i] for i in range(len(items))] == expected
+
+
+def test_add_keeps_equal_keys_in_order():
+    items = SortedList(lambda item: item[0])
+    for item in ['b1', 'a1', 'c1', 'b2', 'a2']:
+        items.add(item)
+    check(items, ['a1', 'a2', 'b1', 'b2', 'c1'])
+
+
+@pytest.mark.parametrize('new', [
+    # After everything already there, appended
+    ['e1', 'd1', 'f1'],
+    # Few enough to insert one at a time
+    ['a2', 'c2', 'e1'],
+    # Enough to merge
+    ['e1', 'a2', 'c2', 'b1', 'd1', 'a3', 'c3', 'f1', 'b2'],
+])
+def test_extend(new):
+    items = SortedList(lambda item: item[0])
+    items.extend(['c1', 'a1', 'd0'])
+    items.extend(new)
+    # The same as sorting everything, ties stay in the order they were added
+    check(items, sorted(['c1', 'a1', 'd0'] + new, key=lambda item: item[0]))
+    items.extend([])
+    assert len(items) == 3 + len(new)
+
+
+def test_remove():
+    items = SortedList(lambda item: item[0])
+    items.extend(['a1', 'b1', 'b2', 'b3', 'c1'])
+    # Finds the right one among the items with the same key
+    items.remove('b2')
+    check(items, ['a1', 'b1', 'b3', 'c1'])
+    items.remove('b3')
+    items.remove('a1')
+    check(items, ['b1', 'c1'])
+    # Not there, nothing happens
+    items.remove('b2')
+    items.remove('z1')
+    check(items, ['b1', 'c1'])
+
+
+def test_resort():
+    items = SortedList(lambda item: item[0])
+    items.extend(['a2', 'b1', 'a1', 'b2'])
+    items.resort(lambda item: item[1])
+    # Ties still go in the order the items were added
+    check(items, ['b1', 'a1', 'a2', 'b2'])
+    # The new key is used from now on
+    items.add('c0')
+    items.remove('a1')
+    check(items, ['c0', 'b1', 'a2', 'b2'])
+
+
+def test_sort_keys_forget(monkeypatch):
+    monkeypatch.setattr(SetMetadata, 'refresh', lambda self: None)
+    sort_keys = SortKeys()
+    # Only the id so far, not remembered
+    assert sort_keys.key('Name', {'multiverse_id':1}) == ('', SortKeys.unknown_date)
+    assert sort_keys.count == 0
+
+    assert sort_keys.key('Name', {'multiverse_id':1, 'name':'Shock'})[0] == 'Shock'
+    assert sort_keys.key('Mana value', {'multiverse_id':1, 'name':'Shock', 'cmc':1})[0] == 1
+    assert sort_keys.count == 2
+    # Remembered, the new name isn't looked at
+    assert sort_keys.key('Name', {'multiverse_id':1, 'name':'Bolt'})[0] == 'Shock'
+
+    sort_keys.forget(1)
+    assert sort_keys.count == 0
+    assert sort_keys.key('Name', {'multiverse_id':1, 'name':'Bolt'})[0] == 'Bolt'
@@ -0,0 +1,84 @@
+import pytest
+import cache
+from cardstore import CardStore
+from collectiondata import CollectionData
+from requester import Requester
+from setmetadata import SetMetadata
+from sqlitecollection import SQLiteCollectionData
+
+
+card_dicts = [
+    {'multiverse_id':1, 'name':'Lightning Bolt', 'cmc':1, 'rarity':'Common', 'set':'LEA', 'text':'Lightning Bolt deals 3 damage to any target.'},
+    {'multiverse_id':2, 'name':'Lighthouse Chronologist', 'cmc':2, 'rarity':'Mythic Rare', 'set':'ROE', 'text':'Level up {U}'},
+    # Lands have no rules text
+    {'multiverse_id':3, 'name':'Forest', 'cmc':0, 'rarity':'Common', 'set':'LEA', 'text':None},
+    {'multiverse_id':4, 'name':"Sol'kanar the Swamp King", 'cmc':5, 'rarity':'Rare', 'set':'LEG', 'text':'Whenever a player casts a black spell, you gain 1 life.'},
+    {'multiverse_id':5, 'name':'Ach! Hans, Run!', 'cmc':6, 'rarity':'Rare', 'set':'UNH',
+     'text':'At the beginning of your upkeep, you may say "Ach! Hans, run! It\'s the..." and the name of a creature card.'},
+    # A card the API didn't know, there's only the id
+    {'multiverse_id':6},
+]
+
+queries = [
+    'name:light*', "name:sol'*", 'name:ach!*', 'name:z*',
+    # 3 or more characters go to the trigram index, shorter ones to LIKE
+    'name:lightning bolt', 'name:bolt', 'name:ol', 'text:a', 'text:"\\"ach"', 'text:%', 'text:_',
+    'name=forest', 'rarity:mythic rare', 'cmc<=1', 'cmc>=5', 'cmc:0',
+    # Cards without the field match the negation
+    'not text:damage', 'not rarity:common', 'rarity!=rare', 'not cmc>1',
+    'name:bolt or name:forest', 'name:l* and not cmc:1', '(text:spell or text:upkeep) and cmc>5', '',
+]
+
+
+@pytest.fixture
+def card_store(tmp_path, monkeypatch):
+    # SQLiteCollectionData always uses the shared store
+    store = CardStore(str(tmp_path / 'cards.db'))
+    monkeypatch.setattr(cache, 'CARD_STORE', store)
+    return store
+
+
+@pytest.fixture
+def collections(card_store, monkeypatch):
+    # CollectionData sorts its results, the release dates don't matter here
+    monkeypatch.setattr(SetMetadata, 'refresh', lambda self: None)
+    json_collection = CollectionData(card_store=card_store)
+    sqlite_collection = SQLiteCollectionData()
+    for card_dict in card_dicts:
+        json_collection.add_card(Requester.make_card(dict(card_dict)))
+        sqlite_collection.add_card(Requester.make_card(dict(card_dict)))
+    return json_collection, sqlite_collection
+
+
+def ids(cards):
+    return sorted(card.multiverse_id for card in cards)
+
+
+@pytest.mark.parametrize('fts', [True, False])
+@pytest.mark.parametrize('query', queries)
+def test_same_results_as_collection_data(collections, query, fts):
+    json_collection, sqlite_collection = collections
+    if fts and not sqlite_collection.fts:
+        pytest.skip('SQLite without FTS5 trigrams')
+    # Without the flag every text search takes the LIKE path
+    sqlite_collection.fts = fts
+    assert ids(sqlite_collection.search(query)) == ids(json_collection.search(query))
+
+
+def test_json_round_trip(tmp_path, card_store, collections):
+    _, sqlite_collection = collections
+    sqlite_collection.add_card(Requester.make_card(dict(card_dicts[0])))
+    path = str(tmp_path / 'collection.json')
+    sqlite_collection.export_json(path)
+
+    reopened = CollectionData(path, card_store=card_store)
+    assert {multiverse_id:entry['collection_data']['owned'] for multiverse_id, entry in reopened.entries.items()} == \
+        {1:2, 2:1, 3:1, 4:1, 5:1, 6:1}
+
+    imported = SQLiteCollectionData()
+    imported.import_json(path)
+    for card_dict in card_dicts:
+        card = Requester.make_card(dict(card_dict))
+        assert imported.num_owned(card) == sqlite_collection.num_owned(card)
+    for query in queries:
+        assert ids(imported.search(query)) == ids(sqlite_collection.search(query))
@@ -1,139 +1,541 @@
-import datetime,  PIL.Image
+import threading, queue, time, logging, perf
 from tkinter import *
 from tkinter import ttk
-from itertools import groupby
 from requester import Requester
-from cache import save_sprite, load_sprite, sprite_in_cache
-from PIL import ImageTk
-from io import BytesIO
+from query import QueryError
+from sortengine import SortKeys, SortedList, get_sort_keys
+from cache import save_sprite, load_sprite, sprite_in_cache, THUMBNAIL_SIZE
+from ui.photocache import PhotoImageCache
+
+log = logging.getLogger(__name__)
 
 
 class CardViewer(Frame):
-    card_size = (223, 310)
-    def __init__(self, master, searchable, height=300, **kwargs):
+    card_size = THUMBNAIL_SIZE
+    # Space around each card in the grid
+    card_padding = 5
+    # Rows above and below the visible ones that get frames too, so a small scroll doesn't show empty space
+    overscan_rows = 1
+    # Ready to draw images, shared by every tab
+    photo_images = PhotoImageCache(card_size)
+    # Most downloaded images to put on screen in one go so the UI stays responsive
+    results_per_tick = 12
+    # How often to check for results when Tcl isn't threaded and other threads can't wake Tk up
+    results_poll_ms = 20
+    # Longest to spend making PhotoImages and CardFrames before letting Tk handle input again
+    frame_budget_ms = 8
+    # Rows past the overscan on either side whose images are downloaded and decoded ahead of time
+    prefetch_rows = 4
+    # Rows of results below the view to have fetched even while the user is scrolling
+    page_lookahead_rows = 10
+    # How long after the last scroll the user counts as idle, when more pages are fetched
+    idle_ms = 400
+    # Cards below the view whose images are looked up (and downloaded if missing) every idle_ms while idle
+    idle_prefetch_cards = 60
+    def __init__(self, master, searchable, height=300, virtualized=True, requester=None, **kwargs):
+        """ :param virtualized: Only make CardFrames for the rows that can be seen. Otherwise every
+                                result gets a frame, which gets slow for big searches.
+            :param requester: The Requester to get images with. By default the viewer gets its own,
+                              which downloads with the downloader every tab shares. """
         super().__init__(master, class_='Card Viewer', **kwargs)
         self.columns = 3
-        self.scrollable_canvas = Canvas(self, height=height, background='red')
-        self.exterior_frame = Frame(self.scrollable_canvas, background='blue')
-        self.scrollbar = Scrollbar(self, orient='vertical', command=self.scrollable_canvas.yview)
-        self.scrollable_canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.virtualized = virtualized
+        self.cell_width = CardViewer.card_size[0] + 2 * CardViewer.card_padding
+        self.cell_height = CardViewer.card_size[1] + 2 * CardViewer.card_padding
+
+        # The canvas is sized so that it fits the amount of cards dictated by self.columns
+        self.scrollable_canvas = Canvas(self, height=height, width=self.columns * self.cell_width, background='red')
+        self.scrollbar = Scrollbar(self, orient='vertical', command=self.__scroll)
+        self.scrollable_canvas.configure(yscrollcommand=self.__on_scroll)
 
-        # This is an instance of the requester class that is used to get sprites only
-        self.requester = Requester()
+        # This is an instance of the requester class that is used to get sprites only.
+        # It's cheap, the threads and connections belong to the shared downloader
+        self.requester = requester or Requester()
 
         # This is an object with a search function. The search function should return a list of mtgsdk.Card objects
         self.searchable = searchable
 
-        # This is just here to keep references to prevent garbage collection
-        self.images = []
+        # The search results in the order they arrived, and the image to show for each of them.
+        # A card's position in these lists is the index the downloader hands back. A path is
+        # None until the card comes near the view, see __path
+        self.cards = []
+        self.paths = []
+        # (position, card) for images __path found missing that haven't been sent to the downloader yet
+        self.to_download = []
+        # Next grid index __prefetch_idle looks at
+        self.idle_cursor = 0
+        # Positions in self.cards in the order they're shown, kept sorted as pages arrive
+        self.sort_order = SortKeys.default_order
+        self.order = SortedList(self.__position_key)
+
+        # Pages of results put here by the search thread as (search id, page), page is None once the search is done
+        self.pages = queue.Queue()
+        # Bumped on every search so pages from an old one can be ignored
+        self.search_id = 0
+        self.searching = False
+        # Set when the search thread may fetch the next page, a new one for every search
+        self.more_pages = threading.Event()
+        # No scrolling for a while, see idle_ms
+        self.idle = True
+        self.idle_job = None
+        # What was last searched for
+        self.search_text = ''
+
+        # grid index -> image for the cards that have a frame, this is just here to keep references to prevent garbage collection
+        self.images = {}
+        # grid index -> (CardFrame, canvas window id) for the cards that have a frame
+        self.shown = {}
+        # (CardFrame, canvas window id) that have scrolled out of view, hidden and waiting to be reused
+        self.spare_frames = []
+        # grid indexes in view that don't have a frame yet, they're given one a few at a time
+        self.to_show = []
+        # grid index -> path for frames showing a placeholder until their image is decoded
+        self.waiting = {}
+        # The (first, last) grid indexes last moved up the download and decode queues
+        self.prefetched_range = None
+        # Bumped every time they are, so the latest view goes ahead of earlier ones
+        self.focus = 0
+
+        # The scheduled call to __load_new_images, if there is one
+        self.load_job = None
+        # Only a threaded Tcl can be called from other threads. Otherwise they post their events
+        # here and __poll hands them to Tk, but only while there's something still running
+        self.threaded = CardViewer.tcl_is_threaded(self)
+        self.posted = queue.Queue()
+        self.poll_job = None
+        # The search thread, the downloader's and the decoder's workers generate <<DownloadDone>>
+        # when they've put something on their queue, rather than the Tk thread checking every so often
+        self.bind('<<DownloadDone>>', lambda event: self.__wake_up())
+        self.requester.on_completed = self.__notify
+        CardViewer.photo_images.decoder.listeners.append(self.__notify)
+        self.bind('<Destroy>', lambda event: self.__destroyed(event))
         
         self.columnconfigure(0, weight=1)
         # Geometry managment
         self.scrollable_canvas.grid(column=0, row=0, sticky=N+E+S+W)
-        self.exterior_frame.pack(fill=BOTH, expand=True)
         self.scrollbar.grid(column=1,row=0, sticky=N+S+E)
 
-        # Put exterior_frame in the canvas
-        self.scrollable_canvas.create_window((0,0), window=self.exterior_frame, anchor=NW)
+        # The canvas getting taller can bring more rows into view
+        self.scrollable_canvas.bind("<Configure>", lambda event: self.__render())
 
-        # Bind on scroll
-        self.exterior_frame.bind("<Configure>", self.__on_scroll)
+        if hasattr(searchable, 'on_fetched'):
+            # A collection opened with cards missing from the card store fetches them in the
+            # background, its thread wakes Tk up through an event once they're in
+            searchable.on_fetched = lambda: self.__notify('<<CardsFetched>>')
+            self.bind('<<CardsFetched>>', lambda event: self.__cards_fetched())
+            self.__start_polling()
 
     def set_images_with_path(self, img_paths, cards):
-        self.images = self.__make_images_from_path(img_paths)
-        self.__update_images(self.images, cards)
+        """ Replaces the cards in the grid. They're shown in the viewer's sort order.
+        :param img_paths: The image to show for each card, None to look it up when it's needed
+        :param cards: The cards """
+        self.cards = list(cards)
+        self.paths = list(img_paths)
+        self.to_download = []
+        self.order = SortedList(self.__position_key)
+        self.order.extend(range(len(self.cards)))
+        self.scrollable_canvas.yview_moveto(0)
+        self.__layout()
+
+    def set_sort_order(self, sort_order):
+        """ Shows the cards in a different order.
+        :param sort_order: One of SortKeys.orders """
+        self.sort_order = sort_order
+        with perf.timer('viewer.sort'):
+            self.order.resort(self.__position_key)
+        self.__layout()
+
+    def __position_key(self, position):
+        return get_sort_keys().card_key(self.sort_order, self.cards[position])
+
+    def __layout(self):
+        """ Redraws the grid after the results or their order changed. """
+        # The cards behind the grid indexes on screen may have moved
+        for index in list(self.shown):
+            self.__hide(index)
+        self.prefetched_range = None
+        # Cards may have been put in above it
+        self.idle_cursor = 0
+
+        rows = (len(self.order) + self.columns - 1) // self.columns
+        self.scrollable_canvas.configure(scrollregion=(0, 0, self.columns * self.cell_width, rows * self.cell_height))
+        self.__render()
 
 
     def load_cards(self, search_text):
-        cards_to_download = []
-        # Get cards that match the search
-        cards = self.searchable.search(search_text)
-
-        # Sort the results
-        cards = sorted(cards, key=lambda card: card.name)
-        temp_cards = []
-        for key, group in groupby(cards, key=lambda x: x.name):
-            temp_cards.extend(sorted(list(group), key=lambda card: datetime.datetime.strptime(Requester.get_set_release_date(card.set_name), '%Y-%m-%d')))
-        cards = temp_cards
-
-        paths = []
+        """ Starts a search. Pages of results are added to the grid as they arrive. """
+        # Drop everything from the previous search
+        self.search_id += 1
+        self.search_text = search_text
+        self.requester.cancel_downloads()
+        self.set_images_with_path([], [])
+
+        if getattr(self.searchable, 'search_in_background', False):
+            # Network searches go on another thread, __load_new_images picks the pages up as they land.
+            # Let the old search's thread go if it was waiting to fetch its next page
+            self.more_pages.set()
+            self.more_pages = threading.Event()
+            self.searching = True
+            search_thread = threading.Thread(target=self.__search, args=(self.searchable, search_text, self.search_id, self.more_pages), daemon=True)
+            search_thread.start()
+        else:
+            self.searching = False
+            try:
+                for page in self.searchable.iter_search(search_text):
+                    self.__add_cards(page)
+            except QueryError as error:
+                log.warning('Search for %s failed: %s', search_text, error)
+
+        # Load the new images, the previous search's loop is replaced rather than left running alongside
+        if self.load_job is not None:
+            self.after_cancel(self.load_job)
+        self.__load_new_images()
+        self.__start_polling()
+
+    def __cards_fetched(self):
+        """ Shows the last search again now that the cards it only had ids for have their data. """
+        if self.search_id and not self.searching:
+            self.load_cards(self.search_text)
+
+    def __search(self, searchable, search_text, search_id, more_pages):
+        """ Runs on the search thread. Fetches a page, then waits for __want_pages before the next. """
+        try:
+            for page in searchable.iter_search(search_text):
+                if search_id != self.search_id:
+                    # Another search started, stop asking for pages nobody will see
+                    return
+                more_pages.clear()
+                self.pages.put((search_id, page))
+                self.__notify()
+                more_pages.wait()
+                if search_id != self.search_id:
+                    # Woken up by a newer search, go before the generator asks the API for another page
+                    return
+        except Exception as error:
+            log.warning('Search for %s failed: %s', search_text, error)
+        finally:
+            self.pages.put((search_id, None))
+            self.__notify()
+
+    @staticmethod
+    def tcl_is_threaded(widget):
+        """ :return: Whether Tcl was built with threads, which is what lets other threads call event_generate """
+        try:
+            return bool(int(widget.tk.eval('set tcl_platform(threaded)')))
+        except (TclError, ValueError):
+            return False
+
+    def __notify(self, event='<<DownloadDone>>'):
+        """ Tells the Tk thread there's something for it, by default for __load_new_images. Called from other threads. """
+        if not self.threaded:
+            # Calling Tk from here would raise, __poll passes it on
+            self.posted.put(event)
+            return
+        try:
+            self.event_generate(event, when='tail')
+        except (TclError, RuntimeError):
+            # The viewer's been destroyed or Tk's main loop has stopped
+            pass
+
+    def __start_polling(self):
+        """ Starts __poll if Tcl isn't threaded and it isn't running already. Call whenever work is started. """
+        if not self.threaded and self.poll_job is None:
+            self.poll_job = self.after(CardViewer.results_poll_ms, self.__poll)
+
+    def __poll(self):
+        """ Generates the events other threads posted, every results_poll_ms until nothing's left running. """
+        self.poll_job = None
+        while True:
+            try:
+                event = self.posted.get_nowait()
+            except queue.Empty:
+                break
+            self.event_generate(event, when='tail')
+        fetch_thread = getattr(self.searchable, 'fetch_thread', None)
+        if (self.searching or self.requester.preforming_async_task() or self.waiting or CardViewer.photo_images.pending
+                or not self.posted.empty() or (fetch_thread is not None and fetch_thread.is_alive())):
+            self.poll_job = self.after(CardViewer.results_poll_ms, self.__poll)
+
+    def __wake_up(self):
+        if self.load_job is None:
+            self.load_job = self.after_idle(self.__load_new_images)
+
+    def __destroyed(self, event):
+        if event.widget is self and self.__notify in CardViewer.photo_images.decoder.listeners:
+            CardViewer.photo_images.decoder.listeners.remove(self.__notify)
+
+    @staticmethod
+    def sort_key(card):
+        """ The key for the default order, by name and printings of the same card by release date. """
+        return get_sort_keys().card_key(SortKeys.default_order, card)
+
+    def __add_cards(self, cards):
+        """ Adds a page of results to the grid. Images are looked up, and downloaded if they're
+        missing, as the cards come near the view rather than for the whole page. """
+        first_new = len(self.cards)
+
         for card in cards:
-            print(f'loading card {card.name}')
             # For some reason some cards don't have multiverse ids?
-            if card.multiverse_id != None:
-                data = None
-                if not sprite_in_cache(card.multiverse_id):
-                    cards_to_download.append((len(paths), card))
-                    data = dict(img_data=None, path='')
-                else:
-                    data = load_sprite(card.multiverse_id)
-                
-                if data['path']:
-                    # Card with image
-                    paths.append(data['path'])
-                else:
-                    # Blank card
-                    paths.append('./scr_images/blank_card.png')
-
-        # Update images
-        self.set_images_with_path(paths, cards)
-
-        # Download the ones that need to be downloaded
-        self.requester.async_download_images(cards_to_download)
-        # Load the new images
-        self.__load_new_images()
-        
-    def __on_scroll(self, event):
+            if card.multiverse_id == None:
+                continue
+            self.cards.append(card)
+            self.paths.append(None)
+
+        # The old order is already sorted so only the new page is sorted, then merged in
+        with perf.timer('viewer.sort'):
+            self.order.extend(range(first_new, len(self.cards)))
+        with perf.timer('viewer.layout'):
+            self.__layout()
+        if self.idle and self.idle_job is None:
+            # Images further down get looked up while nothing else is going on
+            self.idle_job = self.after(CardViewer.idle_ms, self.__prefetch_idle)
+
+    def __path(self, position):
+        """ Gets the image to show for a card, looking it up the first time. A missing image gets
+        the placeholder and goes on the list for __download_missing. """
+        path = self.paths[position]
+        if path is None:
+            card = self.cards[position]
+            if sprite_in_cache(card.multiverse_id):
+                # The thumbnail is already the right size
+                path = load_sprite(card.multiverse_id)['thumbnail']
+            else:
+                path = PhotoImageCache.placeholder_path
+                self.to_download.append((position, card))
+            self.paths[position] = path
+        return path
+
+    def __download_missing(self):
+        """ Sends the images __path found missing to the downloader. They start at the back of
+        the queue, __prefetch moves the ones near the view to the front. """
+        if self.to_download:
+            self.requester.async_download_images(self.to_download, replace=False)
+            self.to_download = []
+            self.__start_polling()
+
+    def __scroll(self, *args):
+        """ Called by the scrollbar when the user drags or clicks it. """
+        self.idle = False
+        if self.idle_job is not None:
+            self.after_cancel(self.idle_job)
+        self.idle_job = self.after(CardViewer.idle_ms, self.__on_idle)
+        self.scrollable_canvas.yview(*args)
+
+    def __on_idle(self):
+        self.idle_job = None
+        self.idle = True
+        self.__want_pages()
+        self.__prefetch_idle()
+
+    def __prefetch_idle(self):
+        """ Looks up the images of the next few cards below the view while the user is idle, so
+        they all get downloaded in the end without getting in the way of scrolling. """
+        self.idle_job = None
+        if not self.idle:
+            return
+        looked_up = 0
+        while self.idle_cursor < len(self.order) and looked_up < CardViewer.idle_prefetch_cards:
+            position = self.order[self.idle_cursor]
+            self.idle_cursor += 1
+            if self.paths[position] is None:
+                self.__path(position)
+                looked_up += 1
+        self.__download_missing()
+        if self.idle_cursor < len(self.order):
+            self.idle_job = self.after(CardViewer.idle_ms, self.__prefetch_idle)
+
+    def __want_pages(self):
+        """ Lets the search thread fetch the next page when the user isn't scrolling or the
+        results below the view are running out. """
+        if self.idle or len(self.order) - self.__visible_range()[1] < CardViewer.page_lookahead_rows * self.columns:
+            self.more_pages.set()
+
+    def __on_scroll(self, first, last):
+        """ Called by the canvas whenever the part of the grid that can be seen changes. """
+        self.scrollbar.set(first, last)
+        self.__render()
+
+    def __visible_range(self):
+        """ :return: (first, last) indexes of the cards that should have a frame, last is exclusive """
+        if not self.virtualized:
+            return 0, len(self.order)
+
         canvas = self.scrollable_canvas
-        # we resize the canvas so that it fits the amount of cards dictated by self.columns
-        canvas.configure(scrollregion=canvas.bbox("all"), width=self.winfo_width())
+        top = canvas.canvasy(0)
+        bottom = canvas.canvasy(canvas.winfo_height())
+        first_row = max(0, int(top // self.cell_height) - CardViewer.overscan_rows)
+        last_row = int(bottom // self.cell_height) + 1 + CardViewer.overscan_rows
+        return first_row * self.columns, min(len(self.order), last_row * self.columns)
 
-    def __load_new_images(self):
-        if self.requester.has_results_in_list():
-            results = self.requester.pop_async_results()
-            for index, img_data, card_obj in results:
-                image = self.__make_image_from_path(img_data['path'])
-                self.__update_image(index, image, card_obj)
-
-        # I think in theory if the requester finishes it's last process right here
-        # we could end up missing some of the cards because preforming_async_task will be false
-        # but the data won't have been loaded yet... Maybe?
-
-        # If it's still loading data than try again in 20ms
-        if self.requester.preforming_async_task():
-            self.after(20, self.__load_new_images)
-
-    def __update_images(self, images, cards):
-        """ Destroy all current images and load in new ones """
-        for child in self.exterior_frame.winfo_children():
-            child.destroy()
-        for index, image in enumerate(images):
-            self.__update_image(index, image, cards[index])
-            
-    def __update_image(self, index, image, card):
-        column = index % self.columns
-        row = index // self.columns
-        
+    def __render(self):
+        """ Makes sure exactly the cards in the visible range have frames. As many as fit in the
+        time budget get one now, __load_new_images sees to the rest. """
+        first, last = self.__visible_range()
+
+        # Free the frames that scrolled out of view so the ones scrolling in can use them
+        for index in [index for index in self.shown if not first <= index < last]:
+            self.__hide(index)
+
+        self.to_show = [index for index in range(first, last) if index not in self.shown]
+        self.__show_pending(self.__deadline())
+        if self.to_show and self.load_job is None:
+            self.load_job = self.after_idle(self.__load_new_images)
+        self.__prefetch(first, last)
+        self.__download_missing()
+        self.__want_pages()
+        self.__start_polling()
+
+    def __prefetch(self, first, last):
+        """ Moves the images of the cards in and near the view to the front of the download and
+        decode queues, closest first. """
+        if not self.virtualized or (first, last) == self.prefetched_range:
+            # Without virtualizing everything is in view
+            return
+        self.prefetched_range = (first, last)
+        self.focus += 1
+
+        ahead = CardViewer.prefetch_rows * self.columns
+        downloads = {}
+        for index in range(max(0, first - ahead), min(len(self.order), last + ahead)):
+            # Rows away from the view, 0 for the ones in it
+            if index < first:
+                distance = (first - 1 - index) // self.columns + 1
+            elif index >= last:
+                distance = (index - last) // self.columns + 1
+            else:
+                distance = 0
+            position = self.order[index]
+            path = self.__path(position)
+            if path == PhotoImageCache.placeholder_path:
+                downloads[position] = (0, -self.focus, distance)
+            elif distance:
+                # The ones in view were asked for when their frame was made
+                CardViewer.photo_images.request(path, distance)
+        # Anything just found missing has to be queued before it can be moved up
+        self.__download_missing()
+        if downloads:
+            self.requester.prioritize(downloads)
+
+    @staticmethod
+    def __deadline():
+        return time.perf_counter() + CardViewer.frame_budget_ms / 1000
+
+    def __show_pending(self, deadline):
+        """ Gives frames to the cards waiting for one, top of the screen first, until time's up. """
+        shown = 0
+        for index in self.to_show:
+            # At least one per call so a slow machine still gets there
+            if shown and time.perf_counter() >= deadline:
+                break
+            self.__show(index)
+            shown += 1
+        del self.to_show[:shown]
+
+    def __show(self, index):
+        canvas = self.scrollable_canvas
+        position = self.order[index]
+        card = self.cards[position]
+        image = self.__image_for(index, self.__path(position))
         self.images[index] = image
-        print(f'updating image for {card.name}')
-        card_frame = CardFrame(self.exterior_frame, card, image, self.searchable, width=CardViewer.card_size[0], height=CardViewer.card_size[1], background='purple')
-        card_frame.grid(column=column, row=row, padx=5, pady=5)
-
-    def __make_image_from_path(self, path):
-        pil_img = PIL.Image.open(path)
-        pil_img = pil_img.resize(CardViewer.card_size, PIL.Image.ANTIALIAS)
-        img = ImageTk.PhotoImage(pil_img)
-
-        return img
-
-    def __make_images_from_path(self, img_paths):
-        images = []
-        for path in img_paths:
-            pil_img = PIL.Image.open(path)
-            pil_img = pil_img.resize(CardViewer.card_size, PIL.Image.ANTIALIAS)
-            images.append(ImageTk.PhotoImage(pil_img))
-        
-        return images
+
+        x = (index % self.columns) * self.cell_width + CardViewer.card_padding
+        y = (index // self.columns) * self.cell_height + CardViewer.card_padding
+        if self.spare_frames:
+            with perf.timer('viewer.reuse_frame'):
+                card_frame, window = self.spare_frames.pop()
+                card_frame.show(card, image)
+                canvas.coords(window, x, y)
+                canvas.itemconfigure(window, state='normal')
+        else:
+            with perf.timer('viewer.create_frame'):
+                card_frame = CardFrame(canvas, card, image, self.searchable, width=CardViewer.card_size[0], height=CardViewer.card_size[1], background='purple')
+                window = canvas.create_window(x, y, window=card_frame, anchor=NW)
+        self.shown[index] = (card_frame, window)
+
+    def __hide(self, index):
+        card_frame, window = self.shown.pop(index)
+        self.images.pop(index, None)
+        self.waiting.pop(index, None)
+        self.scrollable_canvas.itemconfigure(window, state='hidden')
+        self.spare_frames.append((card_frame, window))
+
+    def __load_new_images(self):
+        """ Puts new pages of results and downloaded images into the grid a batch at a time. Runs
+        again straight away while there's more ready, otherwise waits for the next <<DownloadDone>>. """
+        while True:
+            try:
+                search_id, page = self.pages.get_nowait()
+            except queue.Empty:
+                break
+            if search_id != self.search_id:
+                continue
+            if page is None:
+                self.searching = False
+            else:
+                self.__add_cards(page)
+
+        results = self.requester.pop_async_results(CardViewer.results_per_tick)
+        for position, img_data, card_obj in results:
+            self.paths[position] = img_data['thumbnail']
+            # The file may have been written again, i.e. after it failed to decode before
+            CardViewer.photo_images.discard(self.paths[position])
+            self.__update_image(position)
+
+        # Decoding happened on the decoder's threads, making the PhotoImages and frames has to
+        # happen here so it's kept to a few milliseconds a go
+        deadline = self.__deadline()
+        CardViewer.photo_images.make_ready(deadline)
+        self.__swap_ready()
+        self.__show_pending(deadline)
+        self.__download_missing()
+
+        if (len(results) == CardViewer.results_per_tick or self.to_show or not self.pages.empty()
+                or not CardViewer.photo_images.decoder.results.empty()):
+            # There's more waiting, get to it as soon as Tk has caught up
+            self.load_job = self.after_idle(self.__load_new_images)
+        else:
+            # Nothing to do until a <<DownloadDone>> comes in
+            self.load_job = None
+        self.__start_polling()
+
+    def __update_image(self, position):
+        """ Gets a card's new image decoded if it has a frame, __swap_ready puts it in once it's ready.
+        Cards out of view pick up their new image when they scroll in. """
+        for index in self.shown:
+            if self.order[index] == position:
+                self.waiting[index] = self.paths[position]
+                CardViewer.photo_images.request(self.paths[position])
+
+    def __image_for(self, index, path):
+        """ :return: The image at path if it's ready, otherwise the placeholder with the real one on its way """
+        image = CardViewer.photo_images.peek(path)
+        if image is None and path in CardViewer.photo_images.unreadable:
+            return CardViewer.photo_images.placeholder()
+        if image is None:
+            CardViewer.photo_images.request(path)
+            self.waiting[index] = path
+            image = CardViewer.photo_images.placeholder()
+        return image
+
+    def __swap_ready(self):
+        """ Puts decoded images into the frames that were waiting for them. """
+        photo_images = CardViewer.photo_images
+        for index, path in list(self.waiting.items()):
+            if path in photo_images.unreadable:
+                # The frame keeps its placeholder
+                del self.waiting[index]
+                continue
+            if path not in photo_images.images:
+                if path not in photo_images.pending:
+                    # Pushed out of the cache before it got here, ask again
+                    photo_images.request(path)
+                continue
+            del self.waiting[index]
+            with perf.timer('viewer.update_image'):
+                image = photo_images.peek(path)
+                self.images[index] = image
+                card_frame, window = self.shown[index]
+                card_frame.show(self.cards[self.order[index]], image)
 
 
 class CardFrame(Frame):
@@ -146,7 +548,7 @@ class CardFrame(Frame):
         self.collection = collection
         self.canvas = Canvas(self, width=width, height=height, background='green')
 
-        self.canvas.create_image(0, 0, image=image, anchor=NW)
+        self.image_item = self.canvas.create_image(0, 0, image=image, anchor=NW)
 
         self.canvas.pack()
 
@@ -160,6 +562,12 @@ class CardFrame(Frame):
         self.popup_menu.bind("<Leave>", self.__leave)
         self.canvas.bind("<Button-3>", self.__popup)
     
+    def show(self, card, image):
+        """ Reuses this frame for a different card. """
+        self.card_data = card
+        self.image = image
+        self.canvas.itemconfigure(self.image_item, image=image)
+
     def __leave(self, event):
         self.popup_menu.unpost()
 
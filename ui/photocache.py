@@ -0,0 +1,165 @@
+import threading, queue, time, logging, perf
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class ImageDecoder(object):
+    """ Opens and resizes images on worker threads so the Tk thread only has to turn the
+    finished pixels into PhotoImages. PIL lets go of the GIL while it decodes and resizes,
+    so a couple of workers really do run alongside the UI.
+
+    Requests are worked through lowest priority first and newest first after that: after a
+    quick scroll the images now on screen get decoded before the ones that scrolled past. """
+    default_workers = 2
+
+    def __init__(self, size, max_workers=None):
+        self.size = size
+        self.max_workers = max_workers or ImageDecoder.default_workers
+        # (priority, -sequence, path), a path asked for again at a lower priority is queued
+        # again and the job that doesn't match its priority anymore is skipped
+        self.jobs = queue.PriorityQueue()
+        self.sequence = 0
+        self.lock = threading.Lock()
+        # path -> priority for the paths on the queue
+        self.queued = {}
+        # (path, PIL.Image or None if it couldn't be read) ready for the Tk thread
+        self.results = queue.Queue()
+        # Functions called on the worker thread after each result, i.e. to wake up the viewers
+        self.listeners = []
+        self.workers = []
+
+    def decode(self, path, priority=0):
+        """ Queues up an image. Its result turns up in self.results.
+        :param priority: Lower is decoded sooner """
+        with self.lock:
+            queued = self.queued.get(path)
+            if queued is not None and queued <= priority:
+                return
+            self.queued[path] = priority
+            self.sequence += 1
+            self.jobs.put((priority, -self.sequence, path))
+        # Threads are started on the first request, not when the viewer class is made
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self.__work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __work(self):
+        while True:
+            priority, _, path = self.jobs.get()
+            with self.lock:
+                if self.queued.get(path) != priority:
+                    continue
+                del self.queued[path]
+            # Anything going wrong still has to post a result, the path would be pending forever otherwise
+            try:
+                with perf.timer('photo.decode'):
+                    pil_img = ImageDecoder.open(path, self.size)
+            except Exception as error:
+                # i.e. the file was evicted from the image cache since the search was made, or is cut short
+                perf.count('photo.decode_failed')
+                log.warning('Could not read %s: %s', path, error)
+                pil_img = None
+            self.results.put((path, pil_img))
+            for listener in list(self.listeners):
+                listener()
+
+    @staticmethod
+    def open(path, size):
+        """ Reads an image and scales it to size if it isn't already.
+        :return: A loaded PIL.Image """
+        # PIL is imported the first time an image is needed rather than when the app starts
+        import PIL.Image
+        pil_img = PIL.Image.open(path)
+        if pil_img.size != size:
+            pil_img = pil_img.resize(size, PIL.Image.LANCZOS)
+        # open() is lazy, make sure the decode happens here rather than in PhotoImage
+        pil_img.load()
+        return pil_img
+
+
+class PhotoImageCache(object):
+    """ Keeps the most recently used PhotoImages around so showing the same card again
+    doesn't decode or resize anything. Only use it from the Tk thread.
+
+    request() decodes on the ImageDecoder's threads, call make_ready() every so often to turn
+    what's been decoded into PhotoImages a few at a time. """
+    placeholder_path = './scr_images/blank_card.png'
+
+    def __init__(self, size, max_images=400):
+        # Images that aren't already this size (i.e. blank_card.png) are scaled on the way in
+        self.size = size
+        self.max_images = max_images
+        # path -> PhotoImage, oldest first
+        self.images = OrderedDict()
+        # Paths sent to the decoder and not back yet
+        self.pending = set()
+        # Paths that couldn't be read, they aren't asked for again until they're discarded
+        self.unreadable = set()
+        self.decoder = ImageDecoder(size)
+        # Kept outside self.images so it's never evicted
+        self.placeholder_image = None
+
+    def peek(self, path):
+        """ :return: The cached PhotoImage for path, None if it hasn't been made yet """
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+            perf.count('photo_cache.hit')
+            return image
+        perf.count('photo_cache.miss')
+        return None
+
+    def placeholder(self):
+        """ :return: The blank card PhotoImage shown while the real image is on its way """
+        if self.placeholder_image is None:
+            from PIL import ImageTk
+            self.placeholder_image = ImageTk.PhotoImage(ImageDecoder.open(PhotoImageCache.placeholder_path, self.size))
+        return self.placeholder_image
+
+    def request(self, path, priority=0):
+        """ Gets an image decoded in the background unless it's already cached. Asking again for
+        one that's on its way moves it up if the priority is lower.
+        :param priority: Lower is decoded sooner, 0 for images on screen """
+        if path in self.images or path in self.unreadable:
+            return
+        self.pending.add(path)
+        self.decoder.decode(path, priority)
+
+    def make_ready(self, deadline):
+        """ Turns decoded images into PhotoImages until they run out or time's up.
+        Images that couldn't be read go in self.unreadable rather than the cache.
+        :param deadline: time.perf_counter() value to stop at
+        :return: The number of images made """
+        made = 0
+        while time.perf_counter() < deadline:
+            try:
+                path, pil_img = self.decoder.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(path)
+            if pil_img is None:
+                self.unreadable.add(path)
+            else:
+                self.__store(path, pil_img)
+            made += 1
+        return made
+
+    def __store(self, path, pil_img):
+        from PIL import ImageTk
+        with perf.timer('photo.make_photoimage'):
+            image = ImageTk.PhotoImage(pil_img)
+        self.__remember(path, image)
+        return image
+
+    def __remember(self, path, image):
+        self.images[path] = image
+        # Frames showing an evicted image keep their own reference so it's safe to let go of here
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+
+    def discard(self, path):
+        """ Forgets the image at path, i.e. because the file behind it changed. """
+        self.images.pop(path, None)
+        self.unreadable.discard(path)